@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+import os
+from queue import Empty, LifoQueue
+import threading
+from typing import Callable, Iterator, Optional
+import psycopg
+
+# Database connection settings, shared by the load pipeline and the lookup writers. The DSN defaults to the docker
+# compose database (see docker-compose.yaml), and can be overridden with the DATABASE_DSN environment variable - eg.
+# `DATABASE_DSN='host=db.example.com dbname=gis user=loader' make populate_db_with_postcode_data`.
+DEFAULT_DATABASE_DSN = 'user=local password=password host=localhost port=54321 dbname=gis'
+DATABASE_DSN = os.environ.get('DATABASE_DSN', DEFAULT_DATABASE_DSN)
+# The maximum number of connections in the shared pool, overridden with the DATABASE_POOL_SIZE environment variable
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', (os.cpu_count() or 1) + 4))
+
+# Opens a new connection which isn't part of the pool - eg. for worker processes, which can't share connections
+def connect(**kwargs) -> psycopg.Connection:
+    return psycopg.connect(DATABASE_DSN, **kwargs)
+
+# A minimal thread-safe connection pool. Connections are opened as they're needed, up to max_size, and returned to the
+# pool for re-use when the with block using them exits - a caller wanting a connection when max_size are in use waits
+# for one to be returned. A connection is rolled back before it's returned, so it's never handed out mid-transaction,
+# and broken connections are discarded rather than returned. If configure is set, it's called with each new connection
+# (eg. to apply session settings) before the connection is first used.
+class ConnectionPool:
+    def __init__(
+        self,
+        dsn: str = DATABASE_DSN,
+        max_size: int = DATABASE_POOL_SIZE,
+        configure: Optional[Callable[[psycopg.Connection], None]] = None
+    ):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.configure = configure
+        self.idle = LifoQueue()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.returned = threading.Condition(self.lock)
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg.Connection]:
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._release(connection)
+
+    # Closes the idle connections - connections in use are still returned to the pool
+    def close(self) -> None:
+        with self.lock:
+            while True:
+                try:
+                    self.idle.get_nowait().close()
+                except Empty:
+                    return
+                self.size -= 1
+                self.returned.notify()
+
+    def _acquire(self) -> psycopg.Connection:
+        with self.lock:
+            while True:
+                try:
+                    return self.idle.get_nowait()
+                except Empty:
+                    pass
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                self.returned.wait()
+
+        connection = None
+        try:
+            connection = psycopg.connect(self.dsn)
+            if self.configure is not None:
+                self.configure(connection)
+            return connection
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            with self.lock:
+                self.size -= 1
+                self.returned.notify()
+            raise
+
+    def _release(self, connection: psycopg.Connection) -> None:
+        if not connection.closed:
+            try:
+                connection.rollback()
+            except psycopg.Error:
+                connection.close()
+
+        with self.lock:
+            if connection.closed:
+                self.size -= 1
+            else:
+                self.idle.put(connection)
+            self.returned.notify()
+
+# The pool shared by everything in this process. Worker processes forked from a process with a pool get a pool of
+# their own, rather than sharing the parent's connections.
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def pool() -> ConnectionPool:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool()
+            _pool_pid = os.getpid()
+        return _pool
@@ -0,0 +1,150 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import gzip
+import json
+import os
+import zlib
+from typing import List, Optional, Sequence
+
+# Block-compressed files: the data is split into blocks which are compressed independently, as separate gzip members
+# or zstd frames, and concatenated. The result is still an ordinary .gz / .zst file (zcat / zstdcat decompress the whole
+# thing), but a side index (the file name + BLOCK_INDEX_SUFFIX) records where each block starts, so a reader can seek
+# to and decompress a single block rather than the whole file.
+#
+# Each block in the index records its compressed offset & size, its uncompressed offset & size, its row count, and -
+# for files of postcodes - the smallest and largest key (unit postcode) in the block. The keys are a range rather than
+# just the first postcode, as the database's postcode order isn't necessarily python's string order, so a reader looks
+# for the blocks whose range contains the postcode (almost always exactly one).
+#
+# Blocks are compressed on a thread pool - zlib & zstandard release the GIL while compressing - with at most
+# MAX_PENDING_BLOCKS_PER_WORKER blocks per worker in flight, and written in order as they complete.
+#
+# zstd needs the zstandard package, which is an optional dependency (`poetry install --extras zstd`).
+BLOCK_INDEX_SUFFIX = '.idx'
+COMPRESSIONS = ('gzip', 'zstd')
+MAX_PENDING_BLOCKS_PER_WORKER = 2
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError as error:
+        raise ImportError('zstd compression needs zstandard - install it with `poetry install --extras zstd`') from error
+    return zstandard
+
+class BlockCompressedWriter:
+    def __init__(self, filename: str, compression: str = 'gzip', level: Optional[int] = None, workers: Optional[int] = None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(COMPRESSIONS)}")
+
+        if compression == 'gzip':
+            level = 6 if level is None else level
+            # mtime=0, so the output only depends on the data
+            self.compress = lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+        else:
+            zstandard = import_zstandard()
+            level = 3 if level is None else level
+            # ZstdCompressor isn't thread safe, so each block gets its own (they're cheap to create)
+            self.compress = lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+
+        self.filename = filename
+        self.compression = compression
+        self.file = open(filename, 'wb')
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.blocks = []
+        self.offset = 0
+        self.uncompressed_offset = 0
+
+    # keys are the postcodes in the block, if any - only their range is kept. Missing keys (None or NaN, for invalid
+    # postcodes) are left out of the range.
+    def write_block(self, data: bytes, keys: Sequence[Optional[str]] = (), rows: Optional[int] = None) -> None:
+        valid_keys = [key for key in keys if isinstance(key, str)]
+        block = {
+            'min_key': min(valid_keys) if valid_keys else None,
+            'max_key': max(valid_keys) if valid_keys else None,
+            'rows': len(keys) if rows is None else rows,
+            'uncompressed_offset': self.uncompressed_offset,
+            'uncompressed_bytes': len(data),
+        }
+        self.uncompressed_offset += len(data)
+        self.pending.append((block, self.executor.submit(self.compress, data)))
+        while len(self.pending) > self.workers * MAX_PENDING_BLOCKS_PER_WORKER:
+            self._write_next_block()
+
+    def close(self) -> None:
+        while self.pending:
+            self._write_next_block()
+        self.executor.shutdown()
+        self.file.close()
+
+        with open(self.filename + BLOCK_INDEX_SUFFIX, 'w') as file:
+            json.dump({'compression': self.compression, 'blocks': self.blocks}, file)
+
+    def _write_next_block(self) -> None:
+        block, future = self.pending.popleft()
+        compressed = future.result()
+        self.file.write(compressed)
+        block['offset'] = self.offset
+        block['compressed_bytes'] = len(compressed)
+        self.offset += len(compressed)
+        self.blocks.append(block)
+
+class BlockCompressedReader:
+    def __init__(self, filename: str):
+        with open(filename + BLOCK_INDEX_SUFFIX, 'r') as file:
+            index = json.load(file)
+        self.filename = filename
+        self.compression = index['compression']
+        self.blocks = index['blocks']
+        self.uncompressed_offsets = [block['uncompressed_offset'] for block in self.blocks]
+        if self.compression == 'zstd':
+            self.zstandard = import_zstandard()
+
+    # The indexes of the blocks which might contain the key
+    def blocks_containing(self, key: str) -> List[int]:
+        return [
+            i for i, block in enumerate(self.blocks)
+            if block['min_key'] is not None and block['min_key'] <= key <= block['max_key']
+        ]
+
+    def read_block(self, block_number: int) -> bytes:
+        block = self.blocks[block_number]
+        with open(self.filename, 'rb') as file:
+            file.seek(block['offset'])
+            compressed = file.read(block['compressed_bytes'])
+
+        if self.compression == 'gzip':
+            # wbits=31 - a single gzip member
+            return zlib.decompress(compressed, wbits=31)
+        return self.zstandard.ZstdDecompressor().decompress(compressed, max_output_size=block['uncompressed_bytes'])
+
+    # Reads length bytes from the given offset in the uncompressed data, only decompressing the blocks they're in
+    def read_at(self, offset: int, length: int) -> bytes:
+        data = bytearray()
+        block_number = max(bisect.bisect_right(self.uncompressed_offsets, offset) - 1, 0)
+        while length > 0 and block_number < len(self.blocks):
+            block = self.read_block(block_number)
+            start = offset - self.blocks[block_number]['uncompressed_offset']
+            chunk = block[start:start + length]
+            data += chunk
+            offset += len(chunk)
+            length -= len(chunk)
+            block_number += 1
+        return bytes(data)
+
+# Block compresses an existing file (eg. the SQLite database, which can't be written a block of rows at a time) in
+# blocks of block_bytes. Without postcode keys, the index can only be used to read byte ranges (see read_at) - eg. by
+# an HTTP range request based SQLite reader fetching individual pages.
+def compress_file_in_blocks(
+    file_path: str,
+    output_file_path: str,
+    compression: str = 'gzip',
+    block_bytes: int = 1024 * 1024
+) -> None:
+    writer = BlockCompressedWriter(output_file_path, compression)
+    with open(file_path, 'rb') as file:
+        while data := file.read(block_bytes):
+            writer.write_block(data, rows=0)
+    writer.close()
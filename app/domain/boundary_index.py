@@ -0,0 +1,184 @@
+import numpy
+from app.domain.geopackage import read_geopackage_polygons
+from typing import List, Optional, Tuple
+
+# In-process point-in-polygon engine, for assigning large numbers of points (UPRN addresses, ONSPD postcode centroids)
+# to boundaries such as constituencies without needing PostGIS.
+#
+# The index has two levels, both stored as flat numpy arrays in CSR form (an offsets array plus a values array), so
+# batches of points can be assigned without any per-point python:
+# - A uniform grid over the extent of all the boundaries. Each grid cell lists the boundaries whose bounding box
+#   overlaps the cell, giving a handful of candidate boundaries for each point.
+# - Each boundary is split into horizontal bands, and each band lists the boundary edges which span it. A point is
+#   inside a boundary if a ray cast from the point in the +x direction crosses an odd number of the edges in the
+#   point's band. As rings from all polygons (including holes) are included, this handles multi-polygons and holes.
+#
+# Points exactly on a boundary edge follow the ray casting rule, rather than PostGIS ST_Within (which puts them in
+# neither boundary): a point on the edge between two boundaries is in exactly one of them - the one to its right for a
+# vertical edge, or the one above it for a horizontal edge.
+class BoundaryIndex:
+    GRID_SIZE = 256
+    EDGES_PER_BAND = 4
+    POINTS_PER_BATCH = 100_000
+
+    def __init__(self, srs_id: int, features: List[Tuple[str, List[numpy.ndarray]]]):
+        self.srs_id = srs_id
+        self.codes = numpy.array([code for code, _rings in features], dtype=object)
+        self._build_edges(features)
+        self._build_bands()
+        self._build_grid()
+
+    @classmethod
+    def from_geopackage(cls, file_path: str, code_column: str = 'short_code', table_name: Optional[str] = None) -> 'BoundaryIndex':
+        srs_id, features = read_geopackage_polygons(file_path, code_column, table_name)
+        return cls(srs_id, features)
+
+    # Returns the index of the boundary containing each point, or -1 if the point isn't within any boundary. The x/y
+    # co-ordinates must be in the index's SRS.
+    def assign_indexes(self, x, y) -> numpy.ndarray:
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        result = numpy.full(len(x), -1, dtype=numpy.int64)
+        for start in range(0, len(x), self.POINTS_PER_BATCH):
+            end = start + self.POINTS_PER_BATCH
+            result[start:end] = self._assign_batch(x[start:end], y[start:end])
+        return result
+
+    # Returns the code of the boundary containing each point, or None if the point isn't within any boundary
+    def assign(self, x, y) -> numpy.ndarray:
+        indexes = self.assign_indexes(x, y)
+        codes = numpy.full(len(indexes), None, dtype=object)
+        found = indexes >= 0
+        codes[found] = self.codes[indexes[found]]
+        return codes
+
+    def _build_edges(self, features: List[Tuple[str, List[numpy.ndarray]]]) -> None:
+        edge_boundaries, x1, y1, x2, y2 = [], [], [], [], []
+        for boundary_no, (_code, rings) in enumerate(features):
+            for ring in rings:
+                edge_boundaries.append(numpy.full(len(ring) - 1, boundary_no, dtype=numpy.int64))
+                x1.append(ring[:-1, 0])
+                y1.append(ring[:-1, 1])
+                x2.append(ring[1:, 0])
+                y2.append(ring[1:, 1])
+
+        self.edge_boundaries = numpy.concatenate(edge_boundaries)
+        self.edge_x1, self.edge_y1 = numpy.concatenate(x1), numpy.concatenate(y1)
+        self.edge_x2, self.edge_y2 = numpy.concatenate(x2), numpy.concatenate(y2)
+
+        # Horizontal edges can never be crossed by a horizontal ray
+        keep = self.edge_y1 != self.edge_y2
+        self.edge_boundaries = self.edge_boundaries[keep]
+        self.edge_x1, self.edge_y1 = self.edge_x1[keep], self.edge_y1[keep]
+        self.edge_x2, self.edge_y2 = self.edge_x2[keep], self.edge_y2[keep]
+
+        boundary_count = len(features)
+        edge_min_x = numpy.minimum(self.edge_x1, self.edge_x2)
+        edge_max_x = numpy.maximum(self.edge_x1, self.edge_x2)
+        edge_min_y = numpy.minimum(self.edge_y1, self.edge_y2)
+        edge_max_y = numpy.maximum(self.edge_y1, self.edge_y2)
+        self.min_x = numpy.full(boundary_count, numpy.inf)
+        self.min_y = numpy.full(boundary_count, numpy.inf)
+        self.max_x = numpy.full(boundary_count, -numpy.inf)
+        self.max_y = numpy.full(boundary_count, -numpy.inf)
+        numpy.minimum.at(self.min_x, self.edge_boundaries, edge_min_x)
+        numpy.minimum.at(self.min_y, self.edge_boundaries, edge_min_y)
+        numpy.maximum.at(self.max_x, self.edge_boundaries, edge_max_x)
+        numpy.maximum.at(self.max_y, self.edge_boundaries, edge_max_y)
+
+    def _build_bands(self) -> None:
+        edge_counts = numpy.bincount(self.edge_boundaries, minlength=len(self.codes))
+        self.band_counts = numpy.maximum(1, edge_counts // self.EDGES_PER_BAND)
+        self.band_offsets = numpy.concatenate(([0], numpy.cumsum(self.band_counts)))
+        self.band_heights = numpy.maximum((self.max_y - self.min_y) / self.band_counts, numpy.finfo(numpy.float64).tiny)
+
+        # Each edge is listed in every band its y-range overlaps
+        boundaries = self.edge_boundaries
+        first_band = self._band_for(boundaries, numpy.minimum(self.edge_y1, self.edge_y2))
+        last_band = self._band_for(boundaries, numpy.maximum(self.edge_y1, self.edge_y2))
+        edge_ids, bands = self._expand_ranges(first_band, last_band + 1)
+        global_bands = self.band_offsets[boundaries[edge_ids]] + bands
+
+        order = numpy.argsort(global_bands, kind='stable')
+        self.band_edges = edge_ids[order]
+        self.band_edge_offsets = numpy.concatenate((
+            [0],
+            numpy.cumsum(numpy.bincount(global_bands, minlength=self.band_offsets[-1]))
+        ))
+
+    def _build_grid(self) -> None:
+        self.grid_min_x, self.grid_min_y = self.min_x.min(), self.min_y.min()
+        self.grid_cell_width = max((self.max_x.max() - self.grid_min_x) / self.GRID_SIZE, numpy.finfo(numpy.float64).tiny)
+        self.grid_cell_height = max((self.max_y.max() - self.grid_min_y) / self.GRID_SIZE, numpy.finfo(numpy.float64).tiny)
+
+        # Each boundary is listed in every cell its bounding box overlaps
+        first_col, last_col = self._grid_col(self.min_x), self._grid_col(self.max_x)
+        first_row, last_row = self._grid_row(self.min_y), self._grid_row(self.max_y)
+        boundary_ids, cols = self._expand_ranges(first_col, last_col + 1)
+        expanded, rows = self._expand_ranges(first_row[boundary_ids], last_row[boundary_ids] + 1)
+        boundary_ids, cols = boundary_ids[expanded], cols[expanded]
+        cells = rows * self.GRID_SIZE + cols
+
+        order = numpy.argsort(cells, kind='stable')
+        self.cell_boundaries = boundary_ids[order]
+        self.cell_offsets = numpy.concatenate((
+            [0],
+            numpy.cumsum(numpy.bincount(cells, minlength=self.GRID_SIZE * self.GRID_SIZE))
+        ))
+
+    def _assign_batch(self, x: numpy.ndarray, y: numpy.ndarray) -> numpy.ndarray:
+        result = numpy.full(len(x), -1, dtype=numpy.int64)
+
+        # Level 1 - (point, candidate boundary) pairs from the grid, filtered by the boundaries' bounding boxes
+        # Points outside the grid are clamped to the nearest cell, and then removed by the bounding box check
+        valid = numpy.isfinite(x) & numpy.isfinite(y)
+        cells = self._grid_row(numpy.where(valid, y, self.grid_min_y)) * self.GRID_SIZE + self._grid_col(numpy.where(valid, x, self.grid_min_x))
+        starts = self.cell_offsets[cells]
+        ends = numpy.where(valid, self.cell_offsets[cells + 1], starts)
+        pair_points, pair_positions = self._expand_ranges(starts, ends)
+        pair_boundaries = self.cell_boundaries[pair_positions]
+
+        px, py = x[pair_points], y[pair_points]
+        in_bbox = (
+            (px >= self.min_x[pair_boundaries]) & (px <= self.max_x[pair_boundaries]) &
+            (py >= self.min_y[pair_boundaries]) & (py <= self.max_y[pair_boundaries])
+        )
+        pair_points, pair_boundaries = pair_points[in_bbox], pair_boundaries[in_bbox]
+        px, py = px[in_bbox], py[in_bbox]
+        if len(pair_points) == 0:
+            return result
+
+        # Level 2 - (pair, edge) triples from the band of the candidate boundary the point falls in
+        bands = self.band_offsets[pair_boundaries] + self._band_for(pair_boundaries, py)
+        triple_pairs, triple_positions = self._expand_ranges(self.band_edge_offsets[bands], self.band_edge_offsets[bands + 1])
+        edges = self.band_edges[triple_positions]
+        tx, ty = px[triple_pairs], py[triple_pairs]
+
+        x1, y1, x2, y2 = self.edge_x1[edges], self.edge_y1[edges], self.edge_x2[edges], self.edge_y2[edges]
+        crosses = ((y1 > ty) != (y2 > ty)) & (tx < x1 + (ty - y1) * (x2 - x1) / (y2 - y1))
+        crossings = numpy.bincount(triple_pairs, weights=crosses, minlength=len(pair_points))
+        inside = (crossings.astype(numpy.int64) % 2) == 1
+
+        # Boundaries shouldn't overlap, but if they do the first boundary (in index order) containing the point wins.
+        # Each point's pairs are in boundary order, and the last assignment to an element wins, so assign in reverse.
+        result[pair_points[inside][::-1]] = pair_boundaries[inside][::-1]
+        return result
+
+    def _grid_col(self, x: numpy.ndarray) -> numpy.ndarray:
+        return numpy.clip(((x - self.grid_min_x) / self.grid_cell_width).astype(numpy.int64), 0, self.GRID_SIZE - 1)
+
+    def _grid_row(self, y: numpy.ndarray) -> numpy.ndarray:
+        return numpy.clip(((y - self.grid_min_y) / self.grid_cell_height).astype(numpy.int64), 0, self.GRID_SIZE - 1)
+
+    def _band_for(self, boundaries: numpy.ndarray, y: numpy.ndarray) -> numpy.ndarray:
+        bands = ((y - self.min_y[boundaries]) / self.band_heights[boundaries]).astype(numpy.int64)
+        return numpy.clip(bands, 0, self.band_counts[boundaries] - 1)
+
+    # Given arrays of [start, end) ranges, returns the index of the range and the value for every value in every range
+    @staticmethod
+    def _expand_ranges(starts: numpy.ndarray, ends: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        counts = numpy.maximum(ends - starts, 0)
+        range_ids = numpy.repeat(numpy.arange(len(starts)), counts)
+        range_firsts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        values = starts[range_ids] + (numpy.arange(len(range_ids)) - range_firsts)
+        return range_ids, values
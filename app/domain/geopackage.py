@@ -0,0 +1,78 @@
+import numpy
+import sqlite3
+import struct
+from typing import List, Optional, Tuple
+
+# Minimal reader for polygon layers in a GeoPackage (https://www.geopackage.org/spec/), which is a SQLite database
+# storing each geometry as a small GeoPackage header followed by standard WKB. This lets us read the constituency
+# boundaries without PostGIS / GDAL.
+
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+
+# Size in bytes of the optional envelope in the GeoPackage geometry header, indexed by the envelope contents indicator
+GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+# Returns the srs_id of the layer, and a (code, rings) tuple for each feature - where rings is a list of Nx2 arrays of
+# x/y co-ordinates. The outer rings and holes of every polygon in a feature are all included in rings.
+def read_geopackage_polygons(
+    file_path: str,
+    code_column: str,
+    table_name: Optional[str] = None
+) -> Tuple[int, List[Tuple[str, List[numpy.ndarray]]]]:
+    connection = sqlite3.connect(file_path)
+    try:
+        cursor = connection.cursor()
+        if table_name is None:
+            cursor.execute("SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns LIMIT 1")
+        else:
+            cursor.execute("SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns WHERE table_name = ?", (table_name,))
+        table_name, geometry_column, srs_id = cursor.fetchone()
+
+        cursor.execute(f'SELECT "{code_column}", "{geometry_column}" FROM "{table_name}"')
+        features = [(code, parse_gpkg_geometry(blob)) for code, blob in cursor.fetchall() if blob is not None]
+    finally:
+        connection.close()
+
+    return srs_id, features
+
+def parse_gpkg_geometry(blob: bytes) -> List[numpy.ndarray]:
+    if blob[0:2] != b'GP':
+        raise ValueError('Not a GeoPackage geometry blob')
+
+    flags = blob[3]
+    envelope_size = GPKG_ENVELOPE_SIZES[(flags >> 1) & 0b111]
+    return parse_wkb_polygons(blob, 8 + envelope_size)[0]
+
+# Parses a WKB Polygon or MultiPolygon starting at offset, returning its rings and the offset after the geometry
+def parse_wkb_polygons(wkb: bytes, offset: int = 0) -> Tuple[List[numpy.ndarray], int]:
+    byte_order = '<' if wkb[offset] == 1 else '>'
+    (geometry_type,) = struct.unpack_from(f"{byte_order}I", wkb, offset + 1)
+    offset += 5
+
+    # ISO WKB adds 1000 for Z, 2000 for M, and 3000 for ZM co-ordinates
+    base_type = geometry_type % 1000
+    dimensions = {0: 2, 1: 3, 2: 3, 3: 4}[geometry_type // 1000]
+
+    if base_type == WKB_MULTIPOLYGON:
+        (polygon_count,) = struct.unpack_from(f"{byte_order}I", wkb, offset)
+        offset += 4
+        rings = []
+        for _ in range(polygon_count):
+            polygon_rings, offset = parse_wkb_polygons(wkb, offset)
+            rings.extend(polygon_rings)
+        return rings, offset
+
+    if base_type != WKB_POLYGON:
+        raise ValueError(f"Unsupported WKB geometry type {geometry_type}")
+
+    (ring_count,) = struct.unpack_from(f"{byte_order}I", wkb, offset)
+    offset += 4
+    rings = []
+    for _ in range(ring_count):
+        (point_count,) = struct.unpack_from(f"{byte_order}I", wkb, offset)
+        offset += 4
+        coords = numpy.frombuffer(wkb, dtype=f"{byte_order}f8", count=point_count * dimensions, offset=offset)
+        rings.append(coords.reshape(point_count, dimensions)[:, :2].astype(numpy.float64))
+        offset += point_count * dimensions * 8
+    return rings, offset
@@ -0,0 +1,50 @@
+import csv
+from typing import Iterator, Optional, Sequence
+from app import db, metrics
+
+# Writes the postcode_to_boundary table created by the multi-layer stages of app.scripts.load_postcodes (see
+# generate_postcode_to_boundary_mappings) as a CSV with a row per (postcode, layer, boundary):
+#
+#   postcode,layer,boundary_code,proportion,source
+#   AB1 0AA,constituency,S14000001,1.0,UPRN
+#
+# Rows are ordered by postcode and layer, with each postcode's boundaries in a layer ordered by proportion, highest
+# first. Like PostcodeLookupWriter, rows are streamed from a server-side cursor, so memory use stays flat.
+class PostcodeBoundaryCsvWriter:
+    FETCH_BATCH_SIZE = 10_000
+
+    # With layers, only the given layers are written
+    def __init__(self, filename: str, layers: Optional[Sequence[str]] = None):
+        self.filename = filename
+        self.layers = list(layers) if layers else None
+
+    def generate(self, batch_size: int = FETCH_BATCH_SIZE) -> None:
+        with open(self.filename, 'w') as file:
+            writer = csv.writer(file)
+            writer.writerow(['postcode', 'layer', 'boundary_code', 'proportion', 'source'])
+
+            batch = []
+            for row in self._fetch_rows(batch_size):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    writer.writerows(batch)
+                    metrics.add_rows(rows_in=len(batch), rows_out=len(batch))
+                    batch = []
+            writer.writerows(batch)
+            metrics.add_rows(rows_in=len(batch), rows_out=len(batch))
+
+    def _fetch_rows(self, batch_size: int) -> Iterator[tuple]:
+        with db.pool().connection() as conn:
+          # Naming the cursor makes it a server-side cursor
+          with conn.cursor(name='postcode_boundary_rows') as cursor:
+              cursor.itersize = batch_size
+              cursor.execute(
+                  f"""
+                  SELECT postcode, layer, boundary_code, proportion::float, source
+                  FROM postcode_to_boundary
+                  {'WHERE layer = ANY(%s)' if self.layers else ''}
+                  ORDER BY postcode, layer, proportion DESC, boundary_code
+                  """,
+                  (self.layers,) if self.layers else None
+              )
+              yield from cursor
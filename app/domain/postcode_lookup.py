@@ -0,0 +1,197 @@
+from collections import OrderedDict
+import csv
+import io
+import os
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+from app.domain.block_compression import BLOCK_INDEX_SUFFIX, BlockCompressedReader
+from app.domain.postcodes import Postcode
+
+# Runtime API for the generated lookup files, so consumers don't each need to normalise postcodes and write their own
+# queries. Opens either the SQLite database (postcode-lookup.db) or the CSV file (postcode-lookup.csv) - which can be a
+# block-compressed CSV (eg. postcode-lookup.csv.gz with its .idx index), in which case only the blocks containing the
+# postcodes looked up are decompressed.
+#
+# Results are lists of (constituency short code, confidence) tuples, highest confidence first. Confidences are None
+# when reading a CSV generated without confidences. Invalid or unknown postcodes return an empty list.
+class PostcodeLookup:
+    CACHE_SIZE = 10_000
+    # Batched lookups query this many postcodes at a time. The last batch is padded so every query has exactly the same
+    # SQL, which lets sqlite3 re-use a single prepared statement.
+    SQLITE_BATCH_SIZE = 500
+    # The number of decompressed blocks of a block-compressed CSV kept in memory
+    BLOCK_CACHE_SIZE = 8
+
+    # With in_memory=True the whole SQLite database is read into memory up front (CSV files always are), so lookups
+    # never touch the disk
+    def __init__(self, filename: str, cache_size: int = CACHE_SIZE, in_memory: bool = False):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        self.block_reader = None
+        if os.path.exists(filename + BLOCK_INDEX_SUFFIX):
+            self.sqlite_connection = None
+            self.postcodes = None
+            self.block_reader = BlockCompressedReader(filename)
+            self.blocks = OrderedDict()
+            # The header is the first block
+            header = next(csv.reader(io.StringIO(self.block_reader.read_block(0).decode('utf-8'))))
+            self.with_confidences = 'confidence_1' in header
+        elif filename.endswith('.csv'):
+            self.sqlite_connection = None
+            self.postcodes = self._read_csv(filename)
+        else:
+            self.sqlite_connection = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+            self.postcodes = None
+            placeholders = ', '.join(['?'] * self.SQLITE_BATCH_SIZE)
+            self.batch_query = f"""
+                SELECT postcode_lookup.postcode, COALESCE(pcon.short_code, 'UNKNOWN'), postcode_lookup.confidence
+                FROM postcode_lookup
+                LEFT JOIN pcon ON postcode_lookup.pcon_id = pcon.id
+                WHERE postcode_lookup.postcode IN ({placeholders})
+                ORDER BY postcode_lookup.postcode, postcode_lookup.rank
+            """
+            self.most_likely_query = """
+                SELECT COALESCE(pcon.short_code, 'UNKNOWN')
+                FROM postcode_lookup
+                LEFT JOIN pcon ON postcode_lookup.pcon_id = pcon.id
+                WHERE postcode_lookup.postcode = ? AND postcode_lookup.rank = 1
+            """
+            if in_memory:
+                self.postcodes = self._read_sqlite()
+
+    # Uppercases the postcode and removes any whitespace, returning None if it isn't a valid postcode
+    @staticmethod
+    def normalise(postcode: str) -> Optional[str]:
+        return Postcode(str(postcode).upper()).unit_postcode(separator='')
+
+    def lookup(self, postcode: str) -> List[Tuple[str, Optional[float]]]:
+        return self._lookup_normalised([self.normalise(postcode)])[0]
+
+    # Returns the results for every given postcode, keyed by the postcode as given
+    def lookup_many(self, postcodes: Iterable[str]) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        postcodes = list(postcodes)
+        results = self._lookup_normalised([self.normalise(postcode) for postcode in postcodes])
+        return dict(zip(postcodes, results))
+
+    # Returns the constituency we're most confident of for the postcode, or None if the postcode is invalid or unknown.
+    # Cache misses against SQLite only read the top ranked row, and aren't cached.
+    def most_likely(self, postcode: str) -> Optional[str]:
+        normalised_postcode = self.normalise(postcode)
+        if normalised_postcode is None:
+            return None
+
+        if normalised_postcode in self.cache:
+            self.cache.move_to_end(normalised_postcode)
+            results = self.cache[normalised_postcode]
+        elif self.postcodes is not None:
+            results = self.postcodes.get(normalised_postcode, [])
+        elif self.block_reader is not None:
+            results = self._lookup_normalised([normalised_postcode])[0]
+        else:
+            row = self.sqlite_connection.execute(self.most_likely_query, (normalised_postcode,)).fetchone()
+            return row[0] if row else None
+
+        return results[0][0] if results else None
+
+    def close(self) -> None:
+        if self.sqlite_connection is not None:
+            self.sqlite_connection.close()
+
+    def _lookup_normalised(self, normalised_postcodes: List[Optional[str]]) -> List[List[Tuple[str, Optional[float]]]]:
+        # Serve what we can from the cache, and look up each remaining postcode once
+        found = {}
+        missing = []
+        for normalised_postcode in normalised_postcodes:
+            if normalised_postcode is None or normalised_postcode in found:
+                continue
+            if normalised_postcode in self.cache:
+                self.cache.move_to_end(normalised_postcode)
+                found[normalised_postcode] = self.cache[normalised_postcode]
+            else:
+                found[normalised_postcode] = None
+                missing.append(normalised_postcode)
+
+        for normalised_postcode, result in self._query(missing).items():
+            found[normalised_postcode] = result
+            self._cache(normalised_postcode, result)
+
+        return [[] if normalised_postcode is None else found[normalised_postcode] for normalised_postcode in normalised_postcodes]
+
+    def _query(self, normalised_postcodes: List[str]) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        if self.postcodes is not None:
+            return {postcode: self.postcodes.get(postcode, []) for postcode in normalised_postcodes}
+        if self.block_reader is not None:
+            return self._query_blocks(normalised_postcodes)
+
+        results = {postcode: [] for postcode in normalised_postcodes}
+        cursor = self.sqlite_connection.cursor()
+        for start in range(0, len(normalised_postcodes), self.SQLITE_BATCH_SIZE):
+            batch = normalised_postcodes[start:start + self.SQLITE_BATCH_SIZE]
+            batch += [None] * (self.SQLITE_BATCH_SIZE - len(batch))
+            for postcode, pcon, confidence in cursor.execute(self.batch_query, batch):
+                results[postcode].append((pcon, confidence))
+        cursor.close()
+        return results
+
+    def _cache(self, normalised_postcode: str, result: List[Tuple[str, Optional[float]]]) -> None:
+        self.cache[normalised_postcode] = result
+        self.cache.move_to_end(normalised_postcode)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _read_csv(self, filename: str) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        with open(filename, 'r') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            return self._parse_csv_rows(reader, with_confidences='confidence_1' in header)
+
+    def _parse_csv_rows(self, reader: Iterable[List[str]], with_confidences: bool) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        postcodes = {}
+        for row in reader:
+            normalised_postcode = self.normalise(row[0])
+            values = [value for value in row[1:] if value != '']
+            if with_confidences:
+                postcodes[normalised_postcode] = [(values[i], float(values[i+1])) for i in range(0, len(values), 2)]
+            else:
+                postcodes[normalised_postcode] = [(value, None) for value in values]
+        return postcodes
+
+    def _query_blocks(self, normalised_postcodes: List[str]) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        results = {}
+        for postcode in normalised_postcodes:
+            results[postcode] = []
+            # Blocks are indexed by unit postcode, with the space
+            for block_number in self.block_reader.blocks_containing(Postcode(postcode).unit_postcode()):
+                block = self._read_block(block_number)
+                if postcode in block:
+                    results[postcode] = block[postcode]
+                    break
+        return results
+
+    def _read_block(self, block_number: int) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        if block_number in self.blocks:
+            self.blocks.move_to_end(block_number)
+            return self.blocks[block_number]
+
+        data = self.block_reader.read_block(block_number).decode('utf-8')
+        block = self._parse_csv_rows(csv.reader(io.StringIO(data)), self.with_confidences)
+        self.blocks[block_number] = block
+        if len(self.blocks) > self.BLOCK_CACHE_SIZE:
+            self.blocks.popitem(last=False)
+        return block
+
+    def _read_sqlite(self) -> Dict[str, List[Tuple[str, Optional[float]]]]:
+        postcodes = {}
+        cursor = self.sqlite_connection.execute(
+            """
+            SELECT postcode_lookup.postcode, COALESCE(pcon.short_code, 'UNKNOWN'), postcode_lookup.confidence
+            FROM postcode_lookup
+            LEFT JOIN pcon ON postcode_lookup.pcon_id = pcon.id
+            ORDER BY postcode_lookup.postcode, postcode_lookup.rank
+            """
+        )
+        for postcode, pcon, confidence in cursor:
+            postcodes.setdefault(postcode, []).append((pcon, confidence))
+        cursor.close()
+        return postcodes
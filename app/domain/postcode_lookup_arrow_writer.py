@@ -0,0 +1,143 @@
+import numpy
+import pandas
+from typing import Any
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter, ScoredBatch, sort_postcode_entries
+from app.domain.postcodes import Postcode
+
+# Writes the lookup as Parquet or an Arrow IPC file, for loading into dataframes & warehouses without parsing text.
+#
+# - shape='long' has a row for each postcode to constituency mapping: postcode, rank, pcon, confidence (like the SQLite
+#   postcode_lookup table, with the constituency code in place of pcon_id)
+# - shape='wide' has a row for each postcode: postcode, pcon_1, confidence_1, pcon_2, ... (like the CSV file)
+#
+# Postcodes are normalised without whitespace and sorted, so the min/max statistics of each row group let readers skip
+# row groups by postcode area (eg. pyarrow / duckdb filters on postcode). Constituency codes are dictionary encoded, so
+# each is stored once per file and loads as a pandas Categorical.
+#
+# pyarrow is an optional dependency (`poetry install --extras arrow`), so it's only imported when this writer is used.
+WIDE_PCON_COLUMNS = 6
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError('Writing Parquet / Arrow files needs pyarrow - install it with `poetry install --extras arrow`') from error
+    return pyarrow
+
+class PostcodeLookupArrowWriter(PostcodeLookupWriter):
+    # Rows per row group (Parquet) or record batch (Arrow IPC)
+    ROW_GROUP_SIZE = 128 * 1024
+
+    def __init__(
+        self,
+        filename: str,
+        file_format: str = 'parquet',
+        shape: str = 'long',
+        write_confidences: bool = True,
+        row_group_size: int = ROW_GROUP_SIZE
+    ):
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError(f"Unknown file format {file_format}, expected 'parquet' or 'arrow'")
+        if shape not in ('long', 'wide'):
+            raise ValueError(f"Unknown shape {shape}, expected 'long' or 'wide'")
+        # Fail before reading any data if pyarrow isn't installed
+        import_pyarrow()
+
+        self.filename = filename
+        self.file_format = file_format
+        self.shape = shape
+        self.write_confidences = write_confidences
+        self.row_group_size = row_group_size
+
+    def initialize_writer(self) -> None:
+        # Rows arrive in the database's postcode order, which isn't the order of the normalised postcodes, so everything
+        # is buffered as flat arrays and sorted (with sort_postcode_entries) when the file is written
+        self.pcon_ids = {}
+        self.postcodes = []
+        self.entry_counts = []
+        self.entry_pcon_ids = []
+        self.entry_confidences = []
+
+    def write_row(self, parsed_row: dict[str, Any], confidences: dict[str, float]) -> None:
+        normalised_postcode = Postcode(parsed_row['postcode']).unit_postcode(separator='')
+        if normalised_postcode is None:
+            return
+
+        ranked_confidences = self._rank_confidences(confidences)
+        self.postcodes.append(numpy.array([normalised_postcode], dtype=object))
+        self.entry_counts.append(numpy.array([len(ranked_confidences)]))
+        self.entry_pcon_ids.append(numpy.array([self._pcon_id(pcon) for pcon, _ in ranked_confidences], dtype=numpy.int32))
+        self.entry_confidences.append(numpy.array([confidence for _, confidence in ranked_confidences], dtype=float))
+
+    def write_batch(self, batch: ScoredBatch) -> None:
+        normalised_postcodes = Postcode.unit_postcode_series(pandas.Series(batch.postcodes), separator='').to_numpy()
+        valid = pandas.notna(normalised_postcodes)
+        counts = numpy.diff(batch.offsets)
+        valid_entries = numpy.repeat(valid, counts)
+
+        pcon_indexes, pcons = pandas.factorize(batch.pcons[valid_entries])
+        pcon_ids = numpy.array([self._pcon_id(pcon) for pcon in pcons], dtype=numpy.int32)
+
+        self.postcodes.append(normalised_postcodes[valid])
+        self.entry_counts.append(counts[valid])
+        self.entry_pcon_ids.append(pcon_ids[pcon_indexes])
+        self.entry_confidences.append(batch.confidences[valid_entries])
+
+    def finalise_writer(self) -> None:
+        pyarrow = import_pyarrow()
+
+        postcodes = numpy.concatenate(self.postcodes) if self.postcodes else numpy.array([], dtype=object)
+        entry_counts = numpy.concatenate(self.entry_counts).astype(numpy.int64) if self.entry_counts else numpy.array([], dtype=numpy.int64)
+        order, entry_offsets, entry_positions = sort_postcode_entries(postcodes, entry_counts)
+        sorted_counts = entry_counts[order]
+
+        # Sorted dictionary, so the dictionary indexes order the same way as the constituency codes
+        pcon_codes = sorted(self.pcon_ids)
+        sorted_ids = numpy.empty(len(pcon_codes), dtype=numpy.int16)
+        sorted_ids[[self.pcon_ids[pcon] for pcon in pcon_codes]] = numpy.arange(len(pcon_codes))
+        entry_pcon_ids = sorted_ids[numpy.concatenate(self.entry_pcon_ids)[entry_positions]] if self.entry_pcon_ids else numpy.array([], dtype=numpy.int16)
+        entry_confidences = numpy.concatenate(self.entry_confidences)[entry_positions] if self.entry_confidences else numpy.array([], dtype=float)
+        dictionary = pyarrow.array(pcon_codes, type=pyarrow.string())
+
+        if self.shape == 'long':
+            ranks = numpy.arange(len(entry_positions)) - numpy.repeat(entry_offsets[:-1], sorted_counts) + 1
+            columns = {
+                'postcode': pyarrow.array(numpy.repeat(postcodes[order], sorted_counts), type=pyarrow.string()),
+                'rank': pyarrow.array(ranks.astype(numpy.uint8)),
+                'pcon': pyarrow.DictionaryArray.from_arrays(pyarrow.array(entry_pcon_ids), dictionary),
+            }
+            if self.write_confidences:
+                columns['confidence'] = pyarrow.array(entry_confidences)
+        else:
+            columns = {'postcode': pyarrow.array(postcodes[order], type=pyarrow.string())}
+            for i in range(max(WIDE_PCON_COLUMNS, int(sorted_counts.max(initial=0)))):
+                # Postcodes with fewer than i+1 constituencies have a null in this column
+                present = sorted_counts > i
+                positions = entry_offsets[:-1] + numpy.minimum(i, numpy.maximum(sorted_counts - 1, 0))
+                pcon_ids = entry_pcon_ids[positions] if len(entry_pcon_ids) else numpy.zeros(len(positions), dtype=numpy.int16)
+                columns[f"pcon_{i+1}"] = pyarrow.DictionaryArray.from_arrays(pyarrow.array(pcon_ids, mask=~present), dictionary)
+                if self.write_confidences:
+                    confidences = entry_confidences[positions] if len(entry_confidences) else numpy.zeros(len(positions))
+                    columns[f"confidence_{i+1}"] = pyarrow.array(confidences, mask=~present)
+
+        table = pyarrow.table(columns)
+        if self.file_format == 'parquet':
+            sorting_columns = [pyarrow.parquet.SortingColumn(0)]
+            if self.shape == 'long':
+                sorting_columns.append(pyarrow.parquet.SortingColumn(1))
+            pyarrow.parquet.write_table(
+                table,
+                self.filename,
+                row_group_size=self.row_group_size,
+                compression='zstd',
+                sorting_columns=sorting_columns,
+            )
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression='zstd')
+            with pyarrow.OSFile(self.filename, 'wb') as sink, pyarrow.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table, max_chunksize=self.row_group_size)
+
+    def _pcon_id(self, pcon: str) -> int:
+        return self.pcon_ids.setdefault(pcon, len(self.pcon_ids))
@@ -0,0 +1,77 @@
+import mmap
+import numpy
+from typing import List, Optional, Tuple
+from app.domain.postcode_lookup_binary_writer import (
+    BINARY_LOOKUP_HEADER, BINARY_LOOKUP_MAGIC, BINARY_LOOKUP_VERSION, CONFIDENCE_SCALE
+)
+from app.domain.postcodes import Postcode
+
+# Reads the file written by PostcodeLookupBinaryWriter. The file is memory mapped and the arrays are numpy views
+# directly onto the mapping, so opening the file doesn't parse or copy the data, and every process reading the same
+# file shares a single copy of it in the OS page cache. Lookups are a binary search over the sorted keys, which only
+# touches a handful of pages.
+class PostcodeLookupBinaryReader:
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as file:
+            # The mapping stays valid after the file is closed
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, key_width, postcode_count, entry_count, string_count, string_byte_count = (
+            BINARY_LOOKUP_HEADER.unpack_from(self.mmap, 0)
+        )
+        if magic != BINARY_LOOKUP_MAGIC or version != BINARY_LOOKUP_VERSION:
+            raise ValueError(f"{filename} is not a version {BINARY_LOOKUP_VERSION} binary postcode lookup file")
+
+        offset = BINARY_LOOKUP_HEADER.size
+        self.entry_offsets, offset = self._array(numpy.dtype('<u4'), postcode_count + 1, offset)
+        self.entry_pcon_ids, offset = self._array(numpy.dtype('<u2'), entry_count, offset)
+        self.entry_confidences, offset = self._array(numpy.dtype('<u2'), entry_count, offset)
+        string_offsets, offset = self._array(numpy.dtype('<u4'), string_count + 1, offset)
+        self.keys, offset = self._array(numpy.dtype(f"S{key_width}"), postcode_count, offset)
+
+        # The string table is only a few hundred constituency codes, so decode it up front
+        string_bytes = self.mmap[offset:offset + string_byte_count]
+        self.strings = [
+            string_bytes[string_offsets[i]:string_offsets[i+1]].decode('utf-8') for i in range(string_count)
+        ]
+
+    # Returns the constituencies for the postcode with their confidences, highest confidence first. Returns an empty
+    # list if the postcode is invalid or unknown.
+    def lookup(self, postcode: str) -> List[Tuple[str, float]]:
+        position = self._find(postcode)
+        if position is None:
+            return []
+
+        start, end = self.entry_offsets[position], self.entry_offsets[position + 1]
+        return [
+            (self.strings[pcon_id], confidence / CONFIDENCE_SCALE)
+            for pcon_id, confidence in zip(self.entry_pcon_ids[start:end].tolist(), self.entry_confidences[start:end].tolist())
+        ]
+
+    # Returns the constituency we're most confident of for the postcode, or None if the postcode is invalid or unknown
+    def most_likely(self, postcode: str) -> Optional[str]:
+        position = self._find(postcode)
+        # Postcodes without any constituencies have no entries - the entry at their offset is the next postcode's
+        if position is None or self.entry_offsets[position] == self.entry_offsets[position + 1]:
+            return None
+
+        return self.strings[self.entry_pcon_ids[self.entry_offsets[position]]]
+
+    def close(self) -> None:
+        # Drop the numpy views first, as the mapping can't be closed while they reference it
+        self.entry_offsets = self.entry_pcon_ids = self.entry_confidences = self.keys = None
+        self.mmap.close()
+
+    def _find(self, postcode: str) -> Optional[int]:
+        normalised_postcode = Postcode(str(postcode).upper()).unit_postcode(separator='')
+        if normalised_postcode is None:
+            return None
+
+        key = normalised_postcode.encode('ascii')
+        position = int(numpy.searchsorted(self.keys, key))
+        if position >= len(self.keys) or self.keys[position] != key:
+            return None
+        return position
+
+    def _array(self, dtype: numpy.dtype, count: int, offset: int) -> Tuple[numpy.ndarray, int]:
+        return numpy.frombuffer(self.mmap, dtype=dtype, count=count, offset=offset), offset + dtype.itemsize * count
@@ -0,0 +1,85 @@
+from array import array
+import numpy
+import pandas
+import struct
+from typing import Any
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter, ScoredBatch, sort_postcode_entries
+from app.domain.postcodes import Postcode
+
+# Binary lookup file format. Everything is little-endian, and every section is 4-byte aligned except the final two,
+# so the file can be memory mapped and used directly (see PostcodeLookupBinaryReader):
+#
+# - Header: BINARY_LOOKUP_HEADER - magic, version, key width, postcode count, entry count, string count, string bytes
+# - Entry offsets: (postcode count + 1) x uint32 - the entries for postcode i are entries[offsets[i]:offsets[i+1]]
+# - Entry pcon ids: entry count x uint16 - index into the string table, ordered by confidence (highest first)
+# - Entry confidences: entry count x uint16 - the confidence (0.0 - 1.0) multiplied by CONFIDENCE_SCALE
+# - String offsets: (string count + 1) x uint32 - string i is string_bytes[offsets[i]:offsets[i+1]]
+# - Keys: postcode count x KEY_WIDTH bytes - normalised postcodes without whitespace, null padded, in sorted order
+# - String bytes: the UTF-8 encoded constituency codes
+BINARY_LOOKUP_MAGIC = b'PCLOOKUP'
+BINARY_LOOKUP_VERSION = 1
+BINARY_LOOKUP_HEADER = struct.Struct('<8s6I')
+KEY_WIDTH = 7
+CONFIDENCE_SCALE = 65535
+
+class PostcodeLookupBinaryWriter(PostcodeLookupWriter):
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    def initialize_writer(self) -> None:
+        # Rows arrive in the database's postcode order, which isn't the byte order of the normalised keys, so everything
+        # is collected in compact arrays and sorted (with sort_postcode_entries) when the writer is finalised
+        self.keys = bytearray()
+        self.entry_counts = array('I')
+        self.entry_pcon_ids = array('H')
+        self.entry_confidences = array('H')
+        self.pcon_ids = {}
+
+    def write_row(self, parsed_row: dict[str, Any], confidences: dict[str, float]) -> None:
+        normalised_postcode = Postcode(parsed_row['postcode']).unit_postcode(separator='')
+        if normalised_postcode is None:
+            return
+
+        self.keys += normalised_postcode.encode('ascii').ljust(KEY_WIDTH, b'\0')
+        ranked_confidences = self._rank_confidences(confidences)
+        self.entry_counts.append(len(ranked_confidences))
+        for pcon, confidence in ranked_confidences:
+            self.entry_pcon_ids.append(self.pcon_ids.setdefault(pcon, len(self.pcon_ids)))
+            self.entry_confidences.append(round(min(max(confidence, 0.0), 1.0) * CONFIDENCE_SCALE))
+
+    def write_batch(self, batch: ScoredBatch) -> None:
+        normalised_postcodes = Postcode.unit_postcode_series(pandas.Series(batch.postcodes), separator='')
+        valid = normalised_postcodes.notna().to_numpy()
+        counts = numpy.diff(batch.offsets)
+        valid_entries = numpy.repeat(valid, counts)
+
+        self.keys += normalised_postcodes[valid].to_numpy().astype(f"S{KEY_WIDTH}").tobytes()
+        self.entry_counts.extend(counts[valid].tolist())
+        self.entry_pcon_ids.extend(
+            [self.pcon_ids.setdefault(pcon, len(self.pcon_ids)) for pcon in batch.pcons[valid_entries].tolist()]
+        )
+        self.entry_confidences.extend(
+            numpy.round(numpy.clip(batch.confidences[valid_entries], 0.0, 1.0) * CONFIDENCE_SCALE).astype(int).tolist()
+        )
+
+    def finalise_writer(self) -> None:
+        keys = numpy.frombuffer(self.keys, dtype=f"S{KEY_WIDTH}")
+        entry_counts = numpy.frombuffer(self.entry_counts, dtype=numpy.uint32).astype(numpy.int64)
+        order, entry_offsets, entry_positions = sort_postcode_entries(keys, entry_counts)
+        entry_offsets = entry_offsets.astype(numpy.uint32)
+
+        strings = [pcon.encode('utf-8') for pcon in sorted(self.pcon_ids, key=self.pcon_ids.get)]
+        string_offsets = numpy.concatenate(([0], numpy.cumsum([len(s) for s in strings]))).astype(numpy.uint32)
+        string_bytes = b''.join(strings)
+
+        with open(self.filename, 'wb') as file:
+            file.write(BINARY_LOOKUP_HEADER.pack(
+                BINARY_LOOKUP_MAGIC, BINARY_LOOKUP_VERSION, KEY_WIDTH,
+                len(keys), len(entry_positions), len(strings), len(string_bytes)
+            ))
+            file.write(entry_offsets.astype('<u4').tobytes())
+            file.write(numpy.frombuffer(self.entry_pcon_ids, dtype=numpy.uint16)[entry_positions].astype('<u2').tobytes())
+            file.write(numpy.frombuffer(self.entry_confidences, dtype=numpy.uint16)[entry_positions].astype('<u2').tobytes())
+            file.write(string_offsets.astype('<u4').tobytes())
+            file.write(keys[order].tobytes())
+            file.write(string_bytes)
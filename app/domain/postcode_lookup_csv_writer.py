@@ -1,14 +1,30 @@
 import csv
-from typing import Any
-from app.domain.postcode_lookup_writer import PostcodeLookupWriter
+import io
+import pandas
+from typing import Any, Optional
+from app.domain.block_compression import BlockCompressedWriter
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter, ScoredBatch
+from app.domain.postcodes import Postcode
 
 class PostcodeLookupCsvWriter(PostcodeLookupWriter):
-    def __init__(self, filename: str, write_confidences: bool):
+    # With block_compression ('gzip' or 'zstd') the file is written as independently compressed blocks of (at least)
+    # this many rows, with an index of the postcodes in each block - see app.domain.block_compression. The header is a
+    # block of its own, so every other block is just rows.
+    BLOCK_ROWS = 10_000
+
+    def __init__(self, filename: str, write_confidences: bool, block_compression: Optional[str] = None, block_rows: int = BLOCK_ROWS):
         self.filename = filename
         self.write_confidences = write_confidences
+        self.block_compression = block_compression
+        self.block_rows = block_rows
 
     def initialize_writer(self) -> None:
-        self.file = open(self.filename, 'w')
+        if self.block_compression is None:
+            self.file = open(self.filename, 'w')
+        else:
+            self.block_writer = BlockCompressedWriter(self.filename, self.block_compression)
+            self.block_postcodes = []
+            self.file = io.StringIO()
         self.writer = csv.writer(self.file)
 
         csv_header = ['postcode']
@@ -18,15 +34,57 @@ class PostcodeLookupCsvWriter(PostcodeLookupWriter):
                 csv_header.append(f"confidence_{i+1}")
 
         self.writer.writerow(csv_header)
+        if self.block_compression is not None:
+            self._write_block()
 
     def write_row(self, parsed_row: dict[str, Any], confidences: dict[str, float]) -> None:
         csv_row = [parsed_row['postcode']]
-        for pcon, confidence in sorted(confidences.items(), key=lambda x: (-x[1])):
+        for pcon, confidence in self._rank_confidences(confidences):
             csv_row.append(pcon)
             if self.write_confidences:
                 csv_row.append(confidence)
     
         self.writer.writerow(csv_row)
+        if self.block_compression is not None:
+            self.block_postcodes.append(parsed_row['postcode'])
+            if len(self.block_postcodes) >= self.block_rows:
+                self._write_block()
+
+    def write_batch(self, batch: ScoredBatch) -> None:
+        # The batch is already ranked, so each row is just the postcode followed by its slice of the flat arrays
+        pcons = batch.pcons.tolist()
+        confidences = batch.confidences.tolist()
+        offsets = batch.offsets.tolist()
+        csv_rows = []
+        for i, postcode in enumerate(batch.postcodes.tolist()):
+            csv_row = [postcode]
+            for j in range(offsets[i], offsets[i+1]):
+                csv_row.append(pcons[j])
+                if self.write_confidences:
+                    csv_row.append(confidences[j])
+            csv_rows.append(csv_row)
+
+        self.writer.writerows(csv_rows)
+        if self.block_compression is not None:
+            self.block_postcodes.extend(batch.postcodes.tolist())
+            if len(self.block_postcodes) >= self.block_rows:
+                self._write_block()
 
     def finalise_writer(self) -> None:
-        self.file.close()
+        if self.block_compression is None:
+            self.file.close()
+            return
+
+        if self.block_postcodes:
+            self._write_block()
+        self.block_writer.close()
+
+    # Hands the rows written since the last block to the block writer, keyed by their unit postcodes. The keys keep the
+    # space, so each outcode's postcodes form a contiguous range ('AB1 0AA' < 'AB1 9ZZ' < 'AB10 0AA') as they do in the
+    # file, whereas without it they would interleave ('AB10AA' < 'AB100AA' < 'AB19ZZ').
+    def _write_block(self) -> None:
+        keys = Postcode.unit_postcode_series(pandas.Series(self.block_postcodes, dtype=object)).tolist()
+        self.block_writer.write_block(self.file.getvalue().encode('utf-8'), keys=keys, rows=len(self.block_postcodes))
+        self.file.seek(0)
+        self.file.truncate()
+        self.block_postcodes = []
@@ -0,0 +1,102 @@
+from queue import Queue
+import threading
+from typing import Any, List, Optional
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter, ScoredBatch
+
+# Runs a single sink on its own thread, fed scored batches through a bounded queue. Once the sink has failed, the rest
+# of its batches are drained and discarded, so the producer never blocks on a queue nobody is reading.
+class _SinkThread:
+    def __init__(self, writer: PostcodeLookupWriter, queue_size: int):
+        self.writer = writer
+        self.queue = Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=f"{type(writer).__name__}-sink", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def put(self, batch: Optional[ScoredBatch]) -> None:
+        self.queue.put(batch)
+
+    def join(self) -> None:
+        self.thread.join()
+
+    def _run(self) -> None:
+        try:
+            self.writer.initialize_writer()
+            while (batch := self.queue.get()) is not None:
+                self.writer.write_batch(batch)
+            self.writer.finalise_writer()
+        except BaseException as error:
+            self.error = error
+            while self.queue.get() is not None:
+                pass
+
+# Reads and scores combined_postcode_to_constituency_multicol once, and streams every scored batch to any number of
+# writers - so generating all the output files costs one database scan and one scoring pass, rather than one per file.
+#
+# With threaded=True each writer runs on its own thread behind a queue of at most queue_size batches, so the total time
+# is set by the slowest writer rather than the sum of them all (the writers spend much of their time in C code which
+# releases the GIL - sqlite3, file I/O & compression), and a slow writer only holds back the others once its queue is
+# full. Batches are shared between the writers, so writers mustn't modify them.
+class PostcodeLookupFanoutWriter(PostcodeLookupWriter):
+    QUEUE_SIZE = 8
+
+    def __init__(self, writers: List[PostcodeLookupWriter], threaded: bool = True, queue_size: int = QUEUE_SIZE):
+        self.writers = writers
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.sinks = []
+
+    def initialize_writer(self) -> None:
+        if not self.threaded:
+            for writer in self.writers:
+                writer.initialize_writer()
+            return
+
+        self.sinks = [_SinkThread(writer, self.queue_size) for writer in self.writers]
+        for sink in self.sinks:
+            sink.start()
+
+    def write_batch(self, batch: ScoredBatch) -> None:
+        if not self.threaded:
+            for writer in self.writers:
+                try:
+                    writer.write_batch(batch)
+                except Exception as error:
+                    raise RuntimeError(f"{type(writer).__name__} failed") from error
+            return
+
+        # A sink which has failed stops the run - but the other sinks are stopped first, so no thread is left waiting
+        # for batches which will never come
+        failed_sinks = [sink for sink in self.sinks if sink.error is not None]
+        if failed_sinks:
+            self._stop_sinks()
+            self._raise_sink_error(failed_sinks[0])
+
+        for sink in self.sinks:
+            sink.put(batch)
+
+    def write_row(self, parsed_row: dict[str, Any], confidences: dict[str, float]) -> None:
+        for writer in self.writers:
+            writer.write_row(parsed_row, confidences)
+
+    def finalise_writer(self) -> None:
+        if not self.threaded:
+            for writer in self.writers:
+                writer.finalise_writer()
+            return
+
+        self._stop_sinks()
+        for sink in self.sinks:
+            self._raise_sink_error(sink)
+
+    def _stop_sinks(self) -> None:
+        for sink in self.sinks:
+            sink.put(None)
+        for sink in self.sinks:
+            sink.join()
+
+    def _raise_sink_error(self, sink: _SinkThread) -> None:
+        if sink.error is not None:
+            raise RuntimeError(f"{type(sink.writer).__name__} failed") from sink.error
@@ -0,0 +1,189 @@
+from collections import defaultdict
+import json
+import numpy
+import os
+import pandas
+import pickle
+import shutil
+import tempfile
+from typing import Any, List, NamedTuple
+from app.domain.postcode_lookup_binary_writer import PostcodeLookupBinaryWriter
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter, ScoredBatch, sort_postcode_entries
+from app.domain.postcodes import Postcode
+
+# Writes the lookup as a directory of small shards - one per postcode outcode (eg. 'AB10', a few KB each) or area (eg.
+# 'AB') - plus a manifest.json listing them, so a browser or edge worker can fetch and cache just the shard for the
+# postcode being looked up. Shards are either:
+#
+# - json: {"AB101QJ": [["S14000001", 0.9876], ...], ...} - normalised postcodes (no whitespace) to their
+#   constituencies, highest confidence first, with confidences rounded to CONFIDENCE_DECIMAL_PLACES
+# - binary: the PostcodeLookupBinaryWriter format, so each shard can be read with PostcodeLookupBinaryReader
+#
+# The database's postcode order groups most postcodes by shard, but not all - its collation ignores the space, so eg.
+# 'AB1 0AA' sorts after 'AB10 1AA' - so a shard can't be written as soon as the next one starts. Instead rows are
+# buffered by shard, and whenever more than MAX_BUFFERED_POSTCODES are buffered every buffer is appended to its shard's
+# staging file. Each shard is then written from its staging file when the writer is finalised, so memory use is
+# bounded by the buffer and the largest single shard rather than the whole lookup. Everything is kept as flat arrays (like
+# ScoredBatch) rather than a python object per postcode.
+CONFIDENCE_DECIMAL_PLACES = 4
+MANIFEST_FILE = 'manifest.json'
+
+# Part of a shard, as flat arrays: the pcons & confidences for postcodes[i] are the next counts[i] entries, ranked
+class ShardPiece(NamedTuple):
+    postcodes: numpy.ndarray
+    counts: numpy.ndarray
+    pcons: numpy.ndarray
+    confidences: numpy.ndarray
+
+class PostcodeLookupShardedWriter(PostcodeLookupWriter):
+    MAX_BUFFERED_POSTCODES = 200_000
+
+    def __init__(self, directory: str, shard_by: str = 'outcode', encoding: str = 'json'):
+        if shard_by not in ('outcode', 'postcode_area'):
+            raise ValueError(f"Unknown shard_by {shard_by}, expected 'outcode' or 'postcode_area'")
+        if encoding not in ('json', 'binary'):
+            raise ValueError(f"Unknown encoding {encoding}, expected 'json' or 'binary'")
+
+        self.directory = directory
+        self.shard_by = shard_by
+        self.encoding = encoding
+
+    def initialize_writer(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._remove_previous_shards()
+        self.staging_directory = tempfile.mkdtemp(prefix='.staging-', dir=self.directory)
+        self.buffers = defaultdict(list)
+        self.buffered_postcodes = 0
+        self.staged_shards = set()
+
+    def write_row(self, parsed_row: dict[str, Any], confidences: dict[str, float]) -> None:
+        postcode = Postcode(parsed_row['postcode'])
+        if not postcode.valid():
+            return
+
+        ranked_confidences = self._rank_confidences(confidences)
+        shard = postcode.outcode() if self.shard_by == 'outcode' else postcode.postcode_area()
+        self._buffer(shard, ShardPiece(
+            postcodes=numpy.array([postcode.unit_postcode(separator='')], dtype=object),
+            counts=numpy.array([len(ranked_confidences)], dtype=numpy.int64),
+            pcons=numpy.array([pcon for pcon, _ in ranked_confidences], dtype=object),
+            confidences=numpy.array([confidence for _, confidence in ranked_confidences], dtype=float),
+        ))
+
+    # Splits the batch into a piece per shard, each piece holding a contiguous run of the batch's flat arrays
+    def write_batch(self, batch: ScoredBatch) -> None:
+        parts = Postcode.parse_many(batch.postcodes, separator='')
+        valid = parts['unit_postcode'].notna().to_numpy()
+        shard_indexes, shards = pandas.factorize(parts[self.shard_by].to_numpy()[valid])
+        order = numpy.argsort(shard_indexes, kind='stable')
+        counts = numpy.diff(batch.offsets)[valid][order]
+        entry_offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+        # The position of each (reordered) entry in the batch's entry arrays
+        entry_starts = batch.offsets[:-1][valid][order]
+        entry_positions = numpy.repeat(entry_starts - entry_offsets[:-1], counts) + numpy.arange(entry_offsets[-1])
+
+        postcodes = parts['unit_postcode'].to_numpy()[valid][order]
+        pcons = batch.pcons[entry_positions]
+        confidences = batch.confidences[entry_positions]
+        shard_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(shard_indexes, minlength=len(shards)))))
+        for i, shard in enumerate(shards):
+            start, end = shard_offsets[i], shard_offsets[i+1]
+            self._buffer(shard, ShardPiece(
+                postcodes=postcodes[start:end],
+                counts=counts[start:end],
+                pcons=pcons[entry_offsets[start]:entry_offsets[end]],
+                confidences=confidences[entry_offsets[start]:entry_offsets[end]],
+            ))
+
+    def finalise_writer(self) -> None:
+        shards = {}
+        for shard in sorted(self.staged_shards | set(self.buffers)):
+            pieces = self._read_staged_pieces(shard) + self.buffers.pop(shard, [])
+            file_name = f"{shard}.{'json' if self.encoding == 'json' else 'bin'}"
+            postcode_count = self._write_shard(os.path.join(self.directory, file_name), pieces)
+            shards[shard] = {
+                'file': file_name,
+                'postcodes': postcode_count,
+                'bytes': os.path.getsize(os.path.join(self.directory, file_name)),
+            }
+
+        shutil.rmtree(self.staging_directory)
+        with open(os.path.join(self.directory, MANIFEST_FILE), 'w') as file:
+            json.dump({
+                'shard_by': self.shard_by,
+                'encoding': self.encoding,
+                'postcodes': sum(shard['postcodes'] for shard in shards.values()),
+                'shards': shards,
+            }, file, indent=1)
+
+    def _buffer(self, shard: str, piece: ShardPiece) -> None:
+        self.buffers[shard].append(piece)
+        self.buffered_postcodes += len(piece.postcodes)
+        if self.buffered_postcodes >= self.MAX_BUFFERED_POSTCODES:
+            self._stage_buffers()
+
+    # Appends every shard's buffered pieces to its staging file, as a sequence of pickles
+    def _stage_buffers(self) -> None:
+        for shard, pieces in self.buffers.items():
+            with open(os.path.join(self.staging_directory, shard), 'ab') as file:
+                for piece in pieces:
+                    pickle.dump(tuple(piece), file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.staged_shards.add(shard)
+
+        self.buffers = defaultdict(list)
+        self.buffered_postcodes = 0
+
+    def _read_staged_pieces(self, shard: str) -> List[ShardPiece]:
+        if shard not in self.staged_shards:
+            return []
+
+        pieces = []
+        with open(os.path.join(self.staging_directory, shard), 'rb') as file:
+            while True:
+                try:
+                    pieces.append(ShardPiece(*pickle.load(file)))
+                except EOFError:
+                    return pieces
+
+    # Writes the shard's postcodes in sorted order, returning the number of postcodes
+    def _write_shard(self, file_path: str, pieces: List[ShardPiece]) -> int:
+        postcodes = numpy.concatenate([piece.postcodes for piece in pieces])
+        counts = numpy.concatenate([piece.counts for piece in pieces])
+        order, offsets, entry_positions = sort_postcode_entries(postcodes, counts)
+        pcons = numpy.concatenate([piece.pcons for piece in pieces])[entry_positions]
+        confidences = numpy.concatenate([piece.confidences for piece in pieces])[entry_positions]
+
+        if self.encoding == 'json':
+            entries = list(zip(pcons.tolist(), numpy.round(confidences, CONFIDENCE_DECIMAL_PLACES).tolist()))
+            offsets = offsets.tolist()
+            # json.dumps rather than json.dump, which always uses the (much slower) pure python encoder
+            with open(file_path, 'w') as file:
+                file.write(json.dumps(
+                    {postcode: entries[offsets[i]:offsets[i+1]] for i, postcode in enumerate(postcodes[order].tolist())},
+                    separators=(',', ':')
+                ))
+        else:
+            # The pieces are already scored & ranked, so the shard is written as a single scored batch
+            writer = PostcodeLookupBinaryWriter(file_path)
+            writer.initialize_writer()
+            writer.write_batch(ScoredBatch(rows=[], postcodes=postcodes[order], offsets=offsets, pcons=pcons, confidences=confidences))
+            writer.finalise_writer()
+
+        return len(postcodes)
+
+    # Removes the shards listed in a previous run's manifest (and any staging files from an interrupted run), so shards
+    # which no longer exist don't linger in the directory
+    def _remove_previous_shards(self) -> None:
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                manifest = json.load(file)
+            for shard in manifest['shards'].values():
+                shard_path = os.path.join(self.directory, shard['file'])
+                if os.path.exists(shard_path):
+                    os.remove(shard_path)
+            os.remove(manifest_path)
+
+        for entry in os.listdir(self.directory):
+            if entry.startswith('.staging-'):
+                shutil.rmtree(os.path.join(self.directory, entry))
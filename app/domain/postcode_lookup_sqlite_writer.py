@@ -1,11 +1,16 @@
+import numpy
+import pandas
 import re
 import sqlite3
+from app import db
 from app.domain.postcodes import Postcode
-import psycopg
 from typing import Any, Dict, List
-from app.domain.postcode_lookup_writer import PostcodeLookupWriter
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter, ScoredBatch
 
 class PostcodeLookupSqliteWriter(PostcodeLookupWriter):
+    # Rows are buffered and inserted with executemany in batches of this size
+    INSERT_BATCH_SIZE = 50_000
+
     def __init__(self, filename: str):
         self.filename = filename
 
@@ -13,6 +18,13 @@ class PostcodeLookupSqliteWriter(PostcodeLookupWriter):
         self.sqlite_connection = sqlite3.connect(self.filename)
         self.sqlite_cursor = self.sqlite_connection.cursor()
 
+        # Bulk-load pragmas - the file is written from scratch in one go, so if generation fails part way through it's
+        # simply generated again, and we don't need a rollback journal or to sync to disk after every write
+        self.sqlite_cursor.execute("PRAGMA journal_mode = OFF")
+        self.sqlite_cursor.execute("PRAGMA synchronous = OFF")
+        self.sqlite_cursor.execute("PRAGMA locking_mode = EXCLUSIVE")
+        self.sqlite_cursor.execute("PRAGMA cache_size = -262144") # 256MB
+
         # Create pcon lookup table
         self.sqlite_cursor.execute(
             """
@@ -24,49 +36,111 @@ class PostcodeLookupSqliteWriter(PostcodeLookupWriter):
             )
             """
         )
-        for pcon in self._get_pcon_data():
-            self.sqlite_cursor.execute(
-                """
-                INSERT INTO pcon (short_code, name, slug)
-                VALUES (?, ?, ?)
-                """,
-                (pcon['short_code'], pcon['name'], pcon['slug'])
-            )
-
+        pcons = self._get_pcon_data()
+        self.sqlite_cursor.executemany(
+            """
+            INSERT INTO pcon (id, short_code, name, slug)
+            VALUES (?, ?, ?, ?)
+            """,
+            [(i+1, pcon['short_code'], pcon['name'], pcon['slug']) for i, pcon in enumerate(pcons)]
+        )
+        self.pcon_ids = {pcon['short_code']: i+1 for i, pcon in enumerate(pcons)}
 
+        # Rows are loaded into an un-indexed staging table first, and copied into the final table in postcode order
+        # once everything is loaded - so the final table is built in a single ordered pass. The staging table is an
+        # ordinary table in the output file (dropped before the VACUUM), rather than a temporary table which could be
+        # held in memory, so memory use stays flat however many postcodes there are.
         self.sqlite_cursor.execute(
             """
-            CREATE TABLE postcode_lookup(
+            CREATE TABLE postcode_lookup_staging(
                 postcode TEXT,
-                pcon_id TEXT,
+                rank INTEGER,
+                pcon_id INTEGER,
                 confidence FLOAT
             )
             """
         )
-        self.sqlite_cursor.execute("CREATE INDEX idx_postcode_lookup_on_postcode ON postcode_lookup(postcode)")
-        self.sqlite_connection.commit()
+        self.rows = []
 
     def write_row(self, parsed_row: dict[str, Any], confidences: dict[str, float]) -> None:
-        for pcon, confidence in confidences.items():
-            normalised_postcode = Postcode(parsed_row['postcode']).unit_postcode(separator='')
-            self.sqlite_cursor.execute(
-                """
-                INSERT INTO postcode_lookup
-                (postcode, pcon_id, confidence)
-                VALUES
-                (?, (SELECT id FROM pcon WHERE short_code = ?), ?)
-                """,
-                (normalised_postcode, pcon, confidence)
-            )
+        normalised_postcode = Postcode(parsed_row['postcode']).unit_postcode(separator='')
+        # Postcodes which don't normalise can't be looked up, and can't be part of the primary key, so are skipped
+        if normalised_postcode is None:
+            return
+
+        ranked_confidences = self._rank_confidences(confidences)
+        for i, (pcon, confidence) in enumerate(ranked_confidences):
+            # Constituencies we don't know (eg. 'UNKNOWN') have a NULL pcon_id
+            self.rows.append((normalised_postcode, i+1, self.pcon_ids.get(pcon), confidence))
+
+        if len(self.rows) >= self.INSERT_BATCH_SIZE:
+            self._flush_rows()
+
+    def write_batch(self, batch: ScoredBatch) -> None:
+        normalised_postcodes = Postcode.unit_postcode_series(pandas.Series(batch.postcodes), separator='').to_numpy()
+        counts = numpy.diff(batch.offsets)
+        ranks = numpy.arange(len(batch.pcons)) - numpy.repeat(batch.offsets[:-1], counts) + 1
+        postcodes = numpy.repeat(normalised_postcodes, counts)
+        # As in write_row, postcodes which don't normalise are skipped
+        valid = postcodes != None
+        self.rows.extend(zip(
+            postcodes[valid].tolist(),
+            ranks[valid].tolist(),
+            [self.pcon_ids.get(pcon) for pcon in batch.pcons[valid].tolist()],
+            batch.confidences[valid].tolist(),
+        ))
+
+        if len(self.rows) >= self.INSERT_BATCH_SIZE:
+            self._flush_rows()
 
     def finalise_writer(self) -> None:
+        self._flush_rows()
+
+        # The table is clustered on postcode (a WITHOUT ROWID table is stored as a b-tree on its primary key), so all
+        # the rows for a postcode are on the same page. The rank orders a postcode's constituencies by confidence.
+        self.sqlite_cursor.execute(
+            """
+            CREATE TABLE postcode_lookup(
+                postcode TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                pcon_id INTEGER,
+                confidence FLOAT,
+                PRIMARY KEY (postcode, rank)
+            ) WITHOUT ROWID
+            """
+        )
+        self.sqlite_cursor.execute(
+            """
+            INSERT INTO postcode_lookup (postcode, rank, pcon_id, confidence)
+            SELECT postcode, rank, pcon_id, confidence
+            FROM postcode_lookup_staging
+            ORDER BY postcode, rank
+            """
+        )
+        self.sqlite_cursor.execute("DROP TABLE postcode_lookup_staging")
         self.sqlite_connection.commit()
+
+        self.sqlite_cursor.execute("ANALYZE")
+        self.sqlite_cursor.execute("VACUUM")
         self.sqlite_cursor.close()
+        self.sqlite_connection.close()
+
+    def _flush_rows(self) -> None:
+        self.sqlite_cursor.executemany(
+            """
+            INSERT INTO postcode_lookup_staging
+            (postcode, rank, pcon_id, confidence)
+            VALUES
+            (?, ?, ?, ?)
+            """,
+            self.rows
+        )
+        self.rows = []
 
     def _get_pcon_data(self) -> List[Dict]:
-        with psycopg.connect('user=local password=password host=localhost port=54321 dbname=gis') as conn:
+        with db.pool().connection() as conn:
           with conn.cursor() as cursor:
-              cursor.execute("SELECT short_code, name FROM parl_constituencies_2025")
+              cursor.execute("SELECT short_code, name FROM parl_constituencies_2025 ORDER BY short_code")
               return [
                   {'short_code': row[0], 'name': row[1], 'slug': self._pcon_name_to_slug(row[1])}
                   for row in cursor.fetchall()
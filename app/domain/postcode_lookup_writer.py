@@ -1,12 +1,72 @@
-import psycopg
-from typing import Any
+import numpy
+import pandas
+from typing import Any, Iterator, List, NamedTuple, Tuple
+from app import db, metrics
+
+# The postcode -> constituency columns of a combined_postcode_to_constituency_multicol row, with the weight each
+# source's confidence is given (see PostcodeLookupWriter._calculate_confidences) and the source the column belongs to
+PCON_COLUMNS = numpy.array([1, 3, 5, 7, 9, 11, 13])
+CONFIDENCE_COLUMNS = PCON_COLUMNS + 1
+SOURCE_WEIGHTS = numpy.array([0.50, 0.50, 0.50, 0.50, 0.50, 0.25, 0.25])
+SOURCES = numpy.array([0, 0, 0, 0, 0, 1, 2]) # 0 - UPRN, 1 - ONSPD, 2 - mySociety
+
+# A batch of postcodes with their scored constituencies, as flat arrays. The constituencies for postcodes[i] are
+# pcons[offsets[i]:offsets[i+1]] (and the same slice of confidences), ranked by confidence, highest first. Ties are
+# ranked by constituency code, so output is deterministic. rows are the database rows the batch was scored from.
+class ScoredBatch(NamedTuple):
+    rows: List[tuple]
+    postcodes: numpy.ndarray
+    offsets: numpy.ndarray
+    pcons: numpy.ndarray
+    confidences: numpy.ndarray
+
+# Sorts buffered postcodes, whose entries are stored contiguously in postcode order (entry_counts[i] entries each).
+# Returns the postcode sort order, the offsets of each sorted postcode's entries, and the position of each sorted entry
+# in the unsorted entry arrays - so an entry array is sorted with entries[entry_positions].
+def sort_postcode_entries(postcodes: numpy.ndarray, entry_counts: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    entry_starts = numpy.cumsum(entry_counts) - entry_counts
+    order = numpy.argsort(postcodes, kind='stable')
+    sorted_counts = entry_counts[order]
+    entry_offsets = numpy.concatenate(([0], numpy.cumsum(sorted_counts)))
+    entry_positions = numpy.repeat(entry_starts[order] - entry_offsets[:-1], sorted_counts) + numpy.arange(entry_offsets[-1])
+    return order, entry_offsets, entry_positions
 
 class PostcodeLookupWriter:
-    def generate(self) -> None:
+    # Rows are streamed from a server-side cursor, this many rows at a time, so memory usage stays flat regardless of
+    # the number of postcodes and writers start producing output as soon as the first batch arrives
+    FETCH_BATCH_SIZE = 10_000
+
+    def generate(self, batch_size: int = FETCH_BATCH_SIZE) -> None:
         self.initialize_writer()
 
-        with psycopg.connect('user=local password=password host=localhost port=54321 dbname=gis') as conn:
-          with conn.cursor() as cursor:
+        for batch in self._scored_batches(batch_size):
+            self.write_batch(batch)
+            metrics.add_rows(rows_in=len(batch.rows), rows_out=len(batch.rows))
+
+        self.finalise_writer()
+
+    # Writers can override this to consume a whole scored batch at once, rather than a row at a time
+    def write_batch(self, batch: ScoredBatch) -> None:
+        for i, row in enumerate(batch.rows):
+            start, end = batch.offsets[i], batch.offsets[i+1]
+            confidences = dict(zip(batch.pcons[start:end].tolist(), batch.confidences[start:end].tolist()))
+            self.write_row(self._parse_row(row), confidences)
+
+    def _fetch_batches(self, batch_size: int) -> Iterator[List[tuple]]:
+        batch = []
+        for row in self._fetch_rows(batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _fetch_rows(self, batch_size: int) -> Iterator[tuple]:
+        with db.pool().connection() as conn:
+          # Naming the cursor makes it a server-side cursor
+          with conn.cursor(name='postcode_lookup_rows') as cursor:
+              cursor.itersize = batch_size
               cursor.execute(
                   """
                   SELECT
@@ -22,12 +82,56 @@ class PostcodeLookupWriter:
                   ORDER BY postcode
                   """
               )
-              for row in cursor.fetchall():
-                  parsed_row = self._parse_row(row)
-                  confidences = self._calculate_confidences(parsed_row)
-                  self.write_row(parsed_row, confidences)
+              yield from cursor
 
-        self.finalise_writer()
+    def _scored_batches(self, batch_size: int) -> Iterator[ScoredBatch]:
+        for rows in self._fetch_batches(batch_size):
+            yield self._score_batch(rows)
+
+    # Columnar equivalent of calling _parse_row & _calculate_confidences for every row in the batch - the confidences
+    # are identical (the same float operations in the same order), but are calculated with numpy over the whole batch
+    def _score_batch(self, rows: List[tuple]) -> ScoredBatch:
+        row_count = len(rows)
+        columns = list(zip(*rows))
+
+        # Flatten to one entry per (row, source column) with a constituency, in column order within each row
+        pcons = numpy.array([columns[i] for i in PCON_COLUMNS], dtype=object).T.ravel()
+        present = pcons != None
+        row_numbers = numpy.repeat(numpy.arange(row_count), len(PCON_COLUMNS))[present]
+        sources = numpy.tile(SOURCES, row_count)[present]
+        contributions = (
+            numpy.array([columns[i] for i in CONFIDENCE_COLUMNS], dtype=float).T.ravel()[present]
+            * numpy.tile(SOURCE_WEIGHTS, row_count)[present]
+        )
+        # Sorted, so comparing pcon indexes compares constituency codes
+        pcon_indexes, pcon_codes = pandas.factorize(pcons[present], sort=True)
+
+        # Group the entries by (row, pcon). Like next(...) in _calculate_confidences, only the first matching column
+        # from each source counts - entries are already in column order, so a stable sort keeps the first one first.
+        group_keys, groups = numpy.unique(row_numbers * len(pcon_codes) + pcon_indexes, return_inverse=True)
+        group_sources = groups * 3 + sources
+        order = numpy.argsort(group_sources, kind='stable')
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = group_sources[order][1:] != group_sources[order][:-1]
+        by_source = numpy.zeros((len(group_keys), 3))
+        by_source[groups[order][first], sources[order][first]] = contributions[order][first]
+        # Summed in the same order as _calculate_confidences (UPRN, ONSPD, mySociety). Adding the 0.0 of a missing
+        # source doesn't change a float, so this gives exactly the same values.
+        group_confidences = by_source[:, 0] + by_source[:, 1] + by_source[:, 2]
+
+        group_rows = group_keys // max(len(pcon_codes), 1)
+        group_pcons = group_keys % max(len(pcon_codes), 1)
+        ranked = numpy.lexsort((group_pcons, -group_confidences, group_rows))
+        offsets = numpy.zeros(row_count + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(group_rows, minlength=row_count), out=offsets[1:])
+
+        return ScoredBatch(
+            rows=rows,
+            postcodes=numpy.array(columns[0], dtype=object),
+            offsets=offsets,
+            pcons=numpy.asarray(pcon_codes, dtype=object)[group_pcons[ranked]],
+            confidences=group_confidences[ranked],
+        )
 
     def initialize_writer(self) -> None:
         raise NotImplementedError('Implement the initialize_writer method in a subclass')
@@ -60,6 +164,10 @@ class PostcodeLookupWriter:
             'mysociety_pcons': mysociety_pcons
         }
     
+    # Ranks a row's confidences the same way as a ScoredBatch - by confidence, highest first, then constituency code
+    def _rank_confidences(self, confidences: dict[str, float]) -> List[Tuple[str, float]]:
+        return sorted(confidences.items(), key=lambda x: (-x[1], x[0]))
+
     def _calculate_confidences(self, parsed_row: dict[str, Any]) -> dict[str, float]:
         confidences = {}
 
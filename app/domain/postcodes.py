@@ -1,5 +1,8 @@
+import functools
+import numpy
+import pandas
 import re
-from typing import Optional
+from typing import Iterable, Optional, Tuple
 
 class Postcode:
     # Postcodes are comprised of a number of different parts, and these parts form a hierarchy of geographical areas.
@@ -46,51 +49,92 @@ class Postcode:
     # - 'E17 0GF' - { 1:'E', 2:'17', 3:'0', 4:'GF' }
     POSTCODE_REGEXP = r'^\s*([A-Z][A-Z]{0,1})([0-9][A-Z0-9]{0,1})\s*([0-9])([A-Z]{2})\s*$'
 
+    POSTCODE_PATTERN = re.compile(POSTCODE_REGEXP)
+    # The columns returned by parse_many, named after the methods which return the same values
+    PARTS = ['postcode_area', 'postcode_district', 'postcode_sector', 'unit_postcode', 'outcode', 'incode']
+
+    # Instances hold the parsed parts of the postcode (None if it's invalid) rather than a regex Match, and no __dict__
+    __slots__ = ('_area', '_outcode', '_sector', '_incode')
+
     def __init__(self, postcode):
-      postcode_string = str(postcode)
-      self.match = re.search(self.POSTCODE_REGEXP, postcode_string)
+      self._area, self._outcode, self._sector, self._incode = _parse_postcode(str(postcode))
+
+    # Parses every postcode in an iterable, numpy array or pandas series. Returns a DataFrame with a column for each of
+    # PARTS, holding the values the methods of the same name would return (so None for invalid postcodes), indexed like
+    # the series (or 0..n-1). Each distinct postcode is only parsed once.
+    @classmethod
+    def parse_many(cls, postcodes: Iterable[str], separator: str = ' ') -> pandas.DataFrame:
+      if not isinstance(postcodes, (pandas.Series, numpy.ndarray)):
+        postcodes = numpy.array(list(postcodes), dtype=object)
+      codes, uniques = pandas.factorize(postcodes, use_na_sentinel=False)
+
+      # Parse the distinct postcodes into a row per postcode, with None for every part of invalid postcodes
+      search = cls.POSTCODE_PATTERN.search
+      unique_parts = numpy.full((len(uniques), len(cls.PARTS)), None, dtype=object)
+      parsed = [(i, match.groups()) for i, match in enumerate(search(str(postcode)) for postcode in uniques) if match]
+      if parsed:
+        rows, groups = zip(*parsed)
+        area, district, sector, unit = zip(*groups)
+        outcodes = [a + d for a, d in zip(area, district)]
+        rows = list(rows)
+        unique_parts[rows, 0] = area
+        unique_parts[rows, 1] = outcodes
+        unique_parts[rows, 2] = [o + separator + s for o, s in zip(outcodes, sector)]
+        unique_parts[rows, 3] = [o + separator + s + u for o, s, u in zip(outcodes, sector, unit)]
+        unique_parts[rows, 4] = outcodes
+        unique_parts[rows, 5] = [s + u for s, u in zip(sector, unit)]
+
+      index = postcodes.index if isinstance(postcodes, pandas.Series) else None
+      # dtype=object, so invalid postcodes stay None (rather than being inferred as a string column, with NaN)
+      return pandas.DataFrame(unique_parts[codes], columns=cls.PARTS, index=index, dtype=object, copy=False)
+
+    @classmethod
+    def unit_postcode_series(cls, postcodes: pandas.Series, separator: str = ' ') -> pandas.Series:
+      # Columnar equivalent of Postcode(p).unit_postcode(separator) for every p in the series - ie. the normalised
+      # unit postcode for valid postcodes, and None for invalid ones. Use this in preference to creating a Postcode
+      # per row when processing whole pandas chunks.
+      return cls.parse_many(postcodes, separator)['unit_postcode']
 
     def valid(self) -> bool:
-      return self.match is not None
+      return self._area is not None
 
     def postcode_area(self) -> Optional[str]:
-      if not self.valid():
-        return None
-
-      return self.match[1]
+      return self._area
 
     def postcode_district(self) -> Optional[str]:
-      if not self.valid():
-        return None
-
-      return f"{self.match[1]}{self.match[2]}"
+      return self._outcode
 
     def postcode_sector(self, separator: str = ' ') -> Optional[str]:
       if not self.valid():
         return None
 
-      return f"{self.match[1]}{self.match[2]}{separator}{self.match[3]}"
+      return self._outcode + separator + self._sector
 
     def unit_postcode(self, separator: str = ' ') -> Optional[str]:
       if not self.valid():
         return None
 
-      return f"{self.match[1]}{self.match[2]}{separator}{self.match[3]}{self.match[4]}"
+      return self._outcode + separator + self._incode
 
     def outcode(self) -> Optional[str]:
-      if not self.valid():
-        return None
-
-      return f"{self.match[1]}{self.match[2]}"
+      return self._outcode
 
     def incode(self) -> Optional[str]:
-      if not self.valid():
-        return None
-
-      return f"{self.match[3]}{self.match[4]}"
+      return self._incode
 
     def __str__(self) -> str:
       if not self.valid():
         return 'invalid'
 
       return self.unit_postcode()
+
+# Returns (area, outcode, sector digit, incode), or all None if the postcode is invalid. Cached by input string, so
+# seeing the same postcode repeatedly (eg. every address in a UPRN file) only runs the regular expression once.
+@functools.lru_cache(maxsize=65_536)
+def _parse_postcode(postcode: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+  match = Postcode.POSTCODE_PATTERN.search(postcode)
+  if match is None:
+    return None, None, None, None
+
+  area, district, sector, unit = match.groups()
+  return area, area + district, sector, sector + unit
@@ -0,0 +1,23 @@
+import glob
+from typing import List
+import pandas
+
+# The input files, shared by the load pipeline (app.scripts.load_postcodes) and the scripts which read the same files
+# without a database, such as app.scripts.map_postcodes_offline - so importing them doesn't pull in the database code.
+
+# Number of rows read from the input CSV files at a time
+CHUNK_SIZE = 10_000
+
+MYSOCIETY_POSTCODES_FILE = 'data/2024-01-28/input/mysociety_2025_postcodes_with_constituencies.csv'
+CONSTITUENCY_BOUNDARIES_FILE = 'data/2024-01-28/input/mysociety_2025_constituencies_boundaries.gpkg'
+
+def find_uprn_csv_files() -> List[str]:
+    return glob.glob('data/2024-01-28/input/ONS_UPRN_lookup/*.csv')
+
+def find_onspd_csv_files() -> List[str]:
+    return glob.glob('data/2024-01-28/input/ONS_postcode_directory/*.csv')
+
+# Reads one of the input CSV files with pandas.read_csv. keep_default_na=False prevents pandas from translating empty
+# strings to 'nan', so they're read as empty strings.
+def read_csv(file, **kwargs):
+    return pandas.read_csv(file, keep_default_na=False, **kwargs)
@@ -1,92 +1,150 @@
 import csv
+import itertools
+import os
 import sqlite3
+import time
 from datetime import datetime
+from typing import Dict
 
 from app.domain.postcodes import Postcode
 
+CONSTITUENCY_FILE = 'data/mysociety_2025_constituencies.csv'
+POSTCODE_FILE = 'data/2024-01-28/input/mysociety_2025_postcodes_with_constituencies.csv'
+OUTPUT_DIRECTORY = './output'
+# Postcodes are read, parsed & inserted this many at a time, so memory use doesn't grow with the input
+BATCH_SIZE = 50_000
+
+# The constituency table's columns, their types, and the columns of the constituency CSV they're read from. Each
+# constituency is stored once, rather than copied onto every postcode - join on short_code (or use the
+# postcode_lookup_enriched view) to enrich postcodes.
+CONSTITUENCY_COLUMNS = [
+    ('short_code', 'TEXT PRIMARY KEY', 'short_code'),
+    ('name', 'TEXT', 'name'),
+    ('gss_code', 'TEXT', 'gss_code'),
+    ('nation', 'TEXT', 'nation'),
+    ('region', 'TEXT', 'region'),
+    ('type', 'TEXT', 'con_type'),
+    ('electorate', 'INTEGER', 'electorate'),
+    ('area', 'REAL', 'area'),
+    ('density', 'REAL', 'density'),
+    ('center_lat', 'REAL', 'center_lat'),
+    ('center_lon', 'REAL', 'center_lon'),
+]
+
 # Run with: poetry run python -m app.main
+#
+# Writes ./output/postcodes_<timestamp>.db, with a postcode_lookup table of postcode -> constituency short code and a
+# constituency table of the mySociety constituency data. The postcode file is streamed in batches of BATCH_SIZE.
+def main() -> None:
+    constituency_data = read_constituencies()
+
+    os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
+    filename = f"postcodes_{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    con = sqlite3.connect(f"{OUTPUT_DIRECTORY}/{filename}.db")
+    cur = con.cursor()
+
+    # Bulk-load pragmas, as in PostcodeLookupSqliteWriter - the file is new, so if this fails it's simply run again
+    cur.execute("PRAGMA journal_mode = OFF")
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA locking_mode = EXCLUSIVE")
+
+    create_tables(cur)
+    cur.executemany(
+        f"""
+        INSERT INTO constituency ({', '.join(column for column, _, _ in CONSTITUENCY_COLUMNS)})
+        VALUES ({', '.join('?' for _ in CONSTITUENCY_COLUMNS)})
+        """,
+        [
+            tuple(constituency.get(csv_column) or None for _, _, csv_column in CONSTITUENCY_COLUMNS)
+            for constituency in constituency_data.values()
+        ]
+    )
+
+    invalid_postcodes = []
+    missing_constituency = 0
+    invalid_constituency = 0
+    with open(POSTCODE_FILE, 'r') as postcode_csv:
+        reader = csv.reader(postcode_csv)
+        header = next(reader)
+        postcode_index = header.index('postcode')
+        short_code_index = header.index('short_code')
+
+        while batch := list(itertools.islice(reader, BATCH_SIZE)):
+            postcodes = [line[postcode_index] for line in batch]
+            short_codes = [line[short_code_index] or None for line in batch]
+            unit_postcodes = Postcode.unit_postcode_series(postcodes).tolist()
+
+            rows = []
+            for raw_postcode, unit_postcode, short_code in zip(postcodes, unit_postcodes, short_codes):
+                # Invalid postcodes can't be looked up, so are skipped & reported once the file is loaded, as in
+                # load_postcodes
+                if unit_postcode is None:
+                    invalid_postcodes.append(raw_postcode)
+                    continue
 
-# Read all the constiuency data into a dict, indexed by constituence shortcode
-with open('data/mysociety_2025_constituencies.csv', 'r') as constituency_csv:
-    reader = csv.DictReader(constituency_csv)
-    constituency_data = {
-        line['short_code']: line
-        for line in reader
-    }
-
-# For each postcode, build up the desired data
-missing_constituency = 0
-invalid_constituency = 0
-
-output_data = []
-with open('data/2024-01-28/input/mysociety_2025_postcodes_with_constituencies.csv', 'r') as postcode_csv:
-    reader = csv.DictReader(postcode_csv)
-    for line in reader:
-        postcode = Postcode(line['postcode'])
-        if not postcode.valid():
-            print(f"Postcode {line['postcode']} looks invalid.")
-        short_code = line['short_code'] or None
-
-        if short_code is None:
-            print(f"No constituency found for postcode [{line['postcode']}], shortcode [{short_code}].")
-            missing_constituency += 1
-            constituency = {}
-        elif short_code not in constituency_data:
-            print(f"No Constituency found for shortcode [{short_code}] (for postcode [{line['postcode']}]).")
-            invalid_constituency += 1
-            constituency = {}
-        else:
-            constituency = constituency_data[short_code]
-
-        output_data.append({
-            'postcode_no_space': postcode.unit_postcode(separator=''),
-            'postcode_with_space': postcode.unit_postcode(separator=' '),
-            'postcode_area': postcode.postcode_area(),
-            'postcode_district': postcode.postcode_district(),
-            'postcode_sector': postcode.postcode_sector(),
-            'postcode_outcode': postcode.outcode(),
-            'postcode_incode': postcode.incode(),
-            'constituency_shortcode': short_code,
-            'constituency_name': constituency.get('name', None),
-            'constituency_gss': constituency.get('gss_code', None),
-            'constituency_nation': constituency.get('nation', None),
-            'constituency_region': constituency.get('region', None),
-            'constituency_type': constituency.get('con_type', None),
-            'constituency_electorate': constituency.get('electorate', None),
-            'constituency_area': constituency.get('area', None),
-            'constituency_density': constituency.get('density', None),
-            'constituency_center_lat': constituency.get('center_lat', None),
-            'constituency_center_lon': constituency.get('center_lon', None),
-        })
-
-print(f"Found {missing_constituency} postcodes with no constituency short_code")
-print(f"Found {invalid_constituency} postcodes whose constituency short_code was not in the constituency data")
-
-# Write the output
-filename = f"postcodes_{datetime.now().strftime('%Y%m%dT%H%M%S')}"
-con = sqlite3.connect(f"./output/{filename}.db")
-
-cur = con.cursor()
-
-cur.execute(
-    """
-    CREATE TABLE postcode_lookup(
-        postcode TEXT PRIMARY KEY,
-        constituency_shortcode TEXT
+                if short_code is None:
+                    print(f"No constituency found for postcode [{raw_postcode}], shortcode [{short_code}].")
+                    missing_constituency += 1
+                elif short_code not in constituency_data:
+                    print(f"No Constituency found for shortcode [{short_code}] (for postcode [{raw_postcode}]).")
+                    invalid_constituency += 1
+                rows.append((unit_postcode, short_code))
+
+            cur.executemany(
+                """
+                INSERT INTO postcode_lookup
+                (postcode, constituency_shortcode)
+                VALUES
+                (?, ?)
+                """,
+                rows
+            )
+
+    for p in invalid_postcodes:
+        print(f"{time.ctime()} - Found invalid postcode: [{p}]")
+    print(f"Skipped {len(invalid_postcodes)} invalid postcodes")
+    print(f"Found {missing_constituency} postcodes with no constituency short_code")
+    print(f"Found {invalid_constituency} postcodes whose constituency short_code was not in the constituency data")
+
+    con.commit()
+    cur.execute("ANALYZE")
+    cur.close()
+    con.close()
+
+# Read all the constituency data into a dict, indexed by constituency shortcode
+def read_constituencies() -> Dict[str, Dict[str, str]]:
+    with open(CONSTITUENCY_FILE, 'r') as constituency_csv:
+        reader = csv.DictReader(constituency_csv)
+        return {
+            line['short_code']: line
+            for line in reader
+        }
+
+def create_tables(cur: sqlite3.Cursor) -> None:
+    columns = [f"{column} {column_type}" for column, column_type, _ in CONSTITUENCY_COLUMNS]
+    cur.execute(f"CREATE TABLE constituency({', '.join(columns)})")
+
+    # Constituency short codes which aren't in the constituency data are kept (as they were before the enrichment
+    # was normalised), so constituency_shortcode isn't declared as a foreign key
+    cur.execute(
+        """
+        CREATE TABLE postcode_lookup(
+            postcode TEXT PRIMARY KEY,
+            constituency_shortcode TEXT
+        )
+        """
+    )
+
+    # The postcode parts (area, district, etc) can be derived from the postcode, so aren't stored
+    constituency_columns = [f"constituency.{column}" for column, _, _ in CONSTITUENCY_COLUMNS[1:]]
+    cur.execute(
+        f"""
+        CREATE VIEW postcode_lookup_enriched AS
+        SELECT postcode_lookup.postcode, postcode_lookup.constituency_shortcode, {', '.join(constituency_columns)}
+        FROM postcode_lookup
+        LEFT JOIN constituency ON constituency.short_code = postcode_lookup.constituency_shortcode
+        """
     )
-    """
-)
-
-cur.executemany(
-    """
-    INSERT INTO postcode_lookup
-    (postcode, constituency_shortcode)
-    VALUES
-    (:postcode_with_space, :constituency_shortcode)
-    """,
-    output_data
-)
-
-con.commit()
-
-cur.close()
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
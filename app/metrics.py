@@ -0,0 +1,374 @@
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# Instrumentation for pipeline runs. RunMetrics.stage() records, for each stage:
+#
+# - wall time, and CPU time (of this process and any worker processes it waits for - not the database server)
+# - rows in & out (recorded by the code doing the work, with add_rows) and throughput
+# - peak RSS of this process during the stage, and the peak RSS of any worker process so far
+# - timings, row counts and the EXPLAIN (ANALYZE, BUFFERS) plan of the heavy SQL statements (run with execute_sql)
+# - any other figures the stage reports about its work (with add_stat), eg. the share of addresses pruned
+# - optionally, a cProfile or sampling profile of the stage
+#
+# and RunMetrics.write_report() writes everything as a JSON run report. Code doing the work records against the stage
+# the current thread is running, so nothing needs to be passed around - and outside of a stage (eg. when running a
+# single function by hand) recording is a no-op, while execute_sql still runs the statement. Threads doing part of a
+# stage's work record against it by running in_current_stage(function).
+#
+# Stages can run concurrently (see Pipeline.run), each on its own thread. Their wall times, rows & statements are their
+# own, but CPU time and peak RSS are measured for the whole process, so overlap with whatever else is running. The peak
+# RSS is only reset when a stage starts with no other stage running, so it's never cleared from under a running stage -
+# a stage's peak is the process's peak since the start of the earliest stage it overlapped with.
+
+RUN_REPORTS_DIRECTORY = 'data/2024-01-28/output/run-reports'
+PROGRESS_INTERVAL_SECONDS = 10
+HEARTBEAT_INTERVAL_SECONDS = 300
+SAMPLING_INTERVAL_SECONDS = 0.01
+PROFILE_TOP_FUNCTIONS = 30
+
+# The stage being recorded by each thread
+_recording = threading.local()
+
+class StageMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.status = None
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.rows_in = 0
+        self.rows_out = 0
+        self.peak_rss_mb = None
+        self.peak_worker_rss_mb = None
+        self.statements = {}
+        self.stats = {}
+        self.profile = None
+        self.explain = False
+        self.lock = threading.Lock()
+
+    def add_rows(self, rows_in: int = 0, rows_out: int = 0) -> None:
+        with self.lock:
+            self.rows_in += int(rows_in)
+            self.rows_out += int(rows_out)
+
+    # Statements are aggregated by label (eg. a statement run once per partition is one entry), and the plan of the
+    # first run is kept
+    def add_statement(self, label: str, seconds: float, rows: Optional[int], plan: Optional[Any]) -> None:
+        with self.lock:
+            statement = self.statements.setdefault(label, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'plan': None})
+            statement['calls'] += 1
+            statement['seconds'] += seconds
+            statement['rows'] += rows or 0
+            if statement['plan'] is None:
+                statement['plan'] = plan
+
+    def add_stat(self, name: str, value: Any) -> None:
+        with self.lock:
+            self.stats[name] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        per_second = lambda rows: rows / self.wall_seconds if self.wall_seconds else None
+        return {
+            'name': self.name,
+            'status': self.status,
+            'started_at': self.started_at,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_in_per_second': per_second(self.rows_in),
+            'rows_out_per_second': per_second(self.rows_out),
+            'peak_rss_mb': self.peak_rss_mb,
+            'peak_worker_rss_mb': self.peak_worker_rss_mb,
+            'statements': self.statements,
+            'stats': self.stats,
+            'profile': self.profile,
+        }
+
+class RunMetrics:
+    # profile is None, 'cprofile' or 'sample'. With explain=False, statements run with execute_sql are only timed,
+    # avoiding the (small) overhead of EXPLAIN ANALYZE.
+    def __init__(self, profile: Optional[str] = None, explain: bool = True, reports_directory: str = RUN_REPORTS_DIRECTORY):
+        if profile not in (None, 'cprofile', 'sample'):
+            raise ValueError(f"Unknown profiler {profile}, expected 'cprofile' or 'sample'")
+        self.profile = profile
+        self.explain = explain
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.reports_directory = reports_directory
+        self.stages = []
+        self.running_stages = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        stage = StageMetrics(name)
+        stage.explain = self.explain
+        self.stages.append(stage)
+        stage.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+        with self.lock:
+            if self.running_stages == 0:
+                _reset_peak_rss()
+            self.running_stages += 1
+        profiler = self._start_profiler()
+        started_at = time.perf_counter()
+        cpu_started_at = _cpu_seconds()
+        previous_stage, _recording.stage = current_stage(), stage
+        try:
+            yield stage
+            stage.status = stage.status or 'completed'
+        except BaseException:
+            stage.status = 'failed'
+            raise
+        finally:
+            _recording.stage = previous_stage
+            stage.wall_seconds = time.perf_counter() - started_at
+            stage.cpu_seconds = _cpu_seconds() - cpu_started_at
+            stage.peak_rss_mb = _peak_rss_mb()
+            with self.lock:
+                self.running_stages -= 1
+            stage.peak_worker_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            if profiler is not None:
+                stage.profile = self._stop_profiler(profiler, name)
+
+    def skip_stage(self, name: str) -> None:
+        stage = StageMetrics(name)
+        stage.status = 'skipped'
+        self.stages.append(stage)
+
+    def write_report(self) -> str:
+        os.makedirs(self.reports_directory, exist_ok=True)
+        file_path = os.path.join(self.reports_directory, f"{self.run_id}.json")
+        with open(file_path, 'w') as file:
+            json.dump({
+                'run_id': self.run_id,
+                'started_at': self.started_at,
+                'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'argv': sys.argv,
+                'stages': [stage.to_dict() for stage in self.stages],
+            }, file, indent=2, default=str)
+        return file_path
+
+    def _start_profiler(self):
+        if self.profile == 'cprofile':
+            # cProfile only sees the thread which enables it - ie. not worker threads or processes
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profile == 'sample':
+            profiler = SamplingProfiler()
+            profiler.start()
+            return profiler
+        return None
+
+    def _stop_profiler(self, profiler, stage_name: str) -> Dict[str, Any]:
+        os.makedirs(self.reports_directory, exist_ok=True)
+        file_prefix = os.path.join(self.reports_directory, f"{self.run_id}-{stage_name}")
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(f"{file_prefix}.prof")
+            stats = pstats.Stats(profiler)
+            top_functions = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP_FUNCTIONS]
+            return {
+                'type': 'cprofile',
+                'file': f"{file_prefix}.prof",
+                'top_functions_by_cumulative_seconds': [
+                    {'function': f"{file}:{line}({function})", 'calls': calls, 'own_seconds': own, 'cumulative_seconds': cumulative}
+                    for (file, line, function), (_primitive_calls, calls, own, cumulative, _callers) in top_functions
+                ],
+            }
+
+        profiler.stop()
+        profiler.write_folded(f"{file_prefix}.folded")
+        return {
+            'type': 'sample',
+            'file': f"{file_prefix}.folded",
+            'samples': profiler.sample_count,
+            'top_frames_by_samples': [
+                {'frame': frame, 'samples': samples} for frame, samples in profiler.top_frames(PROFILE_TOP_FUNCTIONS)
+            ],
+        }
+
+# A low overhead profiler, which samples the stack of every thread in this process every SAMPLING_INTERVAL_SECONDS.
+# The stacks are written in the 'folded' format used by flamegraph.pl and speedscope. Unlike cProfile it sees worker
+# threads, and doesn't slow down tight python loops - but it doesn't see worker processes either.
+class SamplingProfiler:
+    def __init__(self, interval: float = SAMPLING_INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks = Counter()
+        self.sample_count = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def write_folded(self, file_path: str) -> None:
+        with open(file_path, 'w') as file:
+            for stack, samples in self.stacks.most_common():
+                file.write(f"{stack} {samples}\n")
+
+    # The frames (including callers) which appear in the most samples
+    def top_frames(self, count: int):
+        frames = Counter()
+        for stack, samples in self.stacks.items():
+            for frame in set(stack.split(';')):
+                frames[frame] += samples
+        return frames.most_common(count)
+
+    def _sample(self) -> None:
+        own_thread_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+
+# Reports progress through a file as it's read, every PROGRESS_INTERVAL_SECONDS. Progress is based on the position in
+# the (binary) file, so the file doesn't need to be read an extra time to count its lines first.
+class FileProgress:
+    def __init__(self, label: str, file, interval: float = PROGRESS_INTERVAL_SECONDS):
+        self.label = label
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+        self.interval = interval
+        self.rows = 0
+        self.started_at = time.perf_counter()
+        self.reported_at = self.started_at
+
+    def update(self, rows: int) -> None:
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.reported_at >= self.interval:
+            self.reported_at = now
+            self._report(min(self.file.tell() / self.size, 1.0) if self.size else 1.0)
+
+    def finish(self) -> None:
+        self._report(1.0)
+
+    def _report(self, fraction: float) -> None:
+        elapsed = time.perf_counter() - self.started_at
+        rate = self.rows / elapsed if elapsed else 0
+        print(f"{time.ctime()} - {self.label}: {fraction:.0%} ({self.rows:,} rows, {rate:,.0f} rows/s)", flush=True)
+
+# The stage the current thread is recording against, if any
+def current_stage() -> Optional[StageMetrics]:
+    return getattr(_recording, 'stage', None)
+
+# Records rows against the stage the current thread is running
+def add_rows(rows_in: int = 0, rows_out: int = 0) -> None:
+    stage = current_stage()
+    if stage is not None:
+        stage.add_rows(rows_in, rows_out)
+
+# Records a named figure against the stage the current thread is running
+def add_stat(name: str, value: Any) -> None:
+    stage = current_stage()
+    if stage is not None:
+        stage.add_stat(name, value)
+
+# Records rows against the given stage instead of the current one while in the with block - eg. so worker processes
+# can count their rows and return them to the process running the stage
+@contextmanager
+def recording(stage: Optional[StageMetrics]) -> Iterator[Optional[StageMetrics]]:
+    previous_stage, _recording.stage = current_stage(), stage
+    try:
+        yield stage
+    finally:
+        _recording.stage = previous_stage
+
+# Wraps function so that, wherever it's called (eg. on a ThreadPoolExecutor's threads), it records against the stage
+# the current thread is running
+def in_current_stage(function: Callable[..., Any]) -> Callable[..., Any]:
+    stage = current_stage()
+    def run_in_stage(*args, **kwargs):
+        with recording(stage):
+            return function(*args, **kwargs)
+    return run_in_stage
+
+# Runs a (heavy) SQL statement, recording its timing & the number of rows it produced against the current stage. When
+# the stage is capturing plans, the statement is run with EXPLAIN (ANALYZE, BUFFERS) - which runs it just the same
+# (including any writes) - and the plan is recorded too. Pass explain=False for statements EXPLAIN doesn't support (eg.
+# CREATE INDEX), which are only timed. While the statement is running a line is printed every
+# HEARTBEAT_INTERVAL_SECONDS, so long statements don't look like they've hung.
+def execute_sql(cursor, label: str, sql: str, params: Optional[Any] = None, explain: bool = True) -> Optional[int]:
+    stage = current_stage()
+    explain = explain and stage is not None and stage.explain
+
+    heartbeat_stopped = threading.Event()
+    started_at = time.perf_counter()
+    def heartbeat() -> None:
+        while not heartbeat_stopped.wait(HEARTBEAT_INTERVAL_SECONDS):
+            print(f"{time.ctime()} - Still running {label} ({(time.perf_counter() - started_at) / 60:.0f} minutes)", flush=True)
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+
+    try:
+        if explain:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+            rows = _plan_rows(plan)
+        else:
+            cursor.execute(sql, params)
+            plan = None
+            rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    finally:
+        heartbeat_stopped.set()
+        heartbeat_thread.join()
+
+    if stage is not None:
+        stage.add_statement(label, time.perf_counter() - started_at, rows, plan)
+        stage.add_rows(rows_out=rows or 0)
+    return rows
+
+def _plan_rows(plan) -> Optional[int]:
+    # The JSON plan is a list with a single entry. For INSERT / UPDATE / DELETE the top node is the ModifyTable, which
+    # doesn't return any rows - so use the rows of the node feeding it.
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    node = plan[0]['Plan']
+    if node.get('Node Type') == 'ModifyTable' and node.get('Plans'):
+        node = node['Plans'][0]
+    return node.get('Actual Rows')
+
+def _cpu_seconds() -> float:
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+# ru_maxrss is the peak for the lifetime of the process. On Linux the peak can be reset, so each stage gets its own
+# (see RunMetrics.stage for concurrent stages).
+def _reset_peak_rss() -> None:
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def _peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,273 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import os
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+from app.db import ConnectionPool
+from app.metrics import RunMetrics
+
+# A minimal declarative pipeline. Each Stage declares the files it reads, the stages it depends on, and the tables
+# and files it produces. A fingerprint of each stage's inputs (the content of its input files, plus the fingerprints of
+# its upstream stages) is recorded in the database when the stage completes, and on the next run any stage whose
+# fingerprint hasn't changed - and whose outputs still exist - is skipped. So, for example, a new mySociety file only
+# re-runs the mySociety stage and the stages downstream of it, rather than the multi-hour UPRN stages.
+#
+# Each stage that runs (or is skipped) is recorded in a RunMetrics, for the run report.
+#
+# By default stages run one after another, in the order they're defined. With workers > 1, stages run concurrently on
+# up to workers threads, each on its own connection from a db.ConnectionPool - a stage starts as soon as every stage it
+# depends on has completed, so independent branches (eg. the UPRN, ONSPD & mySociety stages) overlap, and the run takes
+# roughly as long as its longest branch.
+
+FILE_HASH_BLOCK_SIZE = 1024 * 1024
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        run: Callable[..., None],
+        input_files: Callable[[], Sequence[str]] = lambda: [],
+        depends_on: Sequence[str] = (),
+        output_tables: Sequence[str] = (),
+        output_files: Sequence[str] = (),
+        resumable: bool = False
+    ):
+        # run is called with a database connection. input_files is a callable, so globs are evaluated when the
+        # pipeline runs rather than when it is defined. If resumable is True, the outputs of an interrupted run with
+        # the same fingerprint are kept, so the stage can pick up where it left off.
+        self.name = name
+        self.run = run
+        self.input_files = input_files
+        self.depends_on = list(depends_on)
+        self.output_tables = list(output_tables)
+        self.output_files = list(output_files)
+        self.resumable = resumable
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]):
+        self.stages = {}
+        for stage in stages:
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on {dependency}, which must be defined before it")
+            self.stages[stage.name] = stage
+
+    # With only, just the given stages are considered - the stages they depend on are treated as complete. With
+    # workers > 1, pool must be given, and connection is only used to work out the fingerprints.
+    def run(
+        self,
+        connection,
+        only: Optional[Sequence[str]] = None,
+        run_metrics: Optional[RunMetrics] = None,
+        workers: int = 1,
+        pool: Optional[ConnectionPool] = None
+    ) -> None:
+        run_metrics = run_metrics or RunMetrics()
+        self._create_state_tables(connection)
+        fingerprints = self.fingerprints(connection)
+        stages = [stage for stage in self.stages.values() if only is None or stage.name in only]
+
+        if workers > 1:
+            self._run_concurrently(stages, fingerprints, run_metrics, workers, pool)
+            return
+
+        for stage in stages:
+            self.run_stage(connection, stage, fingerprints[stage.name], run_metrics)
+
+    # Records the given stages as complete with their current fingerprints, for when their outputs have been brought
+    # up to date some other way (eg. an incremental refresh)
+    def record_stages_completed(self, connection, stage_names: Sequence[str]) -> None:
+        self._create_state_tables(connection)
+        fingerprints = self.fingerprints(connection)
+
+        for stage_name in stage_names:
+            self._record_state(connection, self.stages[stage_name], fingerprints[stage_name], completed=True)
+
+    def run_stage(self, connection, stage: Stage, fingerprint: str, run_metrics: RunMetrics) -> None:
+        recorded_fingerprint, completed = self._recorded_state(connection, stage)
+
+        if recorded_fingerprint == fingerprint and completed and self._outputs_exist(connection, stage):
+            print(f"{time.ctime()} - Skipping stage {stage.name}, its inputs are unchanged")
+            run_metrics.skip_stage(stage.name)
+            return
+
+        if stage.resumable and recorded_fingerprint == fingerprint and not completed:
+            print(f"{time.ctime()} - Resuming stage {stage.name}")
+        else:
+            print(f"{time.ctime()} - Running stage {stage.name}")
+            self._remove_outputs(connection, stage)
+
+        self._record_state(connection, stage, fingerprint, completed=False)
+        with run_metrics.stage(stage.name) as stage_metrics:
+            stage.run(connection)
+        self._record_state(connection, stage, fingerprint, completed=True)
+        print(
+            f"{time.ctime()} - Completed stage {stage.name} in {stage_metrics.wall_seconds:.1f}s "
+            f"({stage_metrics.rows_out:,} rows out, peak RSS {stage_metrics.peak_rss_mb:,.0f}MB)"
+        )
+
+    # Starts each stage once the stages it depends on have completed, in definition order when several are ready. If a
+    # stage fails no more are started, and the error is raised once the running stages have finished.
+    def _run_concurrently(
+        self,
+        stages: List[Stage],
+        fingerprints: Dict[str, str],
+        run_metrics: RunMetrics,
+        workers: int,
+        pool: Optional[ConnectionPool]
+    ) -> None:
+        # Stages (eg. the spatial joins) take further connections from the pool, so it must have more than workers,
+        # otherwise the running stages could hold every connection while waiting for another
+        if pool is None or pool.max_size <= workers:
+            raise ValueError(f"Running {workers} stages concurrently needs a connection pool of more than {workers} connections")
+
+        stage_names = {stage.name for stage in stages}
+        pending = list(stages)
+        running = {}
+        completed = set()
+        error = None
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stage') as executor:
+            while pending or running:
+                for stage in list(pending):
+                    if error is not None or len(running) >= workers:
+                        break
+                    if all(dependency in completed or dependency not in stage_names for dependency in stage.depends_on):
+                        pending.remove(stage)
+                        future = executor.submit(self._run_stage_on_pool, pool, stage, fingerprints[stage.name], run_metrics)
+                        running[future] = stage
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        completed.add(stage.name)
+                    except BaseException as stage_error:
+                        print(f"{time.ctime()} - Stage {stage.name} failed: {stage_error!r}")
+                        error = error or stage_error
+
+        if error is not None:
+            raise error
+
+    def _run_stage_on_pool(self, pool: ConnectionPool, stage: Stage, fingerprint: str, run_metrics: RunMetrics) -> None:
+        with pool.connection() as connection:
+            self.run_stage(connection, stage, fingerprint, run_metrics)
+
+    def fingerprints(self, connection) -> Dict[str, str]:
+        fingerprints = {}
+        for stage in self.stages.values():
+            fingerprints[stage.name] = self.fingerprint(connection, stage, fingerprints)
+        return fingerprints
+
+    def fingerprint(self, connection, stage: Stage, upstream_fingerprints: Dict[str, str]) -> str:
+        fingerprint = hashlib.sha256(stage.name.encode())
+        for file_path in sorted(stage.input_files()):
+            fingerprint.update(file_path.encode())
+            fingerprint.update(self._file_hash(connection, file_path).encode())
+        for dependency in stage.depends_on:
+            fingerprint.update(upstream_fingerprints[dependency].encode())
+        return fingerprint.hexdigest()
+
+    def _file_hash(self, connection, file_path: str) -> str:
+        # Hashing the multi-GB input files takes a while, so the hash is cached against the file's size & mtime
+        stat = os.stat(file_path)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT content_hash FROM pipeline_file_hashes WHERE file_path = %s AND size = %s AND mtime_ns = %s",
+                (file_path, stat.st_size, stat.st_mtime_ns)
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                return row[0]
+
+            print(f"{time.ctime()} - Calculating fingerprint of {file_path}")
+            content_hash = hashlib.blake2b()
+            with open(file_path, 'rb') as file:
+                while block := file.read(FILE_HASH_BLOCK_SIZE):
+                    content_hash.update(block)
+
+            cursor.execute(
+                """
+                INSERT INTO pipeline_file_hashes (file_path, size, mtime_ns, content_hash)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (file_path) DO UPDATE
+                SET size = EXCLUDED.size, mtime_ns = EXCLUDED.mtime_ns, content_hash = EXCLUDED.content_hash
+                """,
+                (file_path, stat.st_size, stat.st_mtime_ns, content_hash.hexdigest())
+            )
+        connection.commit()
+        return content_hash.hexdigest()
+
+    def _create_state_tables(self, connection) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pipeline_stages (
+                    stage VARCHAR(100) PRIMARY KEY,
+                    fingerprint VARCHAR(64),
+                    completed_at TIMESTAMP
+                )
+                """
+            )
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pipeline_file_hashes (
+                    file_path TEXT PRIMARY KEY,
+                    size BIGINT,
+                    mtime_ns BIGINT,
+                    content_hash VARCHAR(128)
+                )
+                """
+            )
+        connection.commit()
+
+    def _recorded_state(self, connection, stage: Stage):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT fingerprint, completed_at FROM pipeline_stages WHERE stage = %s", (stage.name,))
+            row = cursor.fetchone()
+        if row is None:
+            return None, False
+        return row[0], row[1] is not None
+
+    def _record_state(self, connection, stage: Stage, fingerprint: str, completed: bool) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO pipeline_stages (stage, fingerprint, completed_at)
+                VALUES (%s, %s, CASE WHEN %s THEN NOW() END)
+                ON CONFLICT (stage) DO UPDATE
+                SET fingerprint = EXCLUDED.fingerprint, completed_at = EXCLUDED.completed_at
+                """,
+                (stage.name, fingerprint, completed)
+            )
+        connection.commit()
+
+    # PostgreSQL empties UNLOGGED tables (eg. those created by the bulk-load mode) when it recovers from a crash, so an
+    # empty UNLOGGED output counts as missing, and the stage is run again rather than leaving everything downstream
+    # reading an empty table
+    def _outputs_exist(self, connection, stage: Stage) -> bool:
+        with connection.cursor() as cursor:
+            for table in stage.output_tables:
+                cursor.execute("SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                if row[0] == 'u':
+                    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+                    if not cursor.fetchone()[0]:
+                        print(f"{time.ctime()} - UNLOGGED table {table} is empty, it may have been truncated by a crash")
+                        return False
+        return all(os.path.exists(file_path) for file_path in stage.output_files)
+
+    def _remove_outputs(self, connection, stage: Stage) -> None:
+        with connection.cursor() as cursor:
+            for table in stage.output_tables:
+                cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+        connection.commit()
+
+        for file_path in stage.output_files:
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -0,0 +1,68 @@
+import random
+import time
+from typing import List
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter
+
+# Run with: poetry run python -m app.scripts.benchmark_confidences
+#
+# Compares the row-at-a-time confidence calculation (_parse_row & _calculate_confidences) with the columnar one
+# (_score_batch) on synthetic combined_postcode_to_constituency_multicol rows, and checks they give identical results.
+# Doesn't need the database.
+
+ROW_COUNT = 500_000
+BATCH_SIZE = PostcodeLookupWriter.FETCH_BATCH_SIZE
+PCON_COUNT = 650
+SEED = 1
+
+def synthetic_rows(row_count: int, seed: int = SEED) -> List[tuple]:
+    rng = random.Random(seed)
+    pcons = [f"P{i:03}" for i in range(PCON_COUNT)]
+    rows = []
+    for i in range(row_count):
+        # Most postcodes are in a single constituency, some straddle a boundary
+        local_pcons = rng.sample(pcons, 3)
+        uprn_count = rng.choices([0, 1, 2, 3], weights=[5, 80, 12, 3])[0]
+        uprn_confidences = [rng.random() for _ in range(uprn_count)]
+        total = sum(uprn_confidences)
+        row = [f"AB{i // 4000 + 1} {i % 10}{chr(65 + i // 10 % 26)}{chr(65 + i // 260 % 26)}"]
+        for j in range(5):
+            row += [local_pcons[j], uprn_confidences[j] / total] if j < uprn_count else [None, None]
+        row += [rng.choice(local_pcons), 1.0] if rng.random() < 0.95 else [None, None]
+        row += [rng.choice(local_pcons + ['UNKNOWN']), 1.0] if rng.random() < 0.95 else [None, None]
+        rows.append(tuple(row))
+    return rows
+
+def main() -> None:
+    writer = PostcodeLookupWriter()
+    rows = synthetic_rows(ROW_COUNT)
+    print(f"{time.ctime()} - Generated {len(rows)} synthetic rows")
+
+    started_at = time.perf_counter()
+    row_results = [writer._calculate_confidences(writer._parse_row(row)) for row in rows]
+    row_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    batches = [writer._score_batch(rows[start:start + BATCH_SIZE]) for start in range(0, len(rows), BATCH_SIZE)]
+    batch_seconds = time.perf_counter() - started_at
+
+    mismatches = 0
+    row_number = 0
+    for batch in batches:
+        for i in range(len(batch.rows)):
+            start, end = batch.offsets[i], batch.offsets[i+1]
+            pcons, confidences = batch.pcons[start:end].tolist(), batch.confidences[start:end].tolist()
+            expected = row_results[row_number]
+            # Identical values, and ranked by confidence (highest first) then constituency code
+            if dict(zip(pcons, confidences)) != expected or list(zip(pcons, confidences)) != sorted(expected.items(), key=lambda x: (-x[1], x[0])):
+                mismatches += 1
+            row_number += 1
+
+    print(f"Row at a time: {row_seconds:.2f}s ({len(rows) / row_seconds:,.0f} rows/s)")
+    print(f"Columnar:      {batch_seconds:.2f}s ({len(rows) / batch_seconds:,.0f} rows/s), batches of {BATCH_SIZE}")
+    print(f"Speed up:      {row_seconds / batch_seconds:.1f}x")
+    print(f"Mismatches:    {mismatches}")
+    if mismatches:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
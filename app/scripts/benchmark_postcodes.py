@@ -0,0 +1,69 @@
+import random
+import re
+import timeit
+from typing import Callable, Dict, List
+import pandas
+from app.domain.postcodes import Postcode, _parse_postcode
+
+# Run with: poetry run python -m app.scripts.benchmark_postcodes
+#
+# Microbenchmarks for postcode parsing & normalisation, on valid, invalid and whitespace-heavy inputs. Each input set
+# has POSTCODE_COUNT postcodes, with some repetition (like real files, where many addresses share a postcode).
+
+POSTCODE_COUNT = 200_000
+DISTINCT_POSTCODES = 50_000
+REPEAT = 5
+SEED = 1
+
+# The previous implementation of Postcode - re.search on the pattern string for every instance, keeping the Match, and
+# building the result with an f-string on every call
+class UncachedPostcode:
+    def __init__(self, postcode):
+        self.match = re.search(Postcode.POSTCODE_REGEXP, str(postcode))
+
+    def unit_postcode(self, separator: str = ' '):
+        if self.match is None:
+            return None
+        return f"{self.match[1]}{self.match[2]}{separator}{self.match[3]}{self.match[4]}"
+
+def generate_inputs(seed: int = SEED) -> Dict[str, List[str]]:
+    rng = random.Random(seed)
+    letters = 'ABCDEFGHIJKLMNOPRSTUWYZ'
+
+    def postcode(whitespace: str) -> str:
+        outcode = rng.choice(letters) + rng.choice(['', rng.choice(letters)]) + str(rng.randint(1, 99))
+        incode = str(rng.randint(0, 9)) + rng.choice(letters) + rng.choice(letters)
+        return whitespace + outcode + whitespace + incode + whitespace
+
+    distinct = {
+        'valid': [postcode(' ')[1:-1] for _ in range(DISTINCT_POSTCODES)],
+        'invalid': [postcode(' ')[1:-1][::-1] + rng.choice(['', '!', 'X']) for _ in range(DISTINCT_POSTCODES)],
+        'whitespace': [postcode(rng.choice(['  ', '\t', ' \t  ', ''])) for _ in range(DISTINCT_POSTCODES)],
+    }
+    return {name: rng.choices(postcodes, k=POSTCODE_COUNT) for name, postcodes in distinct.items()}
+
+def benchmark(name: str, function: Callable[[], object], before: Callable[[], object] = lambda: None) -> None:
+    # Best of REPEAT runs, with `before` run (untimed) before each one
+    times = []
+    for _ in range(REPEAT):
+        before()
+        times.append(timeit.timeit(function, number=1))
+    print(f"  {name:<42} {min(times) * 1000:8.1f}ms  {POSTCODE_COUNT / min(times):>12,.0f} postcodes/s")
+
+def main() -> None:
+    for input_name, postcodes in generate_inputs().items():
+        series = pandas.Series(postcodes, dtype=object)
+        print(f"{input_name} ({POSTCODE_COUNT:,} postcodes, up to {DISTINCT_POSTCODES:,} distinct):")
+        benchmark('previous Postcode(p).unit_postcode()', lambda: [UncachedPostcode(p).unit_postcode() for p in postcodes])
+        benchmark(
+            'Postcode(p).unit_postcode() - cold cache',
+            lambda: [Postcode(p).unit_postcode() for p in postcodes],
+            before=_parse_postcode.cache_clear,
+        )
+        benchmark('Postcode(p).unit_postcode() - warm cache', lambda: [Postcode(p).unit_postcode() for p in postcodes])
+        benchmark('Postcode.parse_many', lambda: Postcode.parse_many(series))
+        benchmark('Postcode.unit_postcode_series', lambda: Postcode.unit_postcode_series(series))
+        benchmark('pandas str.extract', lambda: series.str.extract(Postcode.POSTCODE_REGEXP, expand=True))
+
+if __name__ == '__main__':
+    main()
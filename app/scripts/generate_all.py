@@ -0,0 +1,31 @@
+import sys
+from app.domain.postcode_lookup_arrow_writer import PostcodeLookupArrowWriter
+from app.domain.postcode_lookup_binary_writer import PostcodeLookupBinaryWriter
+from app.domain.postcode_lookup_csv_writer import PostcodeLookupCsvWriter
+from app.domain.postcode_lookup_fanout_writer import PostcodeLookupFanoutWriter
+from app.domain.postcode_lookup_sharded_writer import PostcodeLookupShardedWriter
+from app.domain.postcode_lookup_sqlite_writer import PostcodeLookupSqliteWriter
+from app.scripts import generate_binary, generate_csv, generate_parquet, generate_shards, generate_sqlite
+
+# Run with: poetry run python -m app.scripts.generate_all [--sequential] [--parquet] [--shards]
+#
+# Generates the CSV, SQLite and binary lookup files in a single pass over the database, with each writer on its own
+# thread. Pass --sequential to run the writers one after another on the main thread instead, and --parquet to generate
+# the Parquet file too (which needs pyarrow - see generate_parquet), and --shards to generate the JSON outcode shards.
+def main() -> None:
+    args = sys.argv[1:]
+    writers = [
+        PostcodeLookupCsvWriter(filename=generate_csv.OUTPUT_FILE, write_confidences=False),
+        PostcodeLookupSqliteWriter(filename=generate_sqlite.OUTPUT_FILE),
+        PostcodeLookupBinaryWriter(filename=generate_binary.OUTPUT_FILE),
+    ]
+    if '--parquet' in args:
+        writers.append(PostcodeLookupArrowWriter(filename=generate_parquet.OUTPUT_FILE))
+    if '--shards' in args:
+        writers.append(PostcodeLookupShardedWriter(directory=generate_shards.OUTPUT_DIRECTORY))
+
+    writer = PostcodeLookupFanoutWriter(writers, threaded='--sequential' not in args)
+    writer.generate()
+
+if __name__ == '__main__':
+    main()
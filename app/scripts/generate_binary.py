@@ -0,0 +1,11 @@
+from app.domain.postcode_lookup_binary_writer import PostcodeLookupBinaryWriter
+
+OUTPUT_FILE = 'data/2024-01-28/output/postcode-lookup.bin'
+
+# Run with: poetry run python -m app.scripts.generate_binary
+def main() -> None:
+    writer = PostcodeLookupBinaryWriter(filename=OUTPUT_FILE)
+    writer.generate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+import sys
+from app.domain.postcode_boundary_writer import PostcodeBoundaryCsvWriter
+
+OUTPUT_FILE = 'data/2024-01-28/output/postcode-boundaries.csv'
+
+# Run with: poetry run python -m app.scripts.generate_boundaries [--layer=<name> ...]
+#
+# Writes the postcode to boundary mappings for every layer assigned by `load_postcodes --multi-layer`. Pass --layer to
+# only write the given layers.
+def main() -> None:
+    layers = [arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--layer=')]
+    writer = PostcodeBoundaryCsvWriter(filename=OUTPUT_FILE, layers=layers)
+    writer.generate()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
+import sys
 from app.domain.postcode_lookup_csv_writer import PostcodeLookupCsvWriter
 
-# Run with: poetry run python -m app.scripts.generate_csv
+OUTPUT_FILE = 'data/2024-01-28/output/postcode-lookup.csv'
+COMPRESSED_FILE_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Run with: poetry run python -m app.scripts.generate_csv [--compress=gzip|zstd]
+#
+# With --compress the file is written block-compressed (eg. postcode-lookup.csv.gz), with a side index of the
+# postcodes in each block (postcode-lookup.csv.gz.idx) - see app.domain.block_compression.
 def main() -> None:
+    compression = next((arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--compress=')), None)
     writer = PostcodeLookupCsvWriter(
-        filename='data/2024-01-28/output/postcode-lookup.csv',
-        write_confidences=False
+        filename=OUTPUT_FILE + COMPRESSED_FILE_EXTENSIONS.get(compression, ''),
+        write_confidences=False,
+        block_compression=compression
     )
     writer.generate()
 
@@ -0,0 +1,23 @@
+import sys
+from app.domain.postcode_lookup_arrow_writer import PostcodeLookupArrowWriter
+
+OUTPUT_FILE = 'data/2024-01-28/output/postcode-lookup.parquet'
+ARROW_OUTPUT_FILE = 'data/2024-01-28/output/postcode-lookup.arrow'
+
+# Run with: poetry run python -m app.scripts.generate_parquet [--arrow] [--wide]
+#
+# Needs pyarrow - install it with `poetry install --extras arrow`. Writes the long shape (a row per postcode to
+# constituency mapping) as Parquet by default. Pass --arrow to write an Arrow IPC file instead, and --wide for a row
+# per postcode with a column per constituency, like the CSV file.
+def main() -> None:
+    args = sys.argv[1:]
+    file_format = 'arrow' if '--arrow' in args else 'parquet'
+    writer = PostcodeLookupArrowWriter(
+        filename=ARROW_OUTPUT_FILE if file_format == 'arrow' else OUTPUT_FILE,
+        file_format=file_format,
+        shape='wide' if '--wide' in args else 'long'
+    )
+    writer.generate()
+
+if __name__ == '__main__':
+    main()
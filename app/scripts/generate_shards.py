@@ -0,0 +1,20 @@
+import sys
+from app.domain.postcode_lookup_sharded_writer import PostcodeLookupShardedWriter
+
+OUTPUT_DIRECTORY = 'data/2024-01-28/output/postcode-lookup-shards'
+
+# Run with: poetry run python -m app.scripts.generate_shards [--area] [--binary]
+#
+# Writes a JSON shard per outcode by default. Pass --area to shard by postcode area instead, and --binary to write
+# shards in the binary lookup format.
+def main() -> None:
+    args = sys.argv[1:]
+    writer = PostcodeLookupShardedWriter(
+        directory=OUTPUT_DIRECTORY,
+        shard_by='postcode_area' if '--area' in args else 'outcode',
+        encoding='binary' if '--binary' in args else 'json'
+    )
+    writer.generate()
+
+if __name__ == '__main__':
+    main()
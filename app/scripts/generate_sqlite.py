@@ -1,9 +1,25 @@
+import sys
+from app.domain.block_compression import compress_file_in_blocks
 from app.domain.postcode_lookup_sqlite_writer import PostcodeLookupSqliteWriter
+from app.scripts.generate_csv import COMPRESSED_FILE_EXTENSIONS
 
-# Run with: poetry run python -m app.scripts.generate_csv
+OUTPUT_FILE = 'data/2024-01-28/output/postcode-lookup.db'
+
+# Run with: poetry run python -m app.scripts.generate_sqlite [--compress=gzip|zstd]
+#
+# With --compress a block-compressed copy of the database is written too (eg. postcode-lookup.db.gz). SQLite needs
+# random access to its pages, so the database itself can't be written compressed - the copy is compressed in fixed
+# size blocks, and its index maps uncompressed byte offsets to blocks rather than postcodes.
 def main() -> None:
-    writer = PostcodeLookupSqliteWriter(filename='data/2024-01-28/output/postcode-lookup.db')
+    compression = next((arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--compress=')), None)
+    if compression is not None and compression not in COMPRESSED_FILE_EXTENSIONS:
+        raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(COMPRESSED_FILE_EXTENSIONS)}")
+
+    writer = PostcodeLookupSqliteWriter(filename=OUTPUT_FILE)
     writer.generate()
 
+    if compression:
+        compress_file_in_blocks(OUTPUT_FILE, OUTPUT_FILE + COMPRESSED_FILE_EXTENSIONS[compression], compression)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,392 @@
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+from typing import Dict, List, Tuple
+import numpy
+import pandas
+from app.domain.boundary_index import BoundaryIndex
+from app.domain.coordinates import bng_to_wgs84
+from app.utils import ceildiv
+
+# Run with: poetry run python -m app.scripts.generate_synthetic_data [address count]
+#
+# Generates deterministic synthetic versions of every input file - the UPRN lookup, ONSPD, the mySociety postcode
+# lookup and the constituency boundaries - with the same columns and layout as data/2024-01-28/input, so the pipeline
+# can be run & benchmarked without the multi-GB real files. The same address count and seed always give byte-identical
+# files. Scales from 10k to 30M (roughly the size of the real UPRN lookup) addresses.
+#
+# The geography is a grid of constituencies with wiggly, shared edges over a Great Britain sized extent of British
+# National Grid co-ordinates. Postcodes are clustered around towns, numbered so nearby postcodes share a district, and
+# their addresses are scattered around the postcode's centre - so some postcodes straddle constituency boundaries.
+
+SEED = 20240128
+DEFAULT_ADDRESS_COUNT = 1_000_000
+SYNTHETIC_DATA_DIRECTORY = 'data/synthetic'
+
+# Constituency grid, over an extent of BNG eastings & northings
+CONSTITUENCY_COLUMNS = 26
+CONSTITUENCY_ROWS = 25
+EXTENT = (80_000, 0, 660_000, 1_000_000) # min easting, min northing, max easting, max northing
+VERTICES_PER_EDGE = 200
+
+ADDRESSES_PER_POSTCODE = 15
+ADDRESS_SCATTER_METRES = 40
+TOWN_COUNT = 400
+TOWN_SHARE = 0.7 # The remaining postcodes are spread uniformly
+ADDRESSES_PER_UPRN_FILE = 250_000
+MAX_UPRN_FILES = 12
+POSTCODES_PER_CHUNK = 100_000
+TERMINATED_POSTCODE_SHARE = 0.03
+INVALID_UPRN_POSTCODE_SHARE = 0.0001
+MISSING_MYSOCIETY_CONSTITUENCY_SHARE = 0.002
+
+# Postcode components - 2 letter areas, districts 1-99, sectors 0-9, and 2 letter units
+AREA_LETTERS = 'ABCDEFGHJKLMNOPRSTUWY'
+UNIT_LETTERS = 'ABDEFGHJLNPQRSTUWXYZ'
+POSTCODES_PER_SECTOR = len(UNIT_LETTERS) ** 2
+POSTCODES_PER_DISTRICT = POSTCODES_PER_SECTOR * 10
+POSTCODES_PER_AREA = POSTCODES_PER_DISTRICT * 99
+
+WGS84_DEFINITION = (
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+    'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+    'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+)
+
+# The files are laid out the same way as data/2024-01-28/input, under data/synthetic/<address count>/input
+def synthetic_data_directory(address_count: int) -> str:
+    return os.path.join(SYNTHETIC_DATA_DIRECTORY, str(address_count))
+
+def synthetic_input_files(directory: str) -> Dict[str, object]:
+    input_directory = os.path.join(directory, 'input')
+    uprn_directory = os.path.join(input_directory, 'ONS_UPRN_lookup')
+    return {
+        'uprn': sorted(
+            os.path.join(uprn_directory, file_name) for file_name in os.listdir(uprn_directory) if file_name.endswith('.csv')
+        ) if os.path.isdir(uprn_directory) else [],
+        'onspd': [os.path.join(input_directory, 'ONS_postcode_directory', 'ONSPD_SYNTHETIC_UK.csv')],
+        'mysociety': os.path.join(input_directory, 'mysociety_2025_postcodes_with_constituencies.csv'),
+        'boundaries': os.path.join(input_directory, 'mysociety_2025_constituencies_boundaries.gpkg'),
+    }
+
+# Returns True if the data set has been completely generated with these parameters
+def synthetic_data_exists(directory: str, address_count: int, seed: int = SEED) -> bool:
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    return manifest.get('address_count') == address_count and manifest.get('seed') == seed
+
+def generate_synthetic_data(address_count: int, directory: str, seed: int = SEED) -> None:
+    rng = numpy.random.default_rng(seed)
+    input_directory = os.path.join(directory, 'input')
+    os.makedirs(os.path.join(input_directory, 'ONS_UPRN_lookup'), exist_ok=True)
+    os.makedirs(os.path.join(input_directory, 'ONS_postcode_directory'), exist_ok=True)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    files = synthetic_input_files(directory)
+
+    print(f"{time.ctime()} - Generating constituency boundaries")
+    codes, names, rings = generate_constituencies(rng)
+    write_geopackage(files['boundaries'], codes, names, rings)
+    boundary_index = BoundaryIndex(27700, [(code, [ring]) for code, ring in zip(codes, rings)])
+
+    postcode_count = max(1, address_count // ADDRESSES_PER_POSTCODE)
+    print(f"{time.ctime()} - Generating {postcode_count} postcodes")
+    postcodes = generate_postcodes(rng, postcode_count)
+
+    print(f"{time.ctime()} - Generating {address_count} UPRN addresses")
+    write_uprn_files(rng, postcodes, address_count, os.path.join(input_directory, 'ONS_UPRN_lookup'))
+
+    print(f"{time.ctime()} - Generating ONSPD & mySociety postcode files")
+    write_onspd_file(rng, postcodes, files['onspd'][0])
+    write_mysociety_file(rng, postcodes, boundary_index, files['mysociety'])
+
+    # Written last, so an interrupted run is never mistaken for a complete data set
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump({
+            'address_count': address_count,
+            'postcode_count': postcode_count,
+            'constituency_count': len(codes),
+            'seed': seed,
+        }, manifest_file, indent=2)
+    print(f"{time.ctime()} - Generated synthetic data in {directory}")
+
+##### Constituencies #####
+
+# Returns the short code, name and (closed) boundary ring in BNG co-ordinates of each constituency. Neighbouring
+# constituencies share their edges exactly, so there are no gaps or overlaps between them.
+def generate_constituencies(rng: numpy.random.Generator) -> Tuple[List[str], List[str], List[numpy.ndarray]]:
+    min_x, min_y, max_x, max_y = EXTENT
+    cell_width = (max_x - min_x) / CONSTITUENCY_COLUMNS
+    cell_height = (max_y - min_y) / CONSTITUENCY_ROWS
+
+    # Jitter the interior grid nodes, keeping the outer boundary a rectangle
+    node_x, node_y = numpy.meshgrid(
+        numpy.linspace(min_x, max_x, CONSTITUENCY_COLUMNS + 1),
+        numpy.linspace(min_y, max_y, CONSTITUENCY_ROWS + 1),
+        indexing='ij'
+    )
+    interior = (slice(1, -1), slice(1, -1))
+    node_x[interior] += rng.uniform(-0.2, 0.2, node_x[interior].shape) * cell_width
+    node_y[interior] += rng.uniform(-0.2, 0.2, node_y[interior].shape) * cell_height
+
+    edges = {}
+    def edge(start: Tuple[int, int], end: Tuple[int, int]) -> numpy.ndarray:
+        # The points from start up to (but not including) end. Each edge is generated once, and reversed for the
+        # constituency on the other side.
+        if (end, start) in edges:
+            return _reverse_edge(edges[(end, start)], node_x[start], node_y[start])
+        start_point = numpy.array([node_x[start], node_y[start]])
+        end_point = numpy.array([node_x[end], node_y[end]])
+        t = numpy.linspace(0, 1, VERTICES_PER_EDGE + 1)[:-1]
+        points = start_point + numpy.outer(t, end_point - start_point)
+        on_outer_boundary = (start[0] == end[0] and start[0] in (0, CONSTITUENCY_COLUMNS)) or (
+            start[1] == end[1] and start[1] in (0, CONSTITUENCY_ROWS)
+        )
+        if not on_outer_boundary:
+            # A few random harmonics, tapered to zero at each end, perpendicular to the edge
+            wiggle = sum(
+                rng.uniform(-1, 1) / harmonic * numpy.sin(numpy.pi * harmonic * t + rng.uniform(0, 2 * numpy.pi))
+                for harmonic in range(1, 6)
+            ) * numpy.sin(numpy.pi * t)
+            direction = end_point - start_point
+            normal = numpy.array([-direction[1], direction[0]]) / numpy.hypot(*direction)
+            points += numpy.outer(wiggle * 0.05 * min(cell_width, cell_height), normal)
+        edges[(start, end)] = points
+        return points
+
+    codes, names, rings = [], [], []
+    for column in range(CONSTITUENCY_COLUMNS):
+        for row in range(CONSTITUENCY_ROWS):
+            corners = [(column, row), (column + 1, row), (column + 1, row + 1), (column, row + 1)]
+            ring = numpy.vstack([edge(corners[i], corners[(i + 1) % 4]) for i in range(4)])
+            rings.append(numpy.vstack([ring, ring[:1]]))
+            number = len(codes) + 1
+            codes.append(f"SYN{number:03}")
+            names.append(f"Synthetic Constituency {number}")
+    return codes, names, rings
+
+def _reverse_edge(points: numpy.ndarray, start_x: float, start_y: float) -> numpy.ndarray:
+    # points runs from the other constituency's start node up to (not including) our start node, so prepend our start
+    # node and drop theirs
+    return numpy.vstack([[start_x, start_y], points[:0:-1]])
+
+# Writes a minimal GeoPackage (https://www.geopackage.org/spec/) with a parl_constituencies_2025 layer in WGS84, which
+# both ogr2ogr and app.domain.geopackage can read
+def write_geopackage(file_path: str, codes: List[str], names: List[str], rings: List[numpy.ndarray]) -> None:
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+    connection = sqlite3.connect(file_path)
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA application_id = 1196444487") # 'GPKG'
+    cursor.execute("PRAGMA user_version = 10200")
+    cursor.execute(
+        """
+        CREATE TABLE gpkg_spatial_ref_sys (
+            srs_name TEXT NOT NULL,
+            srs_id INTEGER PRIMARY KEY,
+            organization TEXT NOT NULL,
+            organization_coordsys_id INTEGER NOT NULL,
+            definition TEXT NOT NULL,
+            description TEXT
+        )
+        """
+    )
+    cursor.executemany(
+        "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+            ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+            ('WGS 84 geodetic', 4326, 'EPSG', 4326, WGS84_DEFINITION, None),
+        ]
+    )
+    cursor.execute(
+        """
+        CREATE TABLE gpkg_contents (
+            table_name TEXT NOT NULL PRIMARY KEY,
+            data_type TEXT NOT NULL,
+            identifier TEXT UNIQUE,
+            description TEXT DEFAULT '',
+            last_change DATETIME NOT NULL,
+            min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+            srs_id INTEGER
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE gpkg_geometry_columns (
+            table_name TEXT NOT NULL,
+            column_name TEXT NOT NULL,
+            geometry_type_name TEXT NOT NULL,
+            srs_id INTEGER NOT NULL,
+            z TINYINT NOT NULL,
+            m TINYINT NOT NULL,
+            PRIMARY KEY (table_name, column_name)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE parl_constituencies_2025 (
+            fid INTEGER PRIMARY KEY AUTOINCREMENT,
+            geom MULTIPOLYGON,
+            short_code TEXT,
+            name TEXT
+        )
+        """
+    )
+
+    wgs84_rings = [numpy.column_stack(bng_to_wgs84(ring[:, 0], ring[:, 1])) for ring in rings]
+    cursor.executemany(
+        "INSERT INTO parl_constituencies_2025 (geom, short_code, name) VALUES (?, ?, ?)",
+        [(_gpkg_multipolygon(ring, 4326), code, name) for code, name, ring in zip(codes, names, wgs84_rings)]
+    )
+
+    all_points = numpy.vstack(wgs84_rings)
+    cursor.execute(
+        "INSERT INTO gpkg_contents VALUES ('parl_constituencies_2025', 'features', 'parl_constituencies_2025', '', ?, ?, ?, ?, ?, 4326)",
+        (
+            '2024-01-28T00:00:00.000Z',
+            float(all_points[:, 0].min()), float(all_points[:, 1].min()),
+            float(all_points[:, 0].max()), float(all_points[:, 1].max()),
+        )
+    )
+    cursor.execute("INSERT INTO gpkg_geometry_columns VALUES ('parl_constituencies_2025', 'geom', 'MULTIPOLYGON', 4326, 0, 0)")
+    connection.commit()
+    connection.close()
+
+# A GeoPackage geometry blob - header (with an xy envelope) then little-endian WKB - for a single ring multipolygon
+def _gpkg_multipolygon(ring: numpy.ndarray, srs_id: int) -> bytes:
+    header = b'GP' + struct.pack('<BBi4d', 0, 0b011, srs_id, ring[:, 0].min(), ring[:, 0].max(), ring[:, 1].min(), ring[:, 1].max())
+    wkb = struct.pack('<BII', 1, 6, 1) + struct.pack('<BIII', 1, 3, 1, len(ring)) + ring.astype('<f8').tobytes()
+    return header + wkb
+
+##### Postcodes & addresses #####
+
+# Returns a dataframe of postcode, easting & northing (of the postcode's centre). Postcodes are numbered in a
+# spatial order, so each district & sector covers a compact area.
+def generate_postcodes(rng: numpy.random.Generator, postcode_count: int) -> pandas.DataFrame:
+    min_x, min_y, max_x, max_y = EXTENT
+    town_x = rng.uniform(min_x, max_x, TOWN_COUNT)
+    town_y = rng.uniform(min_y, max_y, TOWN_COUNT)
+    town_size = rng.uniform(2_000, 20_000, TOWN_COUNT)
+
+    in_town = rng.random(postcode_count) < TOWN_SHARE
+    towns = rng.integers(0, TOWN_COUNT, postcode_count)
+    eastings = numpy.where(in_town, town_x[towns] + rng.normal(0, 1, postcode_count) * town_size[towns], rng.uniform(min_x, max_x, postcode_count))
+    northings = numpy.where(in_town, town_y[towns] + rng.normal(0, 1, postcode_count) * town_size[towns], rng.uniform(min_y, max_y, postcode_count))
+    # Keep addresses scattered around the centre inside the extent too
+    margin = 5 * ADDRESS_SCATTER_METRES
+    eastings = numpy.clip(eastings, min_x + margin, max_x - margin).round()
+    northings = numpy.clip(northings, min_y + margin, max_y - margin).round()
+
+    # Order by 20km square, so consecutive postcode numbers are near each other
+    order = numpy.lexsort((eastings, eastings // 20_000, northings // 20_000))
+    return pandas.DataFrame({
+        'postcode': postcode_strings(numpy.arange(postcode_count)),
+        'easting': eastings[order].astype(numpy.int64),
+        'northing': northings[order].astype(numpy.int64),
+    })
+
+# Formats postcode numbers as valid, unique postcodes, eg. 0 -> 'AA1 0AA'
+def postcode_strings(numbers: numpy.ndarray) -> pandas.Series:
+    areas = numpy.array([a + b for a in AREA_LETTERS for b in AREA_LETTERS], dtype=object)
+    units = numpy.array([a + b for a in UNIT_LETTERS for b in UNIT_LETTERS], dtype=object)
+    numbers = numpy.asarray(numbers)
+    return (
+        pandas.Series(areas[numbers // POSTCODES_PER_AREA])
+        + pandas.Series(numbers // POSTCODES_PER_DISTRICT % 99 + 1).astype(str)
+        + ' '
+        + pandas.Series(numbers // POSTCODES_PER_SECTOR % 10).astype(str)
+        + pandas.Series(units[numbers % POSTCODES_PER_SECTOR])
+    )
+
+# Writes the UPRN lookup files, split into regional bands of northing like the real files. Addresses are generated a
+# chunk of postcodes at a time, so memory use doesn't grow with the address count.
+def write_uprn_files(rng: numpy.random.Generator, postcodes: pandas.DataFrame, address_count: int, directory: str) -> None:
+    file_count = max(1, min(MAX_UPRN_FILES, ceildiv(address_count, ADDRESSES_PER_UPRN_FILE)))
+    min_y, max_y = EXTENT[1], EXTENT[3]
+    file_paths = [os.path.join(directory, f"NSUL_SYNTHETIC_{i+1:02}.csv") for i in range(file_count)]
+    for file_path in file_paths:
+        with open(file_path, 'w') as file:
+            file.write('UPRN,GRIDGB1E,GRIDGB1N,PCDS,CTRY23CD,RGN23CD,LAD23CD,WD23CD,PCON11CD\n')
+
+    addresses_per_postcode = rng.multinomial(address_count, numpy.full(len(postcodes), 1 / len(postcodes)))
+    next_uprn = 10_000_000
+    for start in range(0, len(postcodes), POSTCODES_PER_CHUNK):
+        chunk = postcodes.iloc[start:start + POSTCODES_PER_CHUNK]
+        counts = addresses_per_postcode[start:start + POSTCODES_PER_CHUNK]
+        chunk_address_count = int(counts.sum())
+        if chunk_address_count == 0:
+            continue
+
+        address_postcodes = numpy.repeat(chunk['postcode'].to_numpy(), counts)
+        invalid = rng.random(chunk_address_count) < INVALID_UPRN_POSTCODE_SHARE
+        address_postcodes[invalid] = rng.choice(['', 'ZZ99', 'NOT KNOWN'], int(invalid.sum()))
+        uprns = next_uprn + numpy.cumsum(rng.integers(1, 20, chunk_address_count))
+        next_uprn = int(uprns[-1])
+        northings = numpy.repeat(chunk['northing'].to_numpy(), counts) + rng.normal(0, ADDRESS_SCATTER_METRES, chunk_address_count).round().astype(numpy.int64)
+        addresses = pandas.DataFrame({
+            'UPRN': uprns,
+            'GRIDGB1E': numpy.repeat(chunk['easting'].to_numpy(), counts) + rng.normal(0, ADDRESS_SCATTER_METRES, chunk_address_count).round().astype(numpy.int64),
+            'GRIDGB1N': northings,
+            'PCDS': address_postcodes,
+            'CTRY23CD': 'E92000001',
+            'RGN23CD': 'E12000007',
+            'LAD23CD': 'E09000033',
+            'WD23CD': 'E05013806',
+            'PCON11CD': 'E14000639',
+        })
+
+        files = numpy.clip((northings - min_y) * file_count // (max_y - min_y), 0, file_count - 1)
+        for file_no, file_addresses in addresses.groupby(files, sort=True):
+            file_addresses.to_csv(file_paths[file_no], mode='a', header=False, index=False)
+
+def write_onspd_file(rng: numpy.random.Generator, postcodes: pandas.DataFrame, file_path: str) -> None:
+    # Terminated postcodes are numbered after the live ones, so they're still unique
+    terminated_count = int(len(postcodes) * TERMINATED_POSTCODE_SHARE)
+    terminated = rng.choice(len(postcodes), terminated_count, replace=False) if terminated_count else numpy.array([], dtype=numpy.int64)
+    all_postcodes = pandas.concat([
+        postcodes,
+        pandas.DataFrame({
+            'postcode': postcode_strings(numpy.arange(len(postcodes), len(postcodes) + terminated_count)),
+            'easting': postcodes['easting'].to_numpy()[terminated],
+            'northing': postcodes['northing'].to_numpy()[terminated],
+        }),
+    ], ignore_index=True)
+    longitudes, latitudes = bng_to_wgs84(all_postcodes['easting'], all_postcodes['northing'])
+
+    pandas.DataFrame({
+        'pcd': all_postcodes['postcode'].str.replace(' ', '').str.pad(7, side='right'),
+        'pcd2': all_postcodes['postcode'].str.pad(8, side='right'),
+        'pcds': all_postcodes['postcode'],
+        'dointr': '198001',
+        'doterm': numpy.where(numpy.arange(len(all_postcodes)) >= len(postcodes), '202001', ''),
+        'oseast1m': all_postcodes['easting'],
+        'osnrth1m': all_postcodes['northing'],
+        'osgrdind': 1,
+        'ctry': 'E92000001',
+        'pcon': 'E14000639',
+        'lat': latitudes.round(6),
+        'long': longitudes.round(6),
+    }).to_csv(file_path, index=False)
+
+def write_mysociety_file(rng: numpy.random.Generator, postcodes: pandas.DataFrame, boundary_index: BoundaryIndex, file_path: str) -> None:
+    short_codes = boundary_index.assign(postcodes['easting'], postcodes['northing'])
+    short_codes[rng.random(len(short_codes)) < MISSING_MYSOCIETY_CONSTITUENCY_SHARE] = None
+    pandas.DataFrame({'postcode': postcodes['postcode'], 'short_code': short_codes}).to_csv(file_path, index=False)
+
+def main() -> None:
+    address_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ADDRESS_COUNT
+    generate_synthetic_data(address_count, synthetic_data_directory(address_count))
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,94 @@
 from collections import defaultdict
-import glob
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+import multiprocessing
+import os
+from typing import Dict, List, NamedTuple
 import pandas
+from app import db, metrics
+from app.inputs import CHUNK_SIZE, CONSTITUENCY_BOUNDARIES_FILE, MYSOCIETY_POSTCODES_FILE, find_onspd_csv_files, find_uprn_csv_files, read_csv
+from app.domain.coordinates import bng_to_wgs84, ewkb_points_hex
 from app.domain.postcodes import Postcode
-from app.utils import ceildiv, print_loading_dot, print_loading_header
-import psycopg
-import re
-import subprocess
+from app.pipeline import Pipeline, Stage
+from app.scripts import generate_all, generate_binary, generate_boundaries, generate_csv, generate_sqlite
+import sys
 import time
 
 # Run with: poetry run python -m app.scripts.load_postcodes
 
-CHUNK_SIZE = 10_000
+# Number of worker processes used to load the UPRN files in parallel. Each worker has its own database connection, so
+# beyond a certain point the database (rather than the CPU) becomes the bottleneck.
+UPRN_LOAD_WORKERS = os.cpu_count() or 1
 
-def get_file_line_count(filepath: str) -> int:
-    cmd_result = subprocess.run(['wc', '-l', filepath], stdout=subprocess.PIPE)
-    cmd_output = cmd_result.stdout.decode()
-    regex_match = re.search("^[0-9]+", cmd_output)
-    line_count = int(regex_match[0])
-    return line_count
+# The UPRN to constituency spatial join is split into this many partitions of addresses, which are mapped concurrently
+# by this many connections
+SPATIAL_JOIN_PARTITIONS = 256
+SPATIAL_JOIN_WORKERS = os.cpu_count() or 1
 
-##### UPRN helper methods #####
+# Number of pipeline stages run concurrently (overridden with --workers=N). The UPRN, ONSPD & mySociety branches are
+# independent until they're combined, so three lets them all run at once. Each running stage holds a connection from
+# db.pool(), as do the spatial join partitions, so the pool must be larger than this.
+STAGE_WORKERS = 3
+
+# Postcodes whose addresses are all further than this (in degrees, ~1m) from every constituency boundary are assigned
+# their constituency wholesale, rather than address by address - see create_uprn_interior_postcodes. The pruning is
+# exact for any margin (an extent which doesn't touch a boundary line is wholly inside or outside each constituency),
+# so the margin only needs to cover rounding: a box2d held at single precision is out by up to ~4e-6 degrees at GB
+# latitudes, so with less than that an address could fall just outside its postcode's extent.
+PRUNING_MARGIN_DEGREES = 0.00001
+
+# Session settings for bulk-load mode (--bulk-load): more memory for sorts & index builds, parallel index builds, and
+# commits which don't wait for the WAL to be flushed. After a crash the interrupted stage is simply run again - and as
+# PostgreSQL empties UNLOGGED tables when it recovers, so are completed stages whose UNLOGGED tables were emptied (see
+# Pipeline._outputs_exist), unless --set-logged has made them LOGGED.
+BULK_LOAD_SESSION_SETTINGS = {
+    'maintenance_work_mem': '2GB',
+    'work_mem': '256MB',
+    'max_parallel_maintenance_workers': '4',
+    'synchronous_commit': 'off',
+}
+# The tables bulk-load mode creates UNLOGGED, which --set-logged makes LOGGED (crash-safe & replicated) at the end
+BULK_LOADED_TABLES = ['uprn_addresses', 'onspd_postcodes']
+
+# A set of boundaries (eg. wards, councils) assigned to every UPRN address & ONSPD postcode by the multi-layer stages.
+# table is a PostGIS table of polygons in a geom column - eg. loaded from a GeoPackage with ogr2ogr, as the
+# constituencies are (see the Makefile) - and code_column identifies each boundary. input_file is the file the table was
+# loaded from, so the multi-layer stages are re-run when it changes.
+class BoundaryLayer(NamedTuple):
+    name: str
+    table: str
+    code_column: str
+    input_file: str
+
+# Add a BoundaryLayer here for each set of boundaries to be assigned by --multi-layer
+BOUNDARY_LAYERS = [
+    BoundaryLayer('constituency', 'parl_constituencies_2025', 'short_code', CONSTITUENCY_BOUNDARIES_FILE),
+]
+
+# The options for the COPY streams copy_dataframe writes to. CSV treats an unquoted empty field as NULL by default, so
+# NULL is given as \N instead - as it is in text format, which these streams used when they were written row by row.
+COPY_CSV_OPTIONS = r"(FORMAT csv, NULL '\N')"
+
+# Writes the whole dataframe to a `COPY ... FROM STDIN {COPY_CSV_OPTIONS}` stream in one go, rather than row by row.
+# None / NaN values are written as \N, and loaded as NULL, while empty strings are loaded as empty strings.
+def copy_dataframe(copy, dataframe: pandas.DataFrame) -> None:
+    if dataframe.empty:
+        return
+
+    copy.write(dataframe.to_csv(header=False, index=False, na_rep='\\N'))
+
+def apply_session_settings(connection, settings: Dict[str, str]) -> None:
+    with connection.cursor() as cursor:
+        for name, value in settings.items():
+            cursor.execute("SELECT set_config(%s, %s, false)", (name, value))
+    connection.commit()
+
+# Adds the number of occurrences of each value in the series to counts, preserving the order values were first seen
+def count_values(values: pandas.Series, counts: Dict[str, int]) -> None:
+    for value, count in values.groupby(values, sort=False).size().items():
+        counts[value] += count
 
-def find_uprn_csv_files() -> List[str]:
-    return glob.glob('data/2024-01-28/input/ONS_UPRN_lookup/*.csv')
+##### UPRN helper methods #####
 
 def create_uprn_address_table(connection) -> None:
     with connection.cursor() as cursor:
@@ -43,30 +108,83 @@ def create_uprn_address_table(connection) -> None:
         )
         connection.commit()
 
-def copy_addresses_from_uprn_file(file_path: str, connection) -> None:
+# With with_coords=True the longitude, latitude & centroid are calculated on the client for each chunk and written as
+# part of the COPY, so set_uprn_address_coords doesn't need to be run afterwards.
+def copy_addresses_from_uprn_file(
+    file_path: str,
+    connection,
+    show_progress: bool = True,
+    with_coords: bool = False,
+    table: str = 'uprn_addresses'
+) -> Dict[str, int]:
     invalid_postcodes = defaultdict(int)
+    columns = "uprn, postcode, northing, easting, latitude, longitude, centroid" if with_coords else "uprn, postcode, northing, easting"
 
     with connection.cursor() as cursor:
-        with cursor.copy("COPY uprn_addresses (uprn, postcode, northing, easting) FROM STDIN") as copy:
-            line_count = get_file_line_count(file_path)
-            total_chunks = ceildiv(line_count, CHUNK_SIZE)
-
-            print_loading_header()
-
-            # keep_default_na=False prevents pandas from translating empty strings to 'nan'
-            with pandas.read_csv(file_path, chunksize=CHUNK_SIZE, dtype={'PCDS':str}, keep_default_na=False) as reader:
-                chunk_no = 0
+        with cursor.copy(f"COPY {table} ({columns}) FROM STDIN {COPY_CSV_OPTIONS}") as copy:
+            with open(file_path, 'rb') as file, read_csv(file, chunksize=CHUNK_SIZE, dtype={'PCDS':str}) as reader:
+                progress = metrics.FileProgress(file_path, file) if show_progress else None
                 for chunk in reader:
-                    print_loading_dot(chunk_no, total_chunks)
-                    chunk_no += 1
-                    for _index, row in chunk.iterrows():
-                        postcode = Postcode(row['PCDS'])
-                        if not postcode.valid():
-                            invalid_postcodes[row['PCDS']] += 1
-                        copy.write_row((row['UPRN'], postcode.unit_postcode(), row['GRIDGB1N'], row['GRIDGB1E']))
+                    postcodes = Postcode.unit_postcode_series(chunk['PCDS'])
+                    count_values(chunk['PCDS'][postcodes.isna()], invalid_postcodes)
+                    addresses = pandas.DataFrame({
+                        'uprn': chunk['UPRN'],
+                        'postcode': postcodes,
+                        'northing': chunk['GRIDGB1N'],
+                        'easting': chunk['GRIDGB1E'],
+                    })
+                    if with_coords:
+                        longitudes, latitudes = bng_to_wgs84(chunk['GRIDGB1E'], chunk['GRIDGB1N'])
+                        # The latitude column holds the longitude (& vice versa), as set_uprn_address_coords has always
+                        # written them - nothing downstream reads them, and tables built either way hold the same values
+                        addresses['latitude'] = longitudes
+                        addresses['longitude'] = latitudes
+                        addresses['centroid'] = ewkb_points_hex(longitudes, latitudes, 4326)
+                    copy_dataframe(copy, addresses)
+                    metrics.add_rows(rows_in=len(chunk), rows_out=len(addresses))
+                    if progress is not None:
+                        progress.update(len(chunk))
+
+                if progress is not None:
+                    progress.finish()
 
         connection.commit()
-    
+
+    return invalid_postcodes
+
+# Entry point for each worker process used by copy_addresses_from_uprn_files_in_parallel. Connections can't be shared
+# between processes, so every worker opens its own connection (and so its own COPY stream) rather than using the pool. The worker's row counts
+# are returned, so they can be recorded against the stage running in the parent process.
+def copy_addresses_from_uprn_file_in_worker(file_path: str, with_coords: bool, table: str):
+    with db.connect() as conn, metrics.recording(metrics.StageMetrics(file_path)) as file_metrics:
+        invalid_postcodes = copy_addresses_from_uprn_file(file_path, conn, show_progress=False, with_coords=with_coords, table=table)
+
+    print(f"{time.ctime()} - Finished loading data from {file_path}", flush=True)
+    return invalid_postcodes, file_metrics.rows_in, file_metrics.rows_out
+
+def copy_addresses_from_uprn_files_in_parallel(
+    file_paths: List[str],
+    workers: int = UPRN_LOAD_WORKERS,
+    with_coords: bool = False,
+    table: str = 'uprn_addresses'
+) -> Dict[str, int]:
+    invalid_postcodes = defaultdict(int)
+    workers = max(1, min(workers, len(file_paths)))
+    print(f"{time.ctime()} - Loading {len(file_paths)} files using {workers} worker processes")
+
+    # The workers are started by a forkserver rather than forked from this process, as other stages' threads may be
+    # running (eg. mid-COPY on pooled connections), and forking a process with threads can deadlock the child
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+        # map() yields results in the order of file_paths, so the merged report is the same on every run
+        load_file = partial(copy_addresses_from_uprn_file_in_worker, with_coords=with_coords, table=table)
+        for worker_invalid_postcodes, rows_in, rows_out in executor.map(load_file, file_paths):
+            metrics.add_rows(rows_in=rows_in, rows_out=rows_out)
+            for k,v in worker_invalid_postcodes.items():
+                invalid_postcodes[k] += v
+
+    return invalid_postcodes
+
+def print_invalid_uprn_postcodes(invalid_postcodes: Dict[str, int]) -> None:
     for k,v in invalid_postcodes.items():
         print (f"{time.ctime()} - Found {v} addresses with invalid postcode: [{k}]")
 
@@ -76,7 +194,9 @@ def set_uprn_address_coords(connection) -> None:
     # https://8kb.co.uk/blog/2014/03/16/uk-geographic-postcode-data-latitude-longitude-royal-mail-paf-and-ordnance-survey-data/
     with connection.cursor() as cursor:
         print(f"{time.ctime()} - Updating centroid of all addresses")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'uprn_addresses_centroids',
             """
             UPDATE uprn_addresses
             SET centroid = ST_transform(
@@ -86,8 +206,12 @@ def set_uprn_address_coords(connection) -> None:
             WHERE centroid IS NULL
             """
         )
+        # Note latitude is set from ST_X (the longitude) & longitude from ST_Y. The columns aren't used by any of the
+        # mappings, and copy_addresses_from_uprn_file writes them the same way, so the swap is kept.
         print(f"{time.ctime()} - Updating lat/lng of all addresses")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'uprn_addresses_coords',
             """
             UPDATE uprn_addresses
             SET latitude = ST_X(centroid), longitude = ST_Y(centroid)
@@ -106,7 +230,9 @@ def create_uprn_address_constituency_map(connection) -> None:
         # Note, batching this by using a sub-query on uprn_addresses and a LIMIT/OFFSET would allow us to output
         # progress on the command line. This works for the first few batches, but starts to slow down exponentially.
         # It's significantly quicker to run it as a single statement.
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'uprn_address_to_constituency',
             """
             CREATE TABLE uprn_address_to_constituency AS
                 SELECT a.uprn, pcon.short_code AS constituency_code
@@ -117,10 +243,277 @@ def create_uprn_address_constituency_map(connection) -> None:
         )
         connection.commit()
 
+# Splits the address table into key ranges of (roughly) equal size, recorded in partitions_table along with when each
+# has been mapped. The partitions are only created once, so re-running a partitioned mapping after an interruption
+# picks up from the first incomplete partition.
+def create_uprn_address_partitions(connection, partitions_table: str, partitions: int) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {partitions_table} (
+                partition_no INTEGER PRIMARY KEY,
+                min_uprn BIGINT,
+                max_uprn BIGINT,
+                completed_at TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(f"SELECT COUNT(1) FROM {partitions_table}")
+        if cursor.fetchone()[0] == 0:
+            print(f"{time.ctime()} - Splitting addresses into {partitions} partitions")
+            cursor.execute(
+                f"""
+                INSERT INTO {partitions_table} (partition_no, min_uprn, max_uprn)
+                    SELECT partition_no, MIN(uprn), MAX(uprn)
+                    FROM (
+                        SELECT uprn, ntile(%s) OVER (ORDER BY uprn) AS partition_no
+                        FROM uprn_addresses
+                    ) partitioned
+                    GROUP BY 1
+                """,
+                (partitions,)
+            )
+        connection.commit()
+
+# Runs map_partition for each incomplete partition in partitions_table, on workers concurrent connections, outputting
+# progress as each partition completes. The partitions are recorded against the stage calling this.
+def map_uprn_address_partitions(connection, partitions_table: str, map_partition, workers: int, description: str) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT partition_no, min_uprn, max_uprn
+            FROM {partitions_table}
+            WHERE completed_at IS NULL
+            ORDER BY partition_no
+            """
+        )
+        pending_partitions = cursor.fetchall()
+        cursor.execute(f"SELECT COUNT(1) FROM {partitions_table}")
+        total_partitions = cursor.fetchone()[0]
+
+    completed_partitions = total_partitions - len(pending_partitions)
+    print(f"{time.ctime()} - {description}: {completed_partitions}/{total_partitions} partitions already complete")
+
+    # The work happens in the database, so threads are enough to keep several connections busy
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(metrics.in_current_stage(map_partition), *partition) for partition in pending_partitions]
+        for future in as_completed(futures):
+            future.result()
+            completed_partitions += 1
+            print(f"{time.ctime()} - Completed {completed_partitions}/{total_partitions} partitions", flush=True)
+
+def create_uprn_address_constituency_partitions(connection, partitions: int) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uprn_address_to_constituency (
+                uprn BIGINT,
+                constituency_code VARCHAR
+            )
+            """
+        )
+        connection.commit()
+
+    create_uprn_address_partitions(connection, 'uprn_address_to_constituency_partitions', partitions)
+
+# Splits the constituency polygons into pieces of at most 256 vertices, so each point-in-polygon test is against a small
+# polygon, and their boundary lines into pieces of at most 256 vertices for create_uprn_interior_postcodes. Both tables
+# are owned by the subdivided_constituencies stage, and re-created from scratch whenever it runs.
+def create_subdivided_constituencies(connection) -> None:
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Creating subdivided constituency polygons and spatial indexes")
+        cursor.execute("DROP TABLE IF EXISTS parl_constituencies_2025_subdivided")
+        cursor.execute(
+            """
+            CREATE TABLE parl_constituencies_2025_subdivided AS
+                SELECT short_code, ST_Subdivide(geom, 256) AS geom
+                FROM parl_constituencies_2025
+            """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX idx_parl_constituencies_2025_subdivided_on_geom
+            ON parl_constituencies_2025_subdivided USING GIST (geom)
+            """
+        )
+        # Addresses on the edge of a piece are looked up in the whole polygons by code
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_parl_constituencies_2025_on_short_code ON parl_constituencies_2025 (short_code)"
+        )
+        cursor.execute("ANALYZE parl_constituencies_2025_subdivided")
+
+        print(f"{time.ctime()} - Creating subdivided constituency boundary lines")
+        cursor.execute("DROP TABLE IF EXISTS parl_constituencies_2025_boundary_lines")
+        cursor.execute(
+            """
+            CREATE TABLE parl_constituencies_2025_boundary_lines AS
+                SELECT short_code, ST_Subdivide(ST_Boundary(geom), 256) AS geom
+                FROM parl_constituencies_2025
+            """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX idx_parl_constituencies_2025_boundary_lines_on_geom
+            ON parl_constituencies_2025_boundary_lines USING GIST (geom)
+            """
+        )
+        cursor.execute("ANALYZE parl_constituencies_2025_boundary_lines")
+        connection.commit()
+
+# Boundary-distance pruning. Most postcodes sit well inside a single constituency, so testing each of their addresses
+# against the constituency polygons is wasted work. A postcode's extent is the bounding box of its addresses, expanded
+# by PRUNING_MARGIN_DEGREES. If the extent doesn't touch any constituency boundary line, every address in it is in the
+# same constituency (or outside them all) as the centre of the extent, so a single point-in-polygon test assigns the
+# whole postcode. These 'interior' postcodes are recorded in uprn_interior_postcodes, and map_uprn_address_partition
+# only joins the remaining near-boundary addresses against the polygons - giving exactly the same mapping.
+def create_uprn_interior_postcodes(connection) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS uprn_postcode_extents")
+        cursor.execute("DROP TABLE IF EXISTS uprn_interior_postcodes")
+
+        print(f"{time.ctime()} - Calculating the extent of every postcode's addresses")
+        metrics.execute_sql(
+            cursor,
+            'uprn_postcode_extents',
+            """
+            CREATE TABLE uprn_postcode_extents AS
+                SELECT
+                    postcode,
+                    COUNT(1) AS address_count,
+                    ST_SetSRID(ST_Expand(ST_Extent(centroid), %s)::geometry, 4326) AS extent
+                FROM uprn_addresses
+                WHERE postcode IS NOT NULL
+                AND centroid IS NOT NULL
+                GROUP BY postcode
+            """,
+            (PRUNING_MARGIN_DEGREES,)
+        )
+
+        # Like map_uprn_address_partition, the centre is tested against the subdivided polygons - with a row for each
+        # constituency containing it, and a NULL constituency if none do
+        print(f"{time.ctime()} - Finding postcodes away from every constituency boundary")
+        metrics.execute_sql(
+            cursor,
+            'uprn_interior_postcodes',
+            """
+            CREATE TABLE uprn_interior_postcodes AS
+                SELECT DISTINCT e.postcode, pcon.short_code AS constituency_code
+                FROM uprn_postcode_extents e
+                LEFT JOIN parl_constituencies_2025_subdivided pcon
+                ON ST_Intersects(ST_Centroid(e.extent), pcon.geom)
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM parl_constituencies_2025_boundary_lines line
+                    WHERE ST_Intersects(e.extent, line.geom)
+                )
+            """
+        )
+        cursor.execute("CREATE INDEX idx_uprn_interior_postcodes_on_postcode ON uprn_interior_postcodes (postcode)")
+        cursor.execute("ANALYZE uprn_interior_postcodes")
+
+        cursor.execute(
+            """
+            SELECT
+                (SELECT COUNT(1) FROM uprn_addresses),
+                COUNT(1),
+                COALESCE(SUM(e.address_count), 0)
+            FROM uprn_postcode_extents e
+            WHERE e.postcode IN (SELECT postcode FROM uprn_interior_postcodes)
+            """
+        )
+        total_addresses, interior_postcodes, pruned_addresses = cursor.fetchone()
+        connection.commit()
+
+    pruned_share = pruned_addresses / total_addresses if total_addresses else 0.0
+    print(
+        f"{time.ctime()} - Pruned {pruned_addresses:,} of {total_addresses:,} addresses ({pruned_share:.1%}), in "
+        f"{interior_postcodes:,} postcodes away from every constituency boundary"
+    )
+    metrics.add_rows(rows_in=total_addresses, rows_out=interior_postcodes)
+    metrics.add_stat('addresses', total_addresses)
+    metrics.add_stat('pruned_addresses', pruned_addresses)
+    metrics.add_stat('pruned_share', pruned_share)
+    metrics.add_stat('interior_postcodes', interior_postcodes)
+
+# Maps a single partition of addresses on its own connection from the pool. The mapped rows and the partition's completed_at are
+# committed in the same transaction, so an interrupted partition is simply run again from scratch.
+def map_uprn_address_partition(partition_no: int, min_uprn: int, max_uprn: int) -> None:
+    with db.pool().connection() as conn:
+        with conn.cursor() as cursor:
+            # Addresses in interior postcodes take their postcode's constituency (see create_uprn_interior_postcodes).
+            # Addresses without a centroid never are, as they aren't in any constituency.
+            metrics.execute_sql(
+                cursor,
+                'uprn_address_to_constituency_partition_interior',
+                """
+                INSERT INTO uprn_address_to_constituency (uprn, constituency_code)
+                    SELECT a.uprn, interior.constituency_code
+                    FROM uprn_addresses a
+                    JOIN uprn_interior_postcodes interior
+                    ON a.postcode = interior.postcode
+                    WHERE a.uprn BETWEEN %s AND %s
+                    AND a.centroid IS NOT NULL
+                """,
+                (min_uprn, max_uprn)
+            )
+            # The same result as create_uprn_address_constituency_map's ST_Within join against the whole polygons. The
+            # pieces an address intersects are found with the spatial index, and an address within a piece is within
+            # its constituency. An address on an edge created by ST_Subdivide isn't within either piece, so it's
+            # tested against the whole constituency - while an address on a constituency boundary isn't within
+            # either constituency, so it's mapped to NULL, as it always has been.
+            metrics.execute_sql(
+                cursor,
+                'uprn_address_to_constituency_partition',
+                """
+                INSERT INTO uprn_address_to_constituency (uprn, constituency_code)
+                    SELECT a.uprn, within.short_code
+                    FROM uprn_addresses a
+                    LEFT JOIN LATERAL (
+                        SELECT DISTINCT piece.short_code
+                        FROM parl_constituencies_2025_subdivided piece
+                        JOIN parl_constituencies_2025 pcon
+                        ON pcon.short_code = piece.short_code
+                        WHERE ST_Intersects(a.centroid, piece.geom)
+                        AND (ST_Within(a.centroid, piece.geom) OR ST_Within(a.centroid, pcon.geom))
+                    ) within
+                    ON true
+                    WHERE a.uprn BETWEEN %s AND %s
+                    AND (
+                        a.centroid IS NULL
+                        OR NOT EXISTS (SELECT 1 FROM uprn_interior_postcodes interior WHERE interior.postcode = a.postcode)
+                    )
+                """,
+                (min_uprn, max_uprn)
+            )
+            cursor.execute(
+                "UPDATE uprn_address_to_constituency_partitions SET completed_at = NOW() WHERE partition_no = %s",
+                (partition_no,)
+            )
+        conn.commit()
+
+# An alternative to create_uprn_address_constituency_map which splits the work into partitions of addresses, which are
+# mapped concurrently on separate connections. Progress is output as each partition completes, and the run can be
+# resumed if interrupted.
+def create_uprn_address_constituency_map_in_partitions(
+    connection,
+    partitions: int = SPATIAL_JOIN_PARTITIONS,
+    workers: int = SPATIAL_JOIN_WORKERS
+) -> None:
+    create_uprn_address_constituency_partitions(connection, partitions)
+    map_uprn_address_partitions(
+        connection,
+        'uprn_address_to_constituency_partitions',
+        map_uprn_address_partition,
+        workers,
+        'Mapping addresses to constituencies'
+    )
+
 def generate_uprn_postcode_to_constituency_mappings(connection) -> None:
     with connection.cursor() as cursor:
         print(f"{time.ctime()} - Creating UPRN postcode to constituencies mappings")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'uprn_postcode_to_constituency',
             """
             CREATE TABLE uprn_postcode_to_constituency AS (
                 SELECT
@@ -145,10 +538,211 @@ def generate_uprn_postcode_to_constituency_mappings(connection) -> None:
         )
         connection.commit()
 
-##### ONSPD helper methods #####
+##### UPRN incremental refresh #####
+
+# Loads a new release of the UPRN files into a staging table with the same columns as uprn_addresses. The co-ordinates
+# are calculated on the client, as they are for uprn_addresses in either load mode, so the added & moved addresses
+# are mapped from exactly the centroids a full rebuild would give them.
+def load_uprn_address_staging_table(connection, file_paths: List[str]) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS uprn_addresses_staging")
+        cursor.execute("CREATE UNLOGGED TABLE uprn_addresses_staging (LIKE uprn_addresses)")
+        connection.commit()
+
+    invalid_postcodes = copy_addresses_from_uprn_files_in_parallel(file_paths, with_coords=True, table='uprn_addresses_staging')
+    print_invalid_uprn_postcodes(invalid_postcodes)
+
+    with connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE uprn_addresses_staging ADD PRIMARY KEY (uprn)")
+        cursor.execute("ANALYZE uprn_addresses_staging")
+        connection.commit()
+
+# Compares the staged release with uprn_addresses, recording every UPRN which has been added, removed, moved (ie. its
+# co-ordinates have changed), or had its postcode changed
+def find_uprn_address_changes(connection) -> None:
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Comparing the new UPRN release with the loaded addresses")
+        cursor.execute("DROP TABLE IF EXISTS uprn_address_changes")
+        metrics.execute_sql(
+            cursor,
+            'uprn_address_changes',
+            """
+            CREATE UNLOGGED TABLE uprn_address_changes AS
+                SELECT
+                    COALESCE(new.uprn, old.uprn) AS uprn,
+                    old.postcode AS old_postcode,
+                    new.postcode AS new_postcode,
+                    CASE
+                        WHEN old.uprn IS NULL THEN 'added'
+                        WHEN new.uprn IS NULL THEN 'removed'
+                        WHEN old.easting IS DISTINCT FROM new.easting OR old.northing IS DISTINCT FROM new.northing THEN 'moved'
+                        ELSE 'postcode_changed'
+                    END AS change
+                FROM uprn_addresses old
+                FULL OUTER JOIN uprn_addresses_staging new
+                ON old.uprn = new.uprn
+                WHERE old.uprn IS NULL
+                OR new.uprn IS NULL
+                OR old.postcode IS DISTINCT FROM new.postcode
+                OR old.easting IS DISTINCT FROM new.easting
+                OR old.northing IS DISTINCT FROM new.northing
+            """
+        )
+        cursor.execute("CREATE INDEX idx_uprn_address_changes_on_uprn ON uprn_address_changes (uprn)")
+        cursor.execute("ANALYZE uprn_address_changes")
+        cursor.execute("SELECT change, COUNT(1) FROM uprn_address_changes GROUP BY 1 ORDER BY 1")
+        for change, count in cursor.fetchall():
+            print(f"{time.ctime()} - Found {count} {change} addresses")
+        connection.commit()
+
+# Applies the recorded changes to uprn_addresses, uprn_address_to_constituency and uprn_postcode_to_constituency (and
+# the boundary-distance pruning tables, if they exist), using the subdivided constituencies from the last full run. Only added & moved addresses are mapped to a constituency, and
+# only postcodes containing a changed address are re-aggregated. Everything is applied in a single transaction, so the
+# tables are never seen half-refreshed.
+def apply_uprn_address_changes(connection) -> None:
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Updating changed addresses")
+        cursor.execute("DELETE FROM uprn_addresses a USING uprn_address_changes c WHERE a.uprn = c.uprn")
+        cursor.execute(
+            """
+            INSERT INTO uprn_addresses
+                SELECT s.*
+                FROM uprn_addresses_staging s
+                JOIN uprn_address_changes c
+                ON s.uprn = c.uprn
+                WHERE c.change <> 'removed'
+            """
+        )
+
+        print(f"{time.ctime()} - Mapping added and moved addresses to constituencies")
+        cursor.execute(
+            """
+            DELETE FROM uprn_address_to_constituency map
+            USING uprn_address_changes c
+            WHERE map.uprn = c.uprn
+            AND c.change IN ('removed', 'moved')
+            """
+        )
+        # Uses the same join as map_uprn_address_partition
+        metrics.execute_sql(
+            cursor,
+            'uprn_address_to_constituency_changes',
+            """
+            INSERT INTO uprn_address_to_constituency (uprn, constituency_code)
+                SELECT a.uprn, within.short_code
+                FROM uprn_address_changes c
+                JOIN uprn_addresses a
+                ON a.uprn = c.uprn
+                LEFT JOIN LATERAL (
+                    SELECT DISTINCT piece.short_code
+                    FROM parl_constituencies_2025_subdivided piece
+                    JOIN parl_constituencies_2025 pcon
+                    ON pcon.short_code = piece.short_code
+                    WHERE ST_Intersects(a.centroid, piece.geom)
+                    AND (ST_Within(a.centroid, piece.geom) OR ST_Within(a.centroid, pcon.geom))
+                ) within
+                ON true
+                WHERE c.change IN ('added', 'moved')
+            """
+        )
+
+        print(f"{time.ctime()} - Recalculating the constituency proportions of affected postcodes")
+        cursor.execute(
+            """
+            CREATE TEMPORARY TABLE affected_postcodes ON COMMIT DROP AS
+                SELECT old_postcode AS postcode FROM uprn_address_changes WHERE old_postcode IS NOT NULL
+                UNION
+                SELECT new_postcode AS postcode FROM uprn_address_changes WHERE new_postcode IS NOT NULL
+            """
+        )
+        cursor.execute(
+            "DELETE FROM uprn_postcode_to_constituency map USING affected_postcodes p WHERE map.postcode = p.postcode"
+        )
+        # The same aggregation as generate_uprn_postcode_to_constituency_mappings, limited to the affected postcodes
+        metrics.execute_sql(
+            cursor,
+            'uprn_postcode_to_constituency_changes',
+            """
+            INSERT INTO uprn_postcode_to_constituency
+                SELECT
+                    a.postcode,
+                    map.constituency_code,
+                    counts.postcode_address_count,
+                    COUNT(1) AS postcode_constituency_address_count,
+                    ( COUNT(1) * 100.0 / counts.postcode_address_count ) as proportion_of_addresses
+                FROM uprn_addresses a
+                JOIN uprn_address_to_constituency map
+                ON a.uprn = map.uprn
+                JOIN (
+                    SELECT postcode, COUNT(1) AS postcode_address_count
+                    FROM uprn_addresses
+                    WHERE postcode IN (SELECT postcode FROM affected_postcodes)
+                    GROUP BY 1
+                ) counts
+                ON a.postcode = counts.postcode
+                GROUP BY 1,2,3
+                ORDER BY 1,2
+            """
+        )
+        cursor.execute("SELECT COUNT(1) FROM affected_postcodes")
+        print(f"{time.ctime()} - Recalculated {cursor.fetchone()[0]} postcodes")
+
+        cursor.execute("SELECT to_regclass('uprn_interior_postcodes')")
+        if cursor.fetchone()[0] is not None:
+            refresh_uprn_interior_postcodes(cursor)
+
+        cursor.execute("DROP TABLE uprn_address_changes")
+        cursor.execute("DROP TABLE uprn_addresses_staging")
+        connection.commit()
 
-def find_onspd_csv_files() -> List[str]:
-    return glob.glob('data/2024-01-28/input/ONS_postcode_directory/*.csv')
+# Recalculates the extents & interior status of the affected postcodes, like create_uprn_interior_postcodes, so the
+# pruning tables stay in step with uprn_addresses and the stage doesn't need to be re-run over every address
+def refresh_uprn_interior_postcodes(cursor) -> None:
+    print(f"{time.ctime()} - Recalculating the extents of affected postcodes")
+    cursor.execute("DELETE FROM uprn_postcode_extents e USING affected_postcodes p WHERE e.postcode = p.postcode")
+    cursor.execute("DELETE FROM uprn_interior_postcodes i USING affected_postcodes p WHERE i.postcode = p.postcode")
+    metrics.execute_sql(
+        cursor,
+        'uprn_postcode_extents_changes',
+        """
+        INSERT INTO uprn_postcode_extents
+            SELECT
+                postcode,
+                COUNT(1) AS address_count,
+                ST_SetSRID(ST_Expand(ST_Extent(centroid), %s)::geometry, 4326) AS extent
+            FROM uprn_addresses
+            WHERE postcode IN (SELECT postcode FROM affected_postcodes)
+            AND centroid IS NOT NULL
+            GROUP BY postcode
+        """,
+        (PRUNING_MARGIN_DEGREES,)
+    )
+    metrics.execute_sql(
+        cursor,
+        'uprn_interior_postcodes_changes',
+        """
+        INSERT INTO uprn_interior_postcodes
+            SELECT DISTINCT e.postcode, pcon.short_code AS constituency_code
+            FROM uprn_postcode_extents e
+            LEFT JOIN parl_constituencies_2025_subdivided pcon
+            ON ST_Intersects(ST_Centroid(e.extent), pcon.geom)
+            WHERE e.postcode IN (SELECT postcode FROM affected_postcodes)
+            AND NOT EXISTS (
+                SELECT 1
+                FROM parl_constituencies_2025_boundary_lines line
+                WHERE ST_Intersects(e.extent, line.geom)
+            )
+        """
+    )
+
+# Refreshes the UPRN tables from a new release of the UPRN files, doing work in proportion to the number of changed
+# addresses rather than rebuilding every table from scratch
+def refresh_uprn_tables_incrementally(connection, file_paths: List[str]) -> None:
+    load_uprn_address_staging_table(connection, file_paths)
+    find_uprn_address_changes(connection)
+    apply_uprn_address_changes(connection)
+
+##### ONSPD helper methods #####
 
 def create_onspd_postcodes_table(connection) -> None:
     with connection.cursor() as cursor:
@@ -165,42 +759,50 @@ def create_onspd_postcodes_table(connection) -> None:
         )
         connection.commit()
 
-def copy_postcodes_from_onspd_file(file_path: str, connection) -> None:
-    terminated_postcodes = []
+# With with_coords=True the centroid is written as part of the COPY, so set_onspd_postcode_coords doesn't need to be
+# run afterwards.
+def copy_postcodes_from_onspd_file(file_path: str, connection, with_coords: bool = False, table: str = 'onspd_postcodes') -> None:
+    terminated_postcode_count = 0
     invalid_postcodes = []
+    columns = "postcode, latitude, longitude, centroid" if with_coords else "postcode, latitude, longitude"
 
     with connection.cursor() as cursor:
-        with cursor.copy("COPY onspd_postcodes (postcode, latitude, longitude) FROM STDIN") as copy:
-            line_count = get_file_line_count(file_path)
-            total_chunks = ceildiv(line_count, CHUNK_SIZE)
+        with cursor.copy(f"COPY {table} ({columns}) FROM STDIN {COPY_CSV_OPTIONS}") as copy:
+            with open(file_path, 'rb') as file, read_csv(file, chunksize=CHUNK_SIZE, dtype={'pcds':str, 'doterm':str}) as reader:
+                progress = metrics.FileProgress(file_path, file)
+                for chunk in reader:
+                    postcodes = Postcode.unit_postcode_series(chunk['pcds'])
+                    terminated = chunk['doterm'].fillna('') != ''
+                    invalid = ~terminated & postcodes.isna()
+                    terminated_postcode_count += int(terminated.sum())
+                    invalid_postcodes.extend(chunk['pcds'][invalid])
 
-            print_loading_header()
+                    included = ~terminated & ~invalid
+                    onspd_postcodes = pandas.DataFrame({
+                        'postcode': postcodes[included],
+                        'latitude': chunk['lat'][included],
+                        'longitude': chunk['long'][included],
+                    })
+                    if with_coords:
+                        onspd_postcodes['centroid'] = ewkb_points_hex(onspd_postcodes['longitude'], onspd_postcodes['latitude'], 4326)
+                    copy_dataframe(copy, onspd_postcodes)
+                    metrics.add_rows(rows_in=len(chunk), rows_out=len(onspd_postcodes))
+                    progress.update(len(chunk))
 
-            # keep_default_na=False prevents pandas from translating empty strings to 'nan'
-            with pandas.read_csv(file_path, chunksize=CHUNK_SIZE, dtype={'pcds':str, 'doterm':str}, keep_default_na=False) as reader:
-                chunk_no = 0
-                for chunk in reader:
-                    print_loading_dot(chunk_no, total_chunks)
-                    chunk_no += 1
-                    for _index, row in chunk.iterrows():
-                        postcode = Postcode(row['pcds'])
-                        if row['doterm'] is not None and row['doterm'] != '':
-                            terminated_postcodes.append(row['pcds'])
-                        elif not postcode.valid():
-                            invalid_postcodes.append(row['pcds'])
-                        else:
-                            copy.write_row((postcode.unit_postcode(), row['lat'], row['long']))
+                progress.finish()
 
         connection.commit()
     
-    print(f"{time.ctime()} - Skipped {len(terminated_postcodes)} terminated postcodes.")
+    print(f"{time.ctime()} - Skipped {terminated_postcode_count} terminated postcodes.")
     for p in invalid_postcodes:
         print(f"{time.ctime()} - Skipped invalid postcode: [{p}]")
 
 def set_onspd_postcode_coords(connection) -> None:
     with connection.cursor() as cursor:
         print(f"{time.ctime()} - Updating centroid of all postcodes")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'onspd_postcodes_centroids',
             """
             UPDATE onspd_postcodes
             SET centroid = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)
@@ -212,7 +814,9 @@ def set_onspd_postcode_coords(connection) -> None:
 def create_onspd_postcode_constituency_map(connection) -> None:
     with connection.cursor() as cursor:
         print(f"{time.ctime()} - Creating postcodes to constituency mapping for all postcodes")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'onspd_postcode_to_constituency',
             """
             CREATE TABLE onspd_postcode_to_constituency AS (
                 SELECT pc.postcode, pcon.short_code AS constituency_code
@@ -225,7 +829,7 @@ def create_onspd_postcode_constituency_map(connection) -> None:
 
 ##### mySociety helper methods #####
 
-def load_mysociety_constituencies(connection) -> None:
+def load_mysociety_constituencies(connection, file_path: str = MYSOCIETY_POSTCODES_FILE) -> None:
     invalid_postcodes = []
 
     with connection.cursor() as cursor:
@@ -239,15 +843,16 @@ def load_mysociety_constituencies(connection) -> None:
             """
         )
 
-        file_path = "data/2024-01-28/input/mysociety_2025_postcodes_with_constituencies.csv"
-        with cursor.copy("COPY mysociety_postcode_to_constituency (postcode, constituency_code) FROM STDIN") as copy:
-            # keep_default_na=False prevents pandas from translating empty strings to 'nan'
-            csv_file = pandas.read_csv(file_path, dtype={'postcode':str, 'short_code':str}, keep_default_na=False)
-            for _index, line in csv_file.iterrows():
-                postcode = Postcode(line['postcode'])
-                if not postcode.valid():
-                    invalid_postcodes.append(line['postcode'])
-                copy.write_row((postcode.unit_postcode(), line["short_code"] or None))
+        with cursor.copy(f"COPY mysociety_postcode_to_constituency (postcode, constituency_code) FROM STDIN {COPY_CSV_OPTIONS}") as copy:
+            csv_file = read_csv(file_path, dtype={'postcode':str, 'short_code':str})
+            postcodes = Postcode.unit_postcode_series(csv_file['postcode'])
+            invalid_postcodes.extend(csv_file['postcode'][postcodes.isna()])
+            # Empty short codes are loaded as NULL, as they always have been
+            copy_dataframe(copy, pandas.DataFrame({
+                'postcode': postcodes,
+                'constituency_code': csv_file['short_code'].where(csv_file['short_code'] != ''),
+            }))
+            metrics.add_rows(rows_in=len(csv_file), rows_out=len(csv_file))
 
         connection.commit()
     
@@ -259,7 +864,9 @@ def load_mysociety_constituencies(connection) -> None:
 def create_combo_constituency_map(connection) -> None:
     with connection.cursor() as cursor:
         print(f"{time.ctime()} - Creating postcode to constituency mapping combining all sources")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'combined_postcode_to_constituency',
             """
             CREATE TABLE combined_postcode_to_constituency AS (
                 SELECT
@@ -297,7 +904,9 @@ def create_combo_constituency_map(connection) -> None:
 def create_multi_column_constituency_map(connection) -> None:
     with connection.cursor() as cursor:
         print(f"{time.ctime()} - Creating multi-column postcode to constituency mapping combining all sources")
-        cursor.execute(
+        metrics.execute_sql(
+            cursor,
+            'combined_postcode_to_constituency_multicol',
             """
             CREATE TABLE combined_postcode_to_constituency_multicol AS (
                 SELECT
@@ -354,43 +963,514 @@ def create_multi_column_constituency_map(connection) -> None:
         )
         connection.commit()
 
-##### MAIN #####
+##### Multi-layer boundary assignment #####
 
-def main() -> None:
-    with psycopg.connect('user=local password=password host=localhost port=54321 dbname=gis') as conn:
-        # # UPRN Processing
-        # uprn_files = find_uprn_csv_files()
-        # print(f"{time.ctime()} - Found {len(uprn_files)} ONS UPRN CSV files")
+# The multi-layer stages assign every UPRN address & ONSPD postcode to a boundary in each of BOUNDARY_LAYERS in a single
+# spatial join, rather than a join per layer. Every layer's polygons are subdivided into one table with one spatial
+# index, so locating a point is a single index probe which finds its boundary in every layer at once - adding a layer
+# adds index entries (and a few more matches per point), rather than another pass over the tens of millions of points.
+
+# Subdivides every layer's polygons into boundary_layer_pieces (as create_subdivided_constituencies does for the
+# constituencies), transformed to WGS84 to match the address & postcode centroids
+def create_boundary_layer_pieces(connection, layers: List[BoundaryLayer] = BOUNDARY_LAYERS) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TABLE boundary_layers (layer VARCHAR(50) PRIMARY KEY)")
+        cursor.execute(
+            """
+            CREATE TABLE boundary_layer_pieces (
+                layer VARCHAR(50),
+                boundary_code VARCHAR,
+                geom GEOMETRY
+            )
+            """
+        )
+        for layer in layers:
+            print(f"{time.ctime()} - Creating subdivided {layer.name} polygons from {layer.table}")
+            cursor.execute("INSERT INTO boundary_layers (layer) VALUES (%s)", (layer.name,))
+            metrics.execute_sql(
+                cursor,
+                'boundary_layer_pieces',
+                f"""
+                INSERT INTO boundary_layer_pieces (layer, boundary_code, geom)
+                    SELECT %s, {layer.code_column}, ST_Subdivide(ST_Transform(geom, 4326), 256)
+                    FROM {layer.table}
+                """,
+                (layer.name,)
+            )
+
+        cursor.execute("CREATE INDEX idx_boundary_layer_pieces_on_geom ON boundary_layer_pieces USING GIST (geom)")
+        cursor.execute("ANALYZE boundary_layer_pieces")
+        connection.commit()
+
+# Maps a single partition of addresses to their boundaries in every layer, on its own connection like
+# map_uprn_address_partition. There's a single row per address & layer - an address on the line between two boundaries
+# is given the one with the lowest code - and addresses outside every boundary of a layer have no row for that layer.
+def map_uprn_address_partition_to_boundaries(partition_no: int, min_uprn: int, max_uprn: int) -> None:
+    with db.pool().connection() as conn:
+        with conn.cursor() as cursor:
+            metrics.execute_sql(
+                cursor,
+                'uprn_address_to_boundary_partition',
+                """
+                INSERT INTO uprn_address_to_boundary (uprn, layer, boundary_code)
+                    SELECT DISTINCT ON (a.uprn, piece.layer) a.uprn, piece.layer, piece.boundary_code
+                    FROM uprn_addresses a
+                    JOIN boundary_layer_pieces piece
+                    ON ST_Intersects(a.centroid, piece.geom)
+                    WHERE a.uprn BETWEEN %s AND %s
+                    ORDER BY a.uprn, piece.layer, piece.boundary_code
+                """,
+                (min_uprn, max_uprn)
+            )
+            cursor.execute(
+                "UPDATE uprn_address_to_boundary_partitions SET completed_at = NOW() WHERE partition_no = %s",
+                (partition_no,)
+            )
+        conn.commit()
+
+def create_uprn_address_boundary_map_in_partitions(
+    connection,
+    partitions: int = SPATIAL_JOIN_PARTITIONS,
+    workers: int = SPATIAL_JOIN_WORKERS
+) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uprn_address_to_boundary (
+                uprn BIGINT,
+                layer VARCHAR(50),
+                boundary_code VARCHAR
+            )
+            """
+        )
+        connection.commit()
+
+    create_uprn_address_partitions(connection, 'uprn_address_to_boundary_partitions', partitions)
+    map_uprn_address_partitions(
+        connection,
+        'uprn_address_to_boundary_partitions',
+        map_uprn_address_partition_to_boundaries,
+        workers,
+        'Mapping addresses to boundaries in every layer'
+    )
+
+def create_onspd_postcode_boundary_map(connection) -> None:
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Creating postcode to boundary mapping for all postcodes")
+        metrics.execute_sql(
+            cursor,
+            'onspd_postcode_to_boundary',
+            """
+            CREATE TABLE onspd_postcode_to_boundary AS (
+                SELECT DISTINCT ON (pc.postcode, piece.layer) pc.postcode, piece.layer, piece.boundary_code
+                FROM onspd_postcodes pc
+                JOIN boundary_layer_pieces piece
+                ON ST_Intersects(pc.centroid, piece.geom)
+                ORDER BY pc.postcode, piece.layer, piece.boundary_code
+            )
+            """
+        )
+        connection.commit()
+
+# Creates postcode_to_boundary, with a row per (postcode, layer, boundary) and the proportion of the postcode in the
+# boundary. Where a postcode has UPRN addresses, the proportion is the proportion of its addresses in the boundary - with
+# an 'UNKNOWN' boundary for addresses outside every boundary in the layer, so each postcode's proportions in a layer
+# sum to 1. Otherwise the ONSPD centroid's boundary has a proportion of 1.
+def generate_postcode_to_boundary_mappings(connection) -> None:
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Creating UPRN postcode to boundary mappings")
+        metrics.execute_sql(
+            cursor,
+            'uprn_postcode_to_boundary',
+            """
+            CREATE TABLE uprn_postcode_to_boundary AS (
+                SELECT
+                    a.postcode,
+                    layer.layer,
+                    map.boundary_code,
+                    counts.postcode_address_count,
+                    COUNT(1) AS postcode_boundary_address_count,
+                    ( COUNT(1) * 1.0 / counts.postcode_address_count ) AS proportion_of_addresses
+                FROM uprn_addresses a
+                CROSS JOIN boundary_layers layer
+                LEFT JOIN uprn_address_to_boundary map
+                ON a.uprn = map.uprn AND map.layer = layer.layer
+                JOIN (
+                    SELECT postcode, COUNT(1) AS postcode_address_count
+                    FROM uprn_addresses
+                    GROUP BY 1
+                ) counts
+                ON a.postcode = counts.postcode
+                GROUP BY 1,2,3,4
+            )
+            """
+        )
+
+        print(f"{time.ctime()} - Creating postcode to boundary mapping combining UPRN & ONSPD")
+        metrics.execute_sql(
+            cursor,
+            'postcode_to_boundary',
+            """
+            CREATE TABLE postcode_to_boundary AS (
+                SELECT
+                    postcode,
+                    layer,
+                    COALESCE(boundary_code, 'UNKNOWN') AS boundary_code,
+                    proportion_of_addresses AS proportion,
+                    'UPRN' AS source
+                FROM uprn_postcode_to_boundary
+
+                UNION ALL
+
+                SELECT
+                    onspd.postcode,
+                    onspd.layer,
+                    onspd.boundary_code,
+                    1.0 AS proportion,
+                    'ONSPD' AS source
+                FROM onspd_postcode_to_boundary onspd
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM uprn_postcode_to_boundary uprn
+                    WHERE uprn.postcode = onspd.postcode
+                    AND uprn.layer = onspd.layer
+                )
+            )
+            """
+        )
+        cursor.execute("CREATE INDEX idx_postcode_to_boundary_on_postcode_layer ON postcode_to_boundary (postcode, layer)")
+        cursor.execute("ANALYZE postcode_to_boundary")
+        connection.commit()
+
+##### Pipeline stages #####
+
+def load_uprn_addresses(connection) -> None:
+    uprn_files = find_uprn_csv_files()
+    print(f"{time.ctime()} - Found {len(uprn_files)} ONS UPRN CSV files")
+
+    create_uprn_address_table(connection)
+    print_invalid_uprn_postcodes(copy_addresses_from_uprn_files_in_parallel(sorted(uprn_files), with_coords=True))
+
+    # The spatial index is built here, by the stage which owns the table, rather than by the spatial join stages
+    # downstream, which can run concurrently
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Creating spatial index on uprn_addresses")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_uprn_addresses_on_centroid ON uprn_addresses USING GIST (centroid)")
+        cursor.execute("ANALYZE uprn_addresses")
+    connection.commit()
+
+def load_onspd_postcodes(connection) -> None:
+    onspd_files = find_onspd_csv_files()
+    print(f"{time.ctime()} - Found {len(onspd_files)} ONSPD CSV files")
+
+    create_onspd_postcodes_table(connection)
+    for file_path in sorted(onspd_files):
+        print(f"{time.ctime()} - Loading data from {file_path}")
+        copy_postcodes_from_onspd_file(file_path, connection, with_coords=True)
+
+##### Bulk-load mode #####
+
+# Bulk-load alternatives to load_uprn_addresses & load_onspd_postcodes. Rather than copying into a table whose primary
+# key is maintained for every row, the rows are copied into an UNLOGGED staging table without any indexes, the final
+# (UNLOGGED) table is built from it with a single CREATE TABLE AS, and then the primary key & spatial index are built
+# once, over the whole table. The co-ordinates are calculated on the client as the rows are copied, exactly as they are
+# by load_uprn_addresses & load_onspd_postcodes, so either mode builds the same rows.
+
+def load_uprn_addresses_in_bulk(connection) -> None:
+    uprn_files = find_uprn_csv_files()
+    print(f"{time.ctime()} - Found {len(uprn_files)} ONS UPRN CSV files")
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS uprn_addresses_raw")
+        cursor.execute(
+            """
+            CREATE UNLOGGED TABLE uprn_addresses_raw (
+                uprn BIGINT,
+                postcode VARCHAR(10),
+                northing INTEGER,
+                easting INTEGER,
+                longitude DECIMAL(18,6),
+                latitude DECIMAL(18,6),
+                centroid GEOMETRY
+            )
+            """
+        )
+        connection.commit()
+
+    print_invalid_uprn_postcodes(
+        copy_addresses_from_uprn_files_in_parallel(sorted(uprn_files), with_coords=True, table='uprn_addresses_raw')
+    )
+
+    with connection.cursor() as cursor:
+        # The same column order as create_uprn_address_table
+        print(f"{time.ctime()} - Creating uprn_addresses from the loaded addresses")
+        metrics.execute_sql(
+            cursor,
+            'uprn_addresses_from_raw',
+            """
+            CREATE UNLOGGED TABLE uprn_addresses AS
+                SELECT uprn, postcode, northing, easting, longitude, latitude, centroid
+                FROM uprn_addresses_raw
+            """
+        )
+        cursor.execute("DROP TABLE uprn_addresses_raw")
+
+        print(f"{time.ctime()} - Creating uprn_addresses primary key and spatial index")
+        metrics.execute_sql(cursor, 'uprn_addresses_primary_key', "ALTER TABLE uprn_addresses ADD PRIMARY KEY (uprn)", explain=False)
+        metrics.execute_sql(
+            cursor,
+            'uprn_addresses_centroid_index',
+            "CREATE INDEX idx_uprn_addresses_on_centroid ON uprn_addresses USING GIST (centroid)",
+            explain=False
+        )
+        cursor.execute("ANALYZE uprn_addresses")
+        connection.commit()
+
+def load_onspd_postcodes_in_bulk(connection) -> None:
+    onspd_files = find_onspd_csv_files()
+    print(f"{time.ctime()} - Found {len(onspd_files)} ONSPD CSV files")
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS onspd_postcodes_raw")
+        cursor.execute(
+            """
+            CREATE UNLOGGED TABLE onspd_postcodes_raw (
+                postcode VARCHAR(10),
+                longitude DECIMAL(18,6),
+                latitude DECIMAL(18,6),
+                centroid GEOMETRY
+            )
+            """
+        )
+        connection.commit()
+
+    for file_path in sorted(onspd_files):
+        print(f"{time.ctime()} - Loading data from {file_path}")
+        copy_postcodes_from_onspd_file(file_path, connection, with_coords=True, table='onspd_postcodes_raw')
+
+    with connection.cursor() as cursor:
+        print(f"{time.ctime()} - Creating onspd_postcodes from the loaded postcodes")
+        metrics.execute_sql(
+            cursor,
+            'onspd_postcodes_from_raw',
+            """
+            CREATE UNLOGGED TABLE onspd_postcodes AS
+                SELECT postcode, longitude, latitude, centroid
+                FROM onspd_postcodes_raw
+            """
+        )
+        cursor.execute("DROP TABLE onspd_postcodes_raw")
+
+        print(f"{time.ctime()} - Creating onspd_postcodes primary key and spatial index")
+        metrics.execute_sql(cursor, 'onspd_postcodes_primary_key', "ALTER TABLE onspd_postcodes ADD PRIMARY KEY (postcode)", explain=False)
+        metrics.execute_sql(
+            cursor,
+            'onspd_postcodes_centroid_index',
+            "CREATE INDEX idx_onspd_postcodes_on_centroid ON onspd_postcodes USING GIST (centroid)",
+            explain=False
+        )
+        cursor.execute("ANALYZE onspd_postcodes")
+        connection.commit()
 
-        # create_uprn_address_table(conn)
+# Makes the bulk-loaded tables LOGGED, so they survive a crash (and are replicated). This writes each table to the WAL
+# once, which is still much cheaper than logging every row as it was loaded.
+def set_bulk_loaded_tables_logged(connection) -> None:
+    with connection.cursor() as cursor:
+        for table in BULK_LOADED_TABLES:
+            cursor.execute("SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row = cursor.fetchone()
+            if row is not None and row[0] == 'u':
+                print(f"{time.ctime()} - Setting {table} to LOGGED")
+                metrics.execute_sql(cursor, f"{table}_set_logged", f"ALTER TABLE {table} SET LOGGED", explain=False)
+        connection.commit()
 
-        # for file_path in sorted(uprn_files):
-        #   print(f"{time.ctime()} - Loading data from {file_path}")
-        #   copy_addresses_from_uprn_file(file_path, conn)
+def combine_constituency_maps(connection) -> None:
+    create_combo_constituency_map(connection)
+    create_multi_column_constituency_map(connection)
 
-        # set_uprn_address_coords(conn)
-        # create_uprn_address_constituency_map(conn)
-        # generate_uprn_postcode_to_constituency_mappings(conn)
+# With multi_layer=True the pipeline also assigns postcodes to every layer in BOUNDARY_LAYERS, and generates the
+# postcode to boundary CSV. With bulk_load=True the UPRN & ONSPD tables are loaded in bulk-load mode.
+def build_pipeline(multi_layer: bool = False, bulk_load: bool = False) -> Pipeline:
+    stages = [
+        Stage(
+            'uprn_addresses',
+            load_uprn_addresses_in_bulk if bulk_load else load_uprn_addresses,
+            input_files=find_uprn_csv_files,
+            output_tables=['uprn_addresses'],
+        ),
+        Stage(
+            'subdivided_constituencies',
+            create_subdivided_constituencies,
+            input_files=lambda: [CONSTITUENCY_BOUNDARIES_FILE],
+            output_tables=['parl_constituencies_2025_subdivided', 'parl_constituencies_2025_boundary_lines'],
+        ),
+        Stage(
+            'uprn_interior_postcodes',
+            create_uprn_interior_postcodes,
+            depends_on=['uprn_addresses', 'subdivided_constituencies'],
+            output_tables=['uprn_postcode_extents', 'uprn_interior_postcodes'],
+        ),
+        Stage(
+            'uprn_address_to_constituency',
+            create_uprn_address_constituency_map_in_partitions,
+            depends_on=['uprn_addresses', 'subdivided_constituencies', 'uprn_interior_postcodes'],
+            output_tables=['uprn_address_to_constituency', 'uprn_address_to_constituency_partitions'],
+            resumable=True,
+        ),
+        Stage(
+            'uprn_postcode_to_constituency',
+            generate_uprn_postcode_to_constituency_mappings,
+            depends_on=['uprn_address_to_constituency'],
+            output_tables=['uprn_postcode_to_constituency'],
+        ),
+        Stage(
+            'onspd_postcodes',
+            load_onspd_postcodes_in_bulk if bulk_load else load_onspd_postcodes,
+            input_files=find_onspd_csv_files,
+            output_tables=['onspd_postcodes'],
+        ),
+        Stage(
+            'onspd_postcode_to_constituency',
+            create_onspd_postcode_constituency_map,
+            input_files=lambda: [CONSTITUENCY_BOUNDARIES_FILE],
+            depends_on=['onspd_postcodes'],
+            output_tables=['onspd_postcode_to_constituency'],
+        ),
+        Stage(
+            'mysociety_postcode_to_constituency',
+            load_mysociety_constituencies,
+            input_files=lambda: [MYSOCIETY_POSTCODES_FILE],
+            output_tables=['mysociety_postcode_to_constituency'],
+        ),
+        Stage(
+            'combined_postcode_to_constituency',
+            combine_constituency_maps,
+            depends_on=['uprn_postcode_to_constituency', 'onspd_postcode_to_constituency', 'mysociety_postcode_to_constituency'],
+            output_tables=['combined_postcode_to_constituency', 'combined_postcode_to_constituency_multicol'],
+        ),
+        # All the lookup files are generated from a single pass over the combined table
+        Stage(
+            'postcode_lookup_files',
+            lambda _connection: generate_all.main(),
+            depends_on=['combined_postcode_to_constituency'],
+            output_files=[generate_csv.OUTPUT_FILE, generate_sqlite.OUTPUT_FILE, generate_binary.OUTPUT_FILE],
+        ),
+    ]
+    if not multi_layer:
+        return Pipeline(stages)
 
-        # # ONSPD processing
-        # onspd_files = find_onspd_csv_files()
-        # print(f"{time.ctime()} - Found {len(onspd_files)} ONSPD CSV files")
+    return Pipeline(stages + [
+        Stage(
+            'boundary_layers',
+            create_boundary_layer_pieces,
+            input_files=lambda: sorted({layer.input_file for layer in BOUNDARY_LAYERS}),
+            output_tables=['boundary_layers', 'boundary_layer_pieces'],
+        ),
+        Stage(
+            'uprn_address_to_boundary',
+            create_uprn_address_boundary_map_in_partitions,
+            depends_on=['uprn_addresses', 'boundary_layers'],
+            output_tables=['uprn_address_to_boundary', 'uprn_address_to_boundary_partitions'],
+            resumable=True,
+        ),
+        Stage(
+            'onspd_postcode_to_boundary',
+            create_onspd_postcode_boundary_map,
+            depends_on=['onspd_postcodes', 'boundary_layers'],
+            output_tables=['onspd_postcode_to_boundary'],
+        ),
+        Stage(
+            'postcode_to_boundary',
+            generate_postcode_to_boundary_mappings,
+            depends_on=['uprn_address_to_boundary', 'onspd_postcode_to_boundary'],
+            output_tables=['uprn_postcode_to_boundary', 'postcode_to_boundary'],
+        ),
+        Stage(
+            'postcode_boundary_file',
+            lambda _connection: generate_boundaries.main(),
+            depends_on=['postcode_to_boundary'],
+            output_files=[generate_boundaries.OUTPUT_FILE],
+        ),
+    ])
 
-        # create_onspd_postcodes_table(conn)
+# Used instead of the uprn stages in the pipeline when a new UPRN release should be applied incrementally. Afterwards,
+# the uprn stages are recorded as complete with the new files' fingerprint, so the pipeline only re-runs the stages
+# downstream of them.
+def refresh_uprn_stages_incrementally(connection) -> None:
+    uprn_files = find_uprn_csv_files()
+    print(f"{time.ctime()} - Found {len(uprn_files)} ONS UPRN CSV files")
 
-        # for file_path in sorted(onspd_files):
-        #   print(f"{time.ctime()} - Loading data from {file_path}")
-        #   copy_postcodes_from_onspd_file(file_path, conn)
+    refresh_uprn_tables_incrementally(connection, sorted(uprn_files))
+    build_pipeline().record_stages_completed(
+        connection,
+        ['uprn_addresses', 'uprn_interior_postcodes', 'uprn_address_to_constituency', 'uprn_postcode_to_constituency']
+    )
 
-        # set_onspd_postcode_coords(conn)
-        # create_onspd_postcode_constituency_map(conn)
+##### MAIN #####
 
-        # # mySociety processing
-        # load_mysociety_constituencies(conn)
+# Runs every stage whose inputs have changed since it last ran. Pass stage names as arguments to only consider those
+# stages, eg. `python -m app.scripts.load_postcodes mysociety_postcode_to_constituency`.
+#
+# Pass --incremental-uprn to apply a new UPRN release to the existing UPRN tables incrementally before running the
+# pipeline, rather than rebuilding them.
+#
+# Pass --multi-layer to also assign postcodes to every layer in BOUNDARY_LAYERS (see generate_postcode_to_boundary_mappings).
+#
+# Independent stages run concurrently on up to STAGE_WORKERS connections from db.pool() - pass --workers=N to change
+# that, or --workers=1 to run the stages one after another on a single connection.
+#
+# Pass --bulk-load to load the UPRN & ONSPD tables in bulk-load mode, with BULK_LOAD_SESSION_SETTINGS applied to every
+# session. The bulk-loaded tables are UNLOGGED - ie. emptied if the database crashes - unless --set-logged is passed too,
+# which makes them LOGGED at the end of the run.
+#
+# A JSON run report with each stage's timings, row counts, peak memory and the EXPLAIN (ANALYZE, BUFFERS) plans of its
+# heavy SQL statements is written to metrics.RUN_REPORTS_DIRECTORY. Pass --profile=cprofile or --profile=sample to
+# profile each stage too, and --no-explain to skip capturing the plans.
+def main() -> None:
+    args = sys.argv[1:]
+    profile = None
+    explain = True
+    workers = STAGE_WORKERS
+    for arg in list(args):
+        if arg.startswith('--profile='):
+            args.remove(arg)
+            profile = arg.split('=', 1)[1]
+        elif arg.startswith('--workers='):
+            args.remove(arg)
+            workers = int(arg.split('=', 1)[1])
+        elif arg == '--no-explain':
+            args.remove(arg)
+            explain = False
+    flags = {flag: flag in args for flag in ('--multi-layer', '--bulk-load', '--set-logged')}
+    args = [arg for arg in args if arg not in flags]
+
+    run_metrics = metrics.RunMetrics(profile=profile, explain=explain)
+    pool = db.pool()
+    try:
+        with db.connect() as conn:
+            if flags['--bulk-load']:
+                apply_session_settings(conn, BULK_LOAD_SESSION_SETTINGS)
+                pool.configure = partial(apply_session_settings, settings=BULK_LOAD_SESSION_SETTINGS)
+
+            if '--incremental-uprn' in args:
+                args.remove('--incremental-uprn')
+                with run_metrics.stage('incremental_uprn_refresh'):
+                    refresh_uprn_stages_incrementally(conn)
+
+            build_pipeline(flags['--multi-layer'], flags['--bulk-load']).run(
+                conn,
+                only=args or None,
+                run_metrics=run_metrics,
+                workers=workers,
+                pool=pool
+            )
 
-        # Combine the data
-        create_combo_constituency_map(conn)
-        create_multi_column_constituency_map(conn)
+            if flags['--set-logged']:
+                with run_metrics.stage('set_logged'):
+                    set_bulk_loaded_tables_logged(conn)
+    finally:
+        pool.close()
+        print(f"{time.ctime()} - Wrote run report to {run_metrics.write_report()}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import List
+import numpy
+import pandas
+from app.domain.boundary_index import BoundaryIndex
+from app.domain.coordinates import bng_to_wgs84
+from app.domain.postcodes import Postcode
+from app.inputs import CHUNK_SIZE, CONSTITUENCY_BOUNDARIES_FILE, find_onspd_csv_files, find_uprn_csv_files, read_csv
+import time
+
+# Run with: poetry run python -m app.scripts.map_postcodes_offline
+#
+# Generates the same postcode to constituency mappings as the uprn_postcode_to_constituency and
+# onspd_postcode_to_constituency tables created by app.scripts.load_postcodes, but entirely in-process using
+# BoundaryIndex - so no PostGIS database is needed. The input files are spread across a pool of worker processes. The
+# one difference is a point exactly on the line between two boundaries, which BoundaryIndex assigns to one of them,
+# where ST_Within assigns it to neither.
+
+OUTPUT_DIRECTORY = 'data/2024-01-28/output'
+WORKERS = os.cpu_count() or 1
+
+# Each worker process loads its own copy of the index
+boundary_index = None
+
+def load_boundary_index(file_path: str = CONSTITUENCY_BOUNDARIES_FILE) -> None:
+    global boundary_index
+    boundary_index = BoundaryIndex.from_geopackage(file_path)
+
+# Assigns points given as British National Grid eastings & northings, converting them if the boundaries are stored in
+# WGS84 (as they are when loaded into PostGIS)
+def assign_bng_points(eastings, northings) -> numpy.ndarray:
+    if boundary_index.srs_id == 27700:
+        return boundary_index.assign(eastings, northings)
+    if boundary_index.srs_id == 4326:
+        return boundary_index.assign(*bng_to_wgs84(eastings, northings))
+    raise ValueError(f"Unsupported boundary SRS {boundary_index.srs_id}")
+
+# Returns the number of addresses per (postcode, constituency_code) in the file
+def count_uprn_file_constituencies(file_path: str) -> pandas.DataFrame:
+    counts = []
+
+    with read_csv(file_path, chunksize=CHUNK_SIZE, usecols=['PCDS', 'GRIDGB1E', 'GRIDGB1N'], dtype={'PCDS':str}) as reader:
+        for chunk in reader:
+            addresses = pandas.DataFrame({
+                'postcode': Postcode.unit_postcode_series(chunk['PCDS']),
+                'constituency_code': assign_bng_points(chunk['GRIDGB1E'], chunk['GRIDGB1N']),
+            })
+            # Addresses with an invalid postcode are excluded, as they are by the join on postcode in PostGIS
+            addresses = addresses[addresses['postcode'].notna()]
+            counts.append(addresses.groupby(['postcode', 'constituency_code'], dropna=False).size().rename('address_count'))
+
+    print(f"{time.ctime()} - Finished mapping addresses from {file_path}", flush=True)
+    return pandas.concat(counts).reset_index() if counts else pandas.DataFrame(columns=['postcode', 'constituency_code', 'address_count'])
+
+# Returns the constituency of each (current, valid) postcode in the file which is within a constituency
+def map_onspd_file_constituencies(file_path: str) -> pandas.DataFrame:
+    mappings = []
+
+    with read_csv(file_path, chunksize=CHUNK_SIZE, dtype={'pcds':str, 'doterm':str}) as reader:
+        for chunk in reader:
+            chunk = chunk.assign(postcode=Postcode.unit_postcode_series(chunk['pcds']))
+            chunk = chunk[(chunk['doterm'].fillna('') == '') & chunk['postcode'].notna()]
+            if boundary_index.srs_id == 4326:
+                constituency_codes = boundary_index.assign(chunk['long'], chunk['lat'])
+            else:
+                eastings = pandas.to_numeric(chunk['oseast1m'], errors='coerce')
+                northings = pandas.to_numeric(chunk['osnrth1m'], errors='coerce')
+                constituency_codes = assign_bng_points(eastings, northings)
+            postcodes = pandas.DataFrame({'postcode': chunk['postcode'], 'constituency_code': constituency_codes})
+            mappings.append(postcodes[postcodes['constituency_code'].notna()])
+
+    print(f"{time.ctime()} - Finished mapping postcodes from {file_path}", flush=True)
+    return pandas.concat(mappings) if mappings else pandas.DataFrame(columns=['postcode', 'constituency_code'])
+
+# Equivalent of the uprn_postcode_to_constituency table
+def generate_uprn_postcode_to_constituency_mappings(
+    file_paths: List[str],
+    workers: int = WORKERS,
+    boundaries_file: str = CONSTITUENCY_BOUNDARIES_FILE
+) -> pandas.DataFrame:
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_boundary_index, initargs=(boundaries_file,)) as executor:
+        file_counts = list(executor.map(count_uprn_file_constituencies, file_paths))
+    counts = pandas.concat(file_counts) if file_counts else pandas.DataFrame(columns=['postcode', 'constituency_code', 'address_count'])
+
+    # Postcodes may be split across files, so sum the per-file counts
+    mappings = (
+        counts.groupby(['postcode', 'constituency_code'], dropna=False)['address_count'].sum()
+        .rename('postcode_constituency_address_count')
+        .reset_index()
+    )
+    mappings['postcode_address_count'] = mappings.groupby('postcode')['postcode_constituency_address_count'].transform('sum')
+    mappings['proportion_of_addresses'] = mappings['postcode_constituency_address_count'] * 100.0 / mappings['postcode_address_count']
+    return mappings[[
+        'postcode', 'constituency_code', 'postcode_address_count', 'postcode_constituency_address_count', 'proportion_of_addresses'
+    ]].sort_values(['postcode', 'constituency_code'], na_position='last')
+
+# Equivalent of the onspd_postcode_to_constituency table
+def generate_onspd_postcode_to_constituency_mappings(
+    file_paths: List[str],
+    workers: int = WORKERS,
+    boundaries_file: str = CONSTITUENCY_BOUNDARIES_FILE
+) -> pandas.DataFrame:
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_boundary_index, initargs=(boundaries_file,)) as executor:
+        file_mappings = list(executor.map(map_onspd_file_constituencies, file_paths))
+    mappings = pandas.concat(file_mappings) if file_mappings else pandas.DataFrame(columns=['postcode', 'constituency_code'])
+    return mappings.sort_values('postcode')
+
+def main() -> None:
+    uprn_files = sorted(find_uprn_csv_files())
+    print(f"{time.ctime()} - Mapping {len(uprn_files)} ONS UPRN CSV files using {WORKERS} worker processes")
+    uprn_mappings = generate_uprn_postcode_to_constituency_mappings(uprn_files)
+    uprn_mappings.to_csv(os.path.join(OUTPUT_DIRECTORY, 'uprn_postcode_to_constituency.csv'), index=False)
+
+    onspd_files = sorted(find_onspd_csv_files())
+    print(f"{time.ctime()} - Mapping {len(onspd_files)} ONSPD CSV files using {WORKERS} worker processes")
+    onspd_mappings = generate_onspd_postcode_to_constituency_mappings(onspd_files)
+    onspd_mappings.to_csv(os.path.join(OUTPUT_DIRECTORY, 'onspd_postcode_to_constituency.csv'), index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+import pandas
+from app import db, inputs
+from app.domain.boundary_index import BoundaryIndex
+from app.domain.coordinates import bng_to_wgs84
+from app.domain.postcode_lookup_binary_writer import PostcodeLookupBinaryWriter
+from app.domain.postcode_lookup_csv_writer import PostcodeLookupCsvWriter
+from app.domain.postcode_lookup_fanout_writer import PostcodeLookupFanoutWriter
+from app.domain.postcode_lookup_sqlite_writer import PostcodeLookupSqliteWriter
+from app.domain.postcodes import Postcode
+from app.scripts import load_postcodes, map_postcodes_offline
+from app.scripts.generate_synthetic_data import (
+    DEFAULT_ADDRESS_COUNT, generate_synthetic_data, synthetic_data_directory, synthetic_data_exists, synthetic_input_files
+)
+
+# Run with: poetry run python -m app.scripts.run_benchmarks [--addresses 1000000] [--database] [--stages a,b,...]
+#
+# Times each stage of the pipeline against synthetic input files (see app.scripts.generate_synthetic_data, which is
+# run first if the files don't exist yet), reporting rows/s and peak memory for each stage. Every stage runs in a fresh
+# process, so peak memory is per stage, and one stage's caches don't flatter the next.
+#
+# Stages which don't need the database always run. With --database the stages which load & join the data in PostGIS,
+# and generate the lookup files from it, run too - in a separate `benchmark` schema, so the real tables are untouched.
+# Database stages depend on the ones before them, so run them all together (or after a run which did).
+#
+# Results are appended to benchmarks/results.jsonl along with the git commit, and each run is compared with the most
+# recent run at the same scale from a different commit - so regressions between commits are visible.
+
+RESULTS_FILE = 'benchmarks/results.jsonl'
+BENCHMARK_SCHEMA = 'benchmark'
+
+class BenchmarkStage:
+    def __init__(
+        self,
+        name: str,
+        run: Callable[..., int],
+        prepare: Optional[Callable[[Dict, str], tuple]] = None,
+        requires_database: bool = False
+    ):
+        # prepare is called with the input files & output directory, and isn't timed. run is called with whatever
+        # prepare returns (or the input files & output directory if there's no prepare), and returns the number of
+        # rows it processed.
+        self.name = name
+        self.run = run
+        self.prepare = prepare
+        self.requires_database = requires_database
+
+##### Stages which don't need the database #####
+
+def parse_csv_files(files: Dict, _output_directory: str) -> int:
+    rows = 0
+    for file_path in files['uprn']:
+        # The same options as copy_addresses_from_uprn_file
+        with inputs.read_csv(file_path, chunksize=inputs.CHUNK_SIZE, dtype={'PCDS':str}) as reader:
+            for chunk in reader:
+                rows += len(chunk)
+    for file_path in files['onspd']:
+        with inputs.read_csv(file_path, chunksize=inputs.CHUNK_SIZE, dtype={'pcds':str, 'doterm':str}) as reader:
+            for chunk in reader:
+                rows += len(chunk)
+    return rows
+
+def read_uprn_postcode_chunks(files: Dict, _output_directory: str) -> tuple:
+    chunks = []
+    for file_path in files['uprn']:
+        with inputs.read_csv(file_path, chunksize=inputs.CHUNK_SIZE, usecols=['PCDS'], dtype={'PCDS':str}) as reader:
+            chunks.extend(chunk['PCDS'] for chunk in reader)
+    return (chunks,)
+
+def normalise_postcodes(chunks: List[pandas.Series]) -> int:
+    for chunk in chunks:
+        Postcode.unit_postcode_series(chunk)
+    return sum(len(chunk) for chunk in chunks)
+
+def read_uprn_coordinates(files: Dict, _output_directory: str) -> tuple:
+    coordinates = pandas.concat(
+        pandas.read_csv(file_path, usecols=['GRIDGB1E', 'GRIDGB1N']) for file_path in files['uprn']
+    )
+    return files['boundaries'], coordinates['GRIDGB1E'].to_numpy(), coordinates['GRIDGB1N'].to_numpy()
+
+def assign_with_boundary_index(boundaries_file: str, eastings, northings) -> int:
+    boundary_index = BoundaryIndex.from_geopackage(boundaries_file)
+    if boundary_index.srs_id == 4326:
+        boundary_index.assign(*bng_to_wgs84(eastings, northings))
+    else:
+        boundary_index.assign(eastings, northings)
+    return len(eastings)
+
+def map_postcodes_without_database(files: Dict, _output_directory: str) -> int:
+    mappings = map_postcodes_offline.generate_uprn_postcode_to_constituency_mappings(files['uprn'], boundaries_file=files['boundaries'])
+    return int(mappings['postcode_constituency_address_count'].sum())
+
+##### Stages which need the database #####
+
+def count_rows(table: str) -> int:
+    with db.connect() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(1) FROM {table}")
+            return cursor.fetchone()[0]
+
+def load_boundaries(files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {BENCHMARK_SCHEMA} CASCADE")
+        conn.execute(f"CREATE SCHEMA {BENCHMARK_SCHEMA}")
+        conn.commit()
+
+    subprocess.run([
+        'ogr2ogr', '-f', 'PostgreSQL', f"PG:{db.DATABASE_DSN}", files['boundaries'],
+        '-lco', f"SCHEMA={BENCHMARK_SCHEMA}", '-lco', 'GEOMETRY_NAME=geom', '-nln', 'parl_constituencies_2025',
+    ], check=True)
+    return count_rows('parl_constituencies_2025')
+
+def subdivide_boundaries(_files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.create_subdivided_constituencies(conn)
+    return count_rows('parl_constituencies_2025_subdivided')
+
+def copy_uprn_addresses(files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.create_uprn_address_table(conn)
+    load_postcodes.copy_addresses_from_uprn_files_in_parallel(files['uprn'], with_coords=True)
+    return count_rows('uprn_addresses')
+
+def copy_onspd_postcodes(files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.create_onspd_postcodes_table(conn)
+        for file_path in files['onspd']:
+            load_postcodes.copy_postcodes_from_onspd_file(file_path, conn, with_coords=True)
+    return count_rows('onspd_postcodes')
+
+def copy_mysociety_postcodes(files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.load_mysociety_constituencies(conn, files['mysociety'])
+    return count_rows('mysociety_postcode_to_constituency')
+
+def prune_uprn_postcodes(_files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.create_uprn_interior_postcodes(conn)
+    return count_rows('uprn_addresses')
+
+def join_uprn_addresses(_files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.create_uprn_address_constituency_map_in_partitions(conn)
+    return count_rows('uprn_addresses')
+
+def join_onspd_postcodes(_files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.create_onspd_postcode_constituency_map(conn)
+    return count_rows('onspd_postcodes')
+
+def aggregate_uprn_postcodes(_files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.generate_uprn_postcode_to_constituency_mappings(conn)
+    return count_rows('uprn_address_to_constituency')
+
+def combine_sources(_files: Dict, _output_directory: str) -> int:
+    with db.connect() as conn:
+        load_postcodes.combine_constituency_maps(conn)
+    return count_rows('combined_postcode_to_constituency_multicol')
+
+def generate_csv_lookup(_files: Dict, output_directory: str) -> int:
+    PostcodeLookupCsvWriter(os.path.join(output_directory, 'postcode-lookup.csv'), write_confidences=True).generate()
+    return count_rows('combined_postcode_to_constituency_multicol')
+
+def generate_sqlite_lookup(_files: Dict, output_directory: str) -> int:
+    file_path = os.path.join(output_directory, 'postcode-lookup.db')
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    PostcodeLookupSqliteWriter(file_path).generate()
+    return count_rows('combined_postcode_to_constituency_multicol')
+
+# All three lookup files from a single pass, for comparison with the sum of the individual generation stages
+def generate_all_lookups(_files: Dict, output_directory: str) -> int:
+    sqlite_file_path = os.path.join(output_directory, 'postcode-lookup-fanout.db')
+    if os.path.exists(sqlite_file_path):
+        os.remove(sqlite_file_path)
+    PostcodeLookupFanoutWriter([
+        PostcodeLookupCsvWriter(os.path.join(output_directory, 'postcode-lookup-fanout.csv'), write_confidences=True),
+        PostcodeLookupSqliteWriter(sqlite_file_path),
+        PostcodeLookupBinaryWriter(os.path.join(output_directory, 'postcode-lookup-fanout.bin')),
+    ]).generate()
+    return count_rows('combined_postcode_to_constituency_multicol')
+
+STAGES = [
+    BenchmarkStage('csv_parse', parse_csv_files),
+    BenchmarkStage('normalisation', normalise_postcodes, prepare=read_uprn_postcode_chunks),
+    BenchmarkStage('boundary_index_join', assign_with_boundary_index, prepare=read_uprn_coordinates),
+    BenchmarkStage('offline_postcode_mapping', map_postcodes_without_database),
+    BenchmarkStage('load_boundaries', load_boundaries, requires_database=True),
+    BenchmarkStage('subdivide_boundaries', subdivide_boundaries, requires_database=True),
+    BenchmarkStage('copy_uprn', copy_uprn_addresses, requires_database=True),
+    BenchmarkStage('copy_onspd', copy_onspd_postcodes, requires_database=True),
+    BenchmarkStage('copy_mysociety', copy_mysociety_postcodes, requires_database=True),
+    BenchmarkStage('boundary_pruning', prune_uprn_postcodes, requires_database=True),
+    BenchmarkStage('uprn_spatial_join', join_uprn_addresses, requires_database=True),
+    BenchmarkStage('onspd_spatial_join', join_onspd_postcodes, requires_database=True),
+    BenchmarkStage('aggregation', aggregate_uprn_postcodes, requires_database=True),
+    BenchmarkStage('combine', combine_sources, requires_database=True),
+    BenchmarkStage('csv_generation', generate_csv_lookup, requires_database=True),
+    BenchmarkStage('sqlite_generation', generate_sqlite_lookup, requires_database=True),
+    BenchmarkStage('fanout_generation', generate_all_lookups, requires_database=True),
+]
+
+##### Running stages #####
+
+# Runs a single stage in this process, and writes its measurements to result_file
+def run_stage_in_this_process(stage_name: str, directory: str, result_file: str) -> None:
+    stage = next(stage for stage in STAGES if stage.name == stage_name)
+    files = synthetic_input_files(directory)
+    output_directory = os.path.join(directory, 'output')
+    os.makedirs(output_directory, exist_ok=True)
+    args = stage.prepare(files, output_directory) if stage.prepare else (files, output_directory)
+
+    started_at = time.perf_counter()
+    cpu_started_at = _cpu_seconds()
+    rows = stage.run(*args)
+    seconds = time.perf_counter() - started_at
+    cpu_seconds = _cpu_seconds() - cpu_started_at
+
+    # ru_maxrss is in KB on Linux. Worker processes are measured separately - the peak of any one of them.
+    with open(result_file, 'w') as file:
+        json.dump({
+            'seconds': seconds,
+            'cpu_seconds': cpu_seconds,
+            'rows': rows,
+            'rows_per_second': rows / seconds if seconds else None,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }, file)
+
+def _cpu_seconds() -> float:
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+def run_stage_in_subprocess(stage: BenchmarkStage, directory: str) -> Dict:
+    with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+        env = dict(os.environ, PGOPTIONS=f"-c search_path={BENCHMARK_SCHEMA},public")
+        subprocess.run(
+            [sys.executable, '-m', 'app.scripts.run_benchmarks', '--run-stage', stage.name, '--directory', directory, '--result-file', result_file.name],
+            env=env,
+            check=True
+        )
+        with open(result_file.name, 'r') as file:
+            return json.load(file)
+
+def git_commit() -> Dict:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, text=True).stdout.strip()
+    changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], stdout=subprocess.PIPE, text=True).stdout
+    return {'commit': commit or None, 'dirty': bool(changes.strip())}
+
+def previous_result(results_file: str, address_count: int, commit: Optional[str]) -> Optional[Dict]:
+    if not os.path.exists(results_file):
+        return None
+    previous = None
+    with open(results_file, 'r') as file:
+        for line in file:
+            result = json.loads(line)
+            if result['address_count'] == address_count and result['commit'] != commit:
+                previous = result
+    return previous
+
+def print_results(result: Dict, previous: Optional[Dict]) -> None:
+    print(f"\nBenchmark results - {result['address_count']:,} addresses, commit {result['commit']}{' (dirty)' if result['dirty'] else ''}")
+    if previous:
+        print(f"Compared with commit {previous['commit']} at {previous['started_at']}")
+    print(f"{'stage':<26} {'seconds':>9} {'rows':>12} {'rows/s':>12} {'peak MB':>9} {'worker MB':>10} {'vs previous':>12}")
+    for name, stage in result['stages'].items():
+        comparison = ''
+        previous_stage = (previous or {}).get('stages', {}).get(name)
+        if previous_stage and previous_stage['seconds']:
+            comparison = f"{(stage['seconds'] / previous_stage['seconds'] - 1) * 100:+.1f}% time"
+        print(
+            f"{name:<26} {stage['seconds']:>9.2f} {stage['rows']:>12,} {stage['rows_per_second'] or 0:>12,.0f} "
+            f"{stage['peak_rss_mb']:>9.0f} {stage['peak_worker_rss_mb']:>10.0f} {comparison:>12}"
+        )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against synthetic data')
+    parser.add_argument('--addresses', type=int, default=DEFAULT_ADDRESS_COUNT, help='Number of synthetic UPRN addresses')
+    parser.add_argument('--database', action='store_true', help='Also run the stages which need the PostGIS database')
+    parser.add_argument('--stages', help='Comma separated names of the stages to run (default: all)')
+    parser.add_argument('--results-file', default=RESULTS_FILE)
+    # Used internally to run a single stage in a subprocess
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage_in_this_process(args.run_stage, args.directory, args.result_file)
+        return
+
+    directory = synthetic_data_directory(args.addresses)
+    if not synthetic_data_exists(directory, args.addresses):
+        generate_synthetic_data(args.addresses, directory)
+
+    stage_names = args.stages.split(',') if args.stages else None
+    stages = [
+        stage for stage in STAGES
+        if (stage_names is None or stage.name in stage_names) and (args.database or not stage.requires_database)
+    ]
+
+    result = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'address_count': args.addresses,
+        **git_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'stages': {},
+    }
+    for stage in stages:
+        print(f"{time.ctime()} - Benchmarking stage {stage.name}")
+        result['stages'][stage.name] = run_stage_in_subprocess(stage, directory)
+
+    previous = previous_result(args.results_file, args.addresses, result['commit'])
+    os.makedirs(os.path.dirname(args.results_file), exist_ok=True)
+    with open(args.results_file, 'a') as file:
+        file.write(json.dumps(result) + '\n')
+    print_results(result, previous)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import asyncio
+from collections import deque
+import json
+import os
+import time
+import traceback
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import unquote
+from app.domain.postcode_lookup import PostcodeLookup
+from app.scripts.generate_sqlite import OUTPUT_FILE
+
+# Run with: poetry run python -m app.scripts.serve_lookup
+#
+# A small local HTTP server for postcode -> constituency lookups, which loads the generated SQLite lookup into memory
+# at startup. Endpoints:
+#
+# - GET /postcodes/<postcode> - the constituencies for a single postcode, highest confidence first
+# - POST /postcodes - a JSON list of postcodes (or {"postcodes": [...]}), returns the constituencies for each postcode
+# - GET /metrics - request & postcode counts, throughput, and p50/p99 latency for each endpoint
+#
+# HTTP/1.1 keep-alive is supported, so load testing tools can re-use connections.
+
+HOST = os.environ.get('POSTCODE_LOOKUP_HOST', '127.0.0.1')
+PORT = int(os.environ.get('POSTCODE_LOOKUP_PORT', '8080'))
+LOOKUP_FILE = os.environ.get('POSTCODE_LOOKUP_FILE', OUTPUT_FILE)
+
+# Latency percentiles are calculated over (at most) this many of the most recent requests to each endpoint
+LATENCY_SAMPLE_SIZE = 10_000
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# Raised for requests which can't be parsed (400) or are too large (413). The connection is closed after the error
+# response, as the rest of the request can't be skipped reliably.
+class BadRequest(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class LookupMetrics:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.request_counts = {}
+        self.postcode_counts = {}
+        self.latencies = {}
+
+    def record(self, endpoint: str, postcode_count: int, latency: float) -> None:
+        self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+        self.postcode_counts[endpoint] = self.postcode_counts.get(endpoint, 0) + postcode_count
+        self.latencies.setdefault(endpoint, deque(maxlen=LATENCY_SAMPLE_SIZE)).append(latency)
+
+    def report(self) -> Dict[str, Any]:
+        uptime = time.monotonic() - self.started_at
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            sorted_latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                'requests': self.request_counts[endpoint],
+                'postcodes': self.postcode_counts[endpoint],
+                'requests_per_second': self.request_counts[endpoint] / uptime,
+                'postcodes_per_second': self.postcode_counts[endpoint] / uptime,
+                'latency_p50_ms': self._percentile(sorted_latencies, 0.50) * 1000,
+                'latency_p99_ms': self._percentile(sorted_latencies, 0.99) * 1000,
+            }
+        return {
+            'uptime_seconds': uptime,
+            'requests': sum(self.request_counts.values()),
+            'postcodes': sum(self.postcode_counts.values()),
+            'endpoints': endpoints,
+        }
+
+    def _percentile(self, sorted_values: list, percentile: float) -> float:
+        return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+class LookupServer:
+    def __init__(self, lookup: PostcodeLookup):
+        self.lookup = lookup
+        self.metrics = LookupMetrics()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"{time.ctime()} - Serving postcode lookups on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                started_at = time.perf_counter()
+                try:
+                    endpoint, status, response, postcode_count = self.route(method, path, body)
+                except Exception:
+                    # The request has been read in full, so the connection can carry on after the error response
+                    print(f"{time.ctime()} - Error handling {method} {path}", flush=True)
+                    traceback.print_exc()
+                    endpoint, status, response, postcode_count = 'error', 500, {'error': 'Internal server error'}, 0
+                self.metrics.record(endpoint, postcode_count, time.perf_counter() - started_at)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except BadRequest as error:
+            self.metrics.record('bad_request', 0, 0.0)
+            self._write_response(writer, error.status, {'error': error.message}, keep_alive=False)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Returns (endpoint name for metrics, HTTP status, JSON response, number of postcodes looked up)
+    def route(self, method: str, path: str, body: bytes) -> Tuple[str, int, Any, int]:
+        if method == 'GET' and path.startswith('/postcodes/'):
+            postcode = unquote(path[len('/postcodes/'):])
+            constituencies = self.lookup.lookup(postcode)
+            if not constituencies:
+                return 'single', 404, {'error': f"Postcode not found: {postcode}"}, 1
+            return 'single', 200, {'postcode': postcode, 'constituencies': self._format(constituencies)}, 1
+
+        if method == 'POST' and path == '/postcodes':
+            try:
+                postcodes = json.loads(body)
+            except ValueError:
+                return 'batch', 400, {'error': 'Request body must be JSON'}, 0
+            if isinstance(postcodes, dict):
+                postcodes = postcodes.get('postcodes')
+            if not isinstance(postcodes, list) or not all(isinstance(p, str) for p in postcodes):
+                return 'batch', 400, {'error': 'Request body must be a list of postcodes'}, 0
+
+            results = self.lookup.lookup_many(postcodes)
+            response = {postcode: self._format(constituencies) for postcode, constituencies in results.items()}
+            return 'batch', 200, {'results': response}, len(postcodes)
+
+        if method == 'GET' and path == '/metrics':
+            return 'metrics', 200, self.metrics.report(), 0
+
+        return 'not_found', 404, {'error': f"No route for {method} {path}"}, 0
+
+    def _format(self, constituencies) -> list:
+        return [{'short_code': pcon, 'confidence': confidence} for pcon, confidence in constituencies]
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await self._read_line(reader)
+        if not request_line:
+            return None
+
+        parts = request_line.decode('latin-1').split(' ', 2)
+        if len(parts) != 3:
+            raise BadRequest(400, 'Malformed request line')
+        method, path, _version = parts
+        headers = {}
+        while (line := await self._read_line(reader)) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        content_length = headers.get('content-length', '0')
+        if not content_length.isdigit():
+            raise BadRequest(400, 'Invalid Content-Length')
+        content_length = int(content_length)
+        if content_length > MAX_BODY_SIZE:
+            raise BadRequest(413, f"Request body is larger than {MAX_BODY_SIZE} bytes")
+        body = await reader.readexactly(content_length) if content_length else b''
+        return method, path.split('?', 1)[0], headers, body
+
+    # readline raises ValueError for lines longer than the reader's limit
+    async def _read_line(self, reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except ValueError:
+            raise BadRequest(400, 'Request line or header too long')
+
+    def _write_response(self, writer: asyncio.StreamWriter, status: int, response: Any, keep_alive: bool) -> None:
+        body = json.dumps(response).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Content Too Large', 500: 'Internal Server Error'}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"\r\n".encode() + body
+        )
+
+def main() -> None:
+    print(f"{time.ctime()} - Loading {LOOKUP_FILE} into memory")
+    lookup = PostcodeLookup(LOOKUP_FILE, in_memory=True)
+    asyncio.run(LookupServer(lookup).serve(HOST, PORT))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import os
+import psycopg
+import pytest
+from app import db
+
+# Tests taking the database fixture run against DATABASE_DSN (the docker compose database - see `make start_db`), and
+# are skipped when it isn't running. They run in a schema of their own, put first on the search path of every
+# connection (including the pool's, and worker processes') with PGOPTIONS - as run_benchmarks does - so the real tables
+# are untouched.
+TEST_SCHEMA = 'postcode_lookup_tests'
+
+@pytest.fixture(scope='session')
+def database_session():
+    try:
+        connection = db.connect(connect_timeout=2, autocommit=True)
+    except psycopg.OperationalError as error:
+        pytest.skip(f"No database to test against: {error}")
+
+    previous_options = os.environ.get('PGOPTIONS')
+    os.environ['PGOPTIONS'] = f"-c search_path={TEST_SCHEMA},public"
+    db.pool().close()
+    try:
+        yield connection
+    finally:
+        db.pool().close()
+        if previous_options is None:
+            del os.environ['PGOPTIONS']
+        else:
+            os.environ['PGOPTIONS'] = previous_options
+        connection.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+        connection.close()
+
+# A connection with an empty test schema
+@pytest.fixture
+def database(database_session):
+    database_session.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+    database_session.execute(f"CREATE SCHEMA {TEST_SCHEMA}")
+    with db.connect() as connection:
+        yield connection
+    db.pool().close()
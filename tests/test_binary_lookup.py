@@ -0,0 +1,53 @@
+import numpy
+import pytest
+from app.domain.postcode_lookup_binary_reader import PostcodeLookupBinaryReader
+from app.domain.postcode_lookup_binary_writer import PostcodeLookupBinaryWriter
+from app.domain.postcode_lookup_writer import ScoredBatch
+
+# Postcodes with their ranked constituencies - 'AB1 0AA' and the last key, 'ZE3 9ZZ', have none
+POSTCODES = {
+    'AB1 0AA': [],
+    'AB10 1QJ': [('S14000001', 0.75), ('S14000002', 0.25)],
+    'SW1A 1AA': [('E14001172', 1.0)],
+    'ZE3 9ZZ': [],
+}
+
+@pytest.fixture(params=['write_batch', 'write_row'])
+def reader(request, tmp_path):
+    file_path = str(tmp_path / 'postcode-lookup.bin')
+    writer = PostcodeLookupBinaryWriter(file_path)
+    writer.initialize_writer()
+    if request.param == 'write_batch':
+        entries = [entry for constituencies in POSTCODES.values() for entry in constituencies]
+        writer.write_batch(ScoredBatch(
+            rows=[],
+            postcodes=numpy.array(list(POSTCODES) + ['INVALID'], dtype=object),
+            offsets=numpy.cumsum([0] + [len(constituencies) for constituencies in POSTCODES.values()] + [1]),
+            pcons=numpy.array([pcon for pcon, _ in entries] + ['E1'], dtype=object),
+            confidences=numpy.array([confidence for _, confidence in entries] + [1.0]),
+        ))
+    else:
+        for postcode, constituencies in POSTCODES.items():
+            writer.write_row({'postcode': postcode}, dict(constituencies))
+    writer.finalise_writer()
+
+    reader = PostcodeLookupBinaryReader(file_path)
+    yield reader
+    reader.close()
+
+def test_round_trip(reader):
+    for postcode, constituencies in POSTCODES.items():
+        results = reader.lookup(postcode.lower().replace(' ', ''))
+        assert [pcon for pcon, _ in results] == [pcon for pcon, _ in constituencies]
+        assert [confidence for _, confidence in results] == pytest.approx([c for _, c in constituencies], abs=1e-4)
+
+    assert reader.lookup('INVALID') == []
+    assert reader.lookup('AB1 0AB') == []
+
+def test_most_likely(reader):
+    assert reader.most_likely('AB10 1QJ') == 'S14000001'
+    assert reader.most_likely('SW1A1AA') == 'E14001172'
+    # Postcodes without any constituencies, including the last key in the file
+    assert reader.most_likely('AB1 0AA') is None
+    assert reader.most_likely('ZE3 9ZZ') is None
+    assert reader.most_likely('AB1 0AB') is None
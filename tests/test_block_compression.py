@@ -0,0 +1,48 @@
+import gzip
+import numpy
+from app.domain.block_compression import BlockCompressedReader, BlockCompressedWriter
+from app.domain.postcode_lookup import PostcodeLookup
+from app.domain.postcode_lookup_csv_writer import PostcodeLookupCsvWriter
+from app.domain.postcode_lookup_writer import ScoredBatch
+
+def scored_batch(postcodes):
+    return ScoredBatch(
+        rows=[],
+        postcodes=numpy.array(postcodes, dtype=object),
+        offsets=numpy.arange(len(postcodes) + 1),
+        pcons=numpy.array([f"E{i}" for i in range(len(postcodes))], dtype=object),
+        confidences=numpy.ones(len(postcodes)),
+    )
+
+def test_blocks_with_invalid_postcodes(tmp_path):
+    file_path = str(tmp_path / 'postcode-lookup.csv.gz')
+    writer = PostcodeLookupCsvWriter(file_path, write_confidences=True, block_compression='gzip', block_rows=2)
+    writer.initialize_writer()
+    writer.write_batch(scored_batch(['AB1 0AA', None, 'AB1 0AB', 'INVALID', 'AB1 0AD']))
+    writer.write_batch(scored_batch([None, 'INVALID']))
+    writer.finalise_writer()
+
+    blocks = BlockCompressedReader(file_path).blocks
+    assert [(block['min_key'], block['max_key'], block['rows']) for block in blocks] == [
+        (None, None, 0),
+        ('AB1 0AA', 'AB1 0AD', 5),
+        (None, None, 2),
+    ]
+    with gzip.open(file_path, 'rt') as file:
+        assert len(file.readlines()) == 8
+
+    lookup = PostcodeLookup(file_path)
+    assert lookup.lookup('AB1 0AB') == [('E2', 1.0)]
+    assert lookup.most_likely('ab10ad') == 'E4'
+    assert lookup.lookup('AB1 0AC') == []
+
+def test_write_block_ignores_missing_keys(tmp_path):
+    file_path = str(tmp_path / 'data.gz')
+    writer = BlockCompressedWriter(file_path)
+    writer.write_block(b'a\nb\nc\n', keys=['AB1 0AB', None, float('nan')])
+    writer.close()
+
+    reader = BlockCompressedReader(file_path)
+    assert reader.blocks[0]['min_key'] == reader.blocks[0]['max_key'] == 'AB1 0AB'
+    assert reader.blocks[0]['rows'] == 3
+    assert reader.read_at(2, 4) == b'b\nc\n'
@@ -0,0 +1,80 @@
+import math
+import random
+import numpy
+import pytest
+from app.domain.boundary_index import BoundaryIndex
+
+# Irregular, non-overlapping boundaries: a jittered grid of many-sided cells, where the centre cell has a hole with an
+# island boundary inside it, and the two corner cells on the bottom row are one multi-polygon boundary
+def boundaries(rng: random.Random):
+    size = 4
+    corners = {
+        (i, j): (i + rng.uniform(-0.3, 0.3), j + rng.uniform(-0.3, 0.3))
+        for i in range(size + 1) for j in range(size + 1)
+    }
+    def ring(points):
+        return numpy.array(points + [points[0]], dtype=numpy.float64)
+    def cell(i, j):
+        # Each side gets an extra point, so edges aren't axis aligned and cells aren't convex
+        path = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+        points = []
+        for a, b in zip(path, path[1:] + path[:1]):
+            (ax, ay), (bx, by) = corners[a], corners[b]
+            points += [(ax, ay), ((ax + bx) / 2 + rng.uniform(-0.1, 0.1), (ay + by) / 2 + rng.uniform(-0.1, 0.1))]
+        return ring(points)
+    def circle(cx, cy, radius, sides=24):
+        return ring([(cx + radius * math.cos(2 * math.pi * k / sides), cy + radius * math.sin(2 * math.pi * k / sides)) for k in range(sides)])
+
+    features = []
+    for i in range(size):
+        for j in range(size):
+            if (i, j) == (size - 1, 0):
+                continue
+            rings = [cell(i, j)]
+            if (i, j) == (0, 0):
+                rings.append(cell(size - 1, 0))
+            if (i, j) == (1, 1):
+                cx, cy = corners[(1, 1)][0] + 0.5, corners[(1, 1)][1] + 0.5
+                rings.append(circle(cx, cy, 0.2))
+                features.append(('island', [circle(cx, cy, 0.1)]))
+            features.append((f"cell_{i}_{j}", rings))
+    return features
+
+# Even-odd ray casting over every ring of each boundary, a point at a time
+def reference_assign(features, x, y):
+    codes = []
+    for px, py in zip(x, y):
+        found = None
+        for code, rings in features:
+            crossings = 0
+            for ring in rings:
+                for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+                    if (y1 > py) != (y2 > py) and px < x1 + (py - y1) * (x2 - x1) / (y2 - y1):
+                        crossings += 1
+            if crossings % 2 == 1:
+                found = code
+                break
+        codes.append(found)
+    return codes
+
+@pytest.mark.parametrize('seed', range(5))
+def test_assign_matches_point_in_polygon(seed):
+    rng = random.Random(seed)
+    features = boundaries(rng)
+    # Random points, plus points in the island & the hole around it, and points which can't be in any boundary
+    cx, cy = dict(features)['island'][0][:-1].mean(axis=0)
+    x = numpy.array([rng.uniform(-0.5, 4.5) for _ in range(2_000)] + [cx, cx + 0.15, numpy.nan, 100.0])
+    y = numpy.array([rng.uniform(-0.5, 4.5) for _ in range(2_000)] + [cy, cy, 1.0, 1.0])
+
+    assigned = BoundaryIndex(4326, features).assign(x, y).tolist()
+    assert assigned == reference_assign(features, x, y)
+    assert {'island', 'cell_0_0', 'cell_1_1', None} <= set(assigned)
+
+def test_points_on_a_shared_edge_are_in_one_boundary():
+    def square(x, y):
+        return numpy.array([(x, y), (x + 1, y), (x + 1, y + 1), (x, y + 1), (x, y)], dtype=numpy.float64)
+    index = BoundaryIndex(27700, [('bottom_left', [square(0, 0)]), ('bottom_right', [square(1, 0)]), ('top_left', [square(0, 1)])])
+
+    # On the vertical edge between the bottom squares, and on the horizontal edge between the left squares
+    assigned = index.assign([1.0, 1.0, 0.5, 0.25], [0.5, 0.25, 1.0, 1.0]).tolist()
+    assert assigned == ['bottom_right', 'bottom_right', 'top_left', 'top_left']
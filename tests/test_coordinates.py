@@ -0,0 +1,65 @@
+import numpy
+from app.domain.coordinates import bng_to_wgs84, ewkb_points_hex
+
+# National Grid points across Great Britain, with their WGS84 longitude & latitude from PROJ for
+# '+proj=tmerc +lat_0=49 +lon_0=-2 +k=0.9996012717 +x_0=400000 +y_0=-100000 +ellps=airy
+# +towgs84=446.448,-125.157,542.06,0.15,0.247,0.842,-20.489' (the spatial_ref_sys definition of 27700 ST_Transform uses)
+# to EPSG:4326. EPSG:27700 to EPSG:4326 gives the same values, without the OSTN15 grid.
+REFERENCE_POINTS = [
+    ((530000, 180000), (-0.128353940, 51.503990828)),
+    ((325000, 673000), (-3.202386182, 55.944167047)),
+    ((134000, 25000), (-5.718349786, 50.065489470)),
+    ((447000, 1141000), (-1.155328762, 60.150795739)),
+    ((318000, 176000), (-3.182120200, 51.476993410)),
+    ((651409.903, 313177.27), (1.716051990, 52.657978599)),
+    ((261880.5, 664982.25), (-4.208231289, 55.858182171)),
+    ((465000.75, 101200.25), (-1.078876047, 50.806719821)),
+]
+
+# Points as written to the lookup tables (ie. to 6dp), with the hex of their
+# ST_AsEWKB(ST_SetSRID(ST_MakePoint(x, y), 4326))
+REFERENCE_EWKB = [
+    ((-0.128354, 51.503991), '0101000020E6100000C5C72764E76DC0BF3A3DEFC682C04940'),
+    ((-5.71835, 50.065489), '0101000020E61000008F53742497DF16C0B69F8CF161084940'),
+    ((1.716052, 52.657979), '0101000020E61000002AC423F1F274FB3F363AE7A738544A40'),
+]
+
+def test_bng_to_wgs84_matches_proj():
+    eastings, northings = zip(*[point for point, _ in REFERENCE_POINTS])
+    longitudes, latitudes = bng_to_wgs84(eastings, northings)
+
+    expected_longitudes, expected_latitudes = (numpy.array(values) for values in zip(*[wgs84 for _, wgs84 in REFERENCE_POINTS]))
+    numpy.testing.assert_allclose(longitudes, expected_longitudes, rtol=0, atol=1e-9)
+    numpy.testing.assert_allclose(latitudes, expected_latitudes, rtol=0, atol=1e-9)
+    # The DECIMAL(18,6) columns hold the same values
+    assert longitudes.round(6).tolist() == expected_longitudes.round(6).tolist()
+    assert latitudes.round(6).tolist() == expected_latitudes.round(6).tolist()
+
+def test_ewkb_points_hex_matches_postgis():
+    points, expected = zip(*REFERENCE_EWKB)
+    x, y = zip(*points)
+    assert ewkb_points_hex(x, y, 4326) == list(expected)
+
+def test_matches_st_transform(database):
+    rng = numpy.random.default_rng(0)
+    eastings = rng.uniform(100_000, 650_000, 1_000).round(2)
+    northings = rng.uniform(10_000, 1_200_000, 1_000).round(2)
+    longitudes, latitudes = bng_to_wgs84(eastings, northings)
+
+    with database.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT ST_X(point), ST_Y(point), ST_AsEWKB(point)
+            FROM (
+                SELECT ST_Transform(ST_SetSRID(ST_MakePoint(e, n), 27700), 4326) AS point, ordinality
+                FROM unnest(%s::float8[], %s::float8[]) WITH ORDINALITY AS points(e, n, ordinality)
+            ) transformed
+            ORDER BY ordinality
+            """,
+            (eastings.tolist(), northings.tolist())
+        )
+        expected_longitudes, expected_latitudes, expected_ewkb = zip(*cursor.fetchall())
+
+    numpy.testing.assert_allclose(longitudes, expected_longitudes, rtol=0, atol=1e-9)
+    numpy.testing.assert_allclose(latitudes, expected_latitudes, rtol=0, atol=1e-9)
+    assert ewkb_points_hex(expected_longitudes, expected_latitudes, 4326) == [bytes(ewkb).hex().upper() for ewkb in expected_ewkb]
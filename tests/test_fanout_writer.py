@@ -0,0 +1,59 @@
+import time
+import pytest
+from app.domain.postcode_lookup_fanout_writer import PostcodeLookupFanoutWriter
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter
+
+class RecordingWriter(PostcodeLookupWriter):
+    def __init__(self, fail_on_batch=None):
+        self.fail_on_batch = fail_on_batch
+        self.batches = []
+        self.finalised = False
+
+    def initialize_writer(self) -> None:
+        pass
+
+    def write_batch(self, batch) -> None:
+        if batch == self.fail_on_batch:
+            raise ValueError(f"Failed on batch {batch}")
+        self.batches.append(batch)
+
+    def finalise_writer(self) -> None:
+        self.finalised = True
+
+def test_threaded_sink_error_stops_every_sink():
+    failing, healthy = RecordingWriter(fail_on_batch=2), RecordingWriter()
+    fanout = PostcodeLookupFanoutWriter([failing, healthy], queue_size=1)
+    fanout.initialize_writer()
+
+    # The sinks run on their own threads, so the error is raised by a later batch
+    with pytest.raises(RuntimeError, match='RecordingWriter failed') as raised:
+        for batch in range(1_000):
+            fanout.write_batch(batch)
+            time.sleep(0.001)
+    assert isinstance(raised.value.__cause__, ValueError)
+
+    # Every sink was sent the end of the batches and has finished
+    assert not any(sink.thread.is_alive() for sink in fanout.sinks)
+    assert failing.batches == [0, 1] and not failing.finalised
+    assert healthy.batches == list(range(len(healthy.batches))) and healthy.finalised
+
+def test_threaded_writers_get_every_batch():
+    writers = [RecordingWriter(), RecordingWriter()]
+    fanout = PostcodeLookupFanoutWriter(writers, queue_size=1)
+    fanout.initialize_writer()
+    for batch in range(20):
+        fanout.write_batch(batch)
+    fanout.finalise_writer()
+
+    assert all(writer.batches == list(range(20)) and writer.finalised for writer in writers)
+
+def test_serial_sink_error_is_raised():
+    failing, healthy = RecordingWriter(fail_on_batch=1), RecordingWriter()
+    fanout = PostcodeLookupFanoutWriter([healthy, failing], threaded=False)
+    fanout.initialize_writer()
+    fanout.write_batch(0)
+
+    with pytest.raises(RuntimeError, match='RecordingWriter failed') as raised:
+        fanout.write_batch(1)
+    assert isinstance(raised.value.__cause__, ValueError)
+    assert healthy.batches == [0, 1] and failing.batches == [0]
@@ -0,0 +1,339 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import csv
+import io
+import random
+import pandas
+import pytest
+from app.domain.coordinates import bng_to_wgs84
+from app.domain.postcodes import Postcode
+from app.scripts import load_postcodes
+
+UPRN_COLUMNS = ['UPRN', 'PCDS', 'GRIDGB1E', 'GRIDGB1N']
+ONSPD_COLUMNS = ['pcds', 'doterm', 'lat', 'long']
+
+def write_csv(file_path, columns, rows) -> str:
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    return str(file_path)
+
+# Addresses in a few hundred metres square of London, a handful to a postcode, including invalid & missing postcodes
+def uprn_rows(seed: int, count: int = 500):
+    rng = random.Random(seed)
+    postcodes = [f"E1 {digit}{letters}" for digit in range(1, 4) for letters in ('AA', 'AB', 'BA', 'BB')] + ['INVALID', '']
+    return [
+        (100_000 + uprn, rng.choice(postcodes), 530_000 + rng.randint(0, 400), 180_000 + rng.randint(0, 400))
+        for uprn in range(count)
+    ]
+
+# Two neighbouring constituencies covering the southern three quarters of the addresses, given as rings of British
+# National Grid points. Both rings have a vertex half way along the boundary between them.
+CONSTITUENCIES = {
+    'WEST': [(529_900, 179_900), (530_200, 179_900), (530_200, 180_100), (530_200, 180_300), (529_900, 180_300)],
+    'EAST': [(530_200, 179_900), (530_500, 179_900), (530_500, 180_300), (530_200, 180_300), (530_200, 180_100)],
+}
+
+def create_constituencies(connection, constituencies=CONSTITUENCIES) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TABLE parl_constituencies_2025 (short_code VARCHAR, geom GEOMETRY)")
+        for short_code, points in constituencies.items():
+            eastings, northings = zip(*(points + points[:1]))
+            longitudes, latitudes = bng_to_wgs84(eastings, northings)
+            ring = ', '.join(f"{x!r} {y!r}" for x, y in zip(longitudes.tolist(), latitudes.tolist()))
+            cursor.execute(
+                "INSERT INTO parl_constituencies_2025 VALUES (%s, ST_GeomFromText(%s, 4326))",
+                (short_code, f"POLYGON(({ring}))")
+            )
+    connection.commit()
+
+def build_uprn_tables(connection) -> None:
+    load_postcodes.load_uprn_addresses(connection)
+    load_postcodes.create_subdivided_constituencies(connection)
+    load_postcodes.create_uprn_interior_postcodes(connection)
+    load_postcodes.create_uprn_address_constituency_map_in_partitions(connection, partitions=4, workers=2)
+    load_postcodes.generate_uprn_postcode_to_constituency_mappings(connection)
+
+# Postcodes of up to 10 addresses within 20m of each other, spread across the same square, so most postcodes are away
+# from the constituency boundaries and some straddle them
+def clustered_uprn_rows(seed: int, postcodes: int = 200):
+    rng = random.Random(seed)
+    rows = []
+    for index in range(postcodes):
+        postcode = f"E{index // 100 + 1} {index % 10}{'ABDEFGHJLN'[index // 10 % 10]}A"
+        easting, northing = 530_000 + rng.randint(0, 400), 180_000 + rng.randint(0, 400)
+        for _ in range(rng.randint(1, 10)):
+            rows.append((100_000 + len(rows), postcode, easting + rng.randint(-20, 20), northing + rng.randint(-20, 20)))
+    return rows
+
+def onspd_rows():
+    return [
+        ('E1 1AA', '', '51.5', '-0.1'),
+        ('E1 1AB', '', '51.500123', '-0.100456'),
+        ('E1 1BA', '202001', '51.6', '-0.2'),
+        ('INVALID', '', '51.7', '-0.3'),
+    ]
+
+# Records the COPY statements and the data written to them, instead of running them
+class FakeConnection:
+    rowcount = -1
+
+    def __init__(self):
+        self.copies = []
+        self.statements = []
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    @contextmanager
+    def copy(self, sql: str):
+        self.copies.append((sql, io.StringIO()))
+        yield self.copies[-1][1]
+
+    def execute(self, sql: str, params=None):
+        self.statements.append((' '.join(sql.split()), params))
+
+    def commit(self):
+        pass
+
+    # The copied rows, as PostgreSQL reads them with COPY_CSV_OPTIONS
+    def copied_rows(self):
+        assert all(load_postcodes.COPY_CSV_OPTIONS in sql for sql, _data in self.copies)
+        return [
+            [None if field == '\\N' else field for field in row]
+            for _sql, data in self.copies for row in csv.reader(io.StringIO(data.getvalue()))
+        ]
+
+# The fields a row-by-row text format COPY was given
+def text_copy_fields(row):
+    return [None if value is None else str(value) for value in row]
+
+def query(connection, sql: str):
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return [column.name for column in cursor.description], cursor.fetchall()
+
+def uprn_addresses(connection):
+    return query(
+        connection,
+        """
+        SELECT uprn, postcode, northing, easting, longitude, latitude, ST_AsEWKB(centroid) AS centroid
+        FROM uprn_addresses
+        ORDER BY uprn
+        """
+    )
+
+def uprn_constituencies(connection):
+    return (
+        query(connection, "SELECT uprn, constituency_code FROM uprn_address_to_constituency ORDER BY uprn"),
+        query(connection, "SELECT * FROM uprn_postcode_to_constituency ORDER BY postcode, constituency_code"),
+    )
+
+def onspd_postcodes(connection):
+    return query(
+        connection,
+        "SELECT postcode, longitude, latitude, ST_AsEWKB(centroid) AS centroid FROM onspd_postcodes ORDER BY postcode"
+    )
+
+def test_bulk_load_builds_the_same_tables(database, tmp_path, monkeypatch):
+    uprn_file = write_csv(tmp_path / 'uprn.csv', UPRN_COLUMNS, uprn_rows(seed=1))
+    onspd_file = write_csv(tmp_path / 'onspd.csv', ONSPD_COLUMNS, onspd_rows())
+    monkeypatch.setattr(load_postcodes, 'find_uprn_csv_files', lambda: [uprn_file])
+    monkeypatch.setattr(load_postcodes, 'find_onspd_csv_files', lambda: [onspd_file])
+
+    load_postcodes.load_uprn_addresses(database)
+    load_postcodes.load_onspd_postcodes(database)
+    expected_addresses, expected_postcodes = uprn_addresses(database), onspd_postcodes(database)
+    database.execute("DROP TABLE uprn_addresses, onspd_postcodes")
+    database.commit()
+
+    load_postcodes.load_uprn_addresses_in_bulk(database)
+    load_postcodes.load_onspd_postcodes_in_bulk(database)
+    assert uprn_addresses(database) == expected_addresses
+    assert onspd_postcodes(database) == expected_postcodes
+    assert len(expected_addresses[1]) == 500
+
+def test_incremental_refresh_matches_a_full_rebuild(database, tmp_path, monkeypatch):
+    rng = random.Random(2)
+    old_rows = uprn_rows(seed=2)
+    # The new release removes the first 20 addresses, moves the next 20, changes the postcode of 20 more, and adds 50
+    new_rows = [
+        (uprn, postcode, easting + rng.randint(-150, 150), northing + rng.randint(-150, 150)) if index < 40 else
+        (uprn, rng.choice(['E1 1AA', 'E1 2BB', 'E9 9ZZ', '']), easting, northing) if index < 60 else
+        (uprn, postcode, easting, northing)
+        for index, (uprn, postcode, easting, northing) in enumerate(old_rows) if index >= 20
+    ] + [(100_000 + uprn, postcode, easting, northing) for uprn, postcode, easting, northing in uprn_rows(seed=3, count=50)]
+    old_file = write_csv(tmp_path / 'old.csv', UPRN_COLUMNS, old_rows)
+    new_file = write_csv(tmp_path / 'new.csv', UPRN_COLUMNS, new_rows)
+    create_constituencies(database)
+
+    monkeypatch.setattr(load_postcodes, 'find_uprn_csv_files', lambda: [old_file])
+    build_uprn_tables(database)
+    load_postcodes.refresh_uprn_tables_incrementally(database, [new_file])
+    refreshed = uprn_constituencies(database)
+
+    database.execute(
+        """
+        DROP TABLE uprn_addresses, parl_constituencies_2025_subdivided, parl_constituencies_2025_boundary_lines,
+            uprn_postcode_extents, uprn_interior_postcodes, uprn_address_to_constituency,
+            uprn_address_to_constituency_partitions, uprn_postcode_to_constituency
+        """
+    )
+    database.commit()
+    monkeypatch.setattr(load_postcodes, 'find_uprn_csv_files', lambda: [new_file])
+    build_uprn_tables(database)
+    rebuilt = uprn_constituencies(database)
+
+    assert refreshed == rebuilt
+    # The fixture covers addresses in each constituency & in neither
+    assert {code for _, code in rebuilt[0][1]} == {'WEST', 'EAST', None}
+
+# Addresses at every vertex of the constituencies (all on a constituency boundary - shared, or on the coast), at every
+# vertex of their ST_Subdivide pieces once they're densified (many on an edge between two pieces, inside a
+# constituency), and at random points. Each address has a postcode of its own.
+def create_boundary_addresses(connection) -> None:
+    load_postcodes.create_uprn_address_table(connection)
+    with connection.cursor() as cursor:
+        vertices = """
+            INSERT INTO uprn_addresses (uprn, centroid)
+                SELECT %s + ROW_NUMBER() OVER (), point
+                FROM (SELECT (ST_DumpPoints({geom})).geom AS point FROM parl_constituencies_2025) points
+        """
+        cursor.execute(vertices.format(geom='geom'), (100000,))
+        cursor.execute("UPDATE parl_constituencies_2025 SET geom = ST_Segmentize(geom, 0.00001)")
+        cursor.execute(vertices.format(geom='ST_Subdivide(geom, 256)'), (200000,))
+        cursor.execute(
+            """
+            INSERT INTO uprn_addresses (uprn, centroid)
+                SELECT 300000 + ROW_NUMBER() OVER (), point
+                FROM (
+                    SELECT (ST_Dump(ST_GeneratePoints(ST_SetSRID(ST_Expand(ST_Extent(geom), 0.001)::geometry, 4326), 2000, 1))).geom AS point
+                    FROM parl_constituencies_2025
+                ) points
+            """
+        )
+        cursor.execute("UPDATE uprn_addresses SET postcode = 'T' || uprn")
+    connection.commit()
+
+def test_partitioned_map_matches_the_whole_polygon_join(database):
+    create_constituencies(database)
+    create_boundary_addresses(database)
+
+    load_postcodes.create_uprn_address_constituency_map(database)
+    expected = query(database, "SELECT uprn, constituency_code FROM uprn_address_to_constituency ORDER BY uprn")
+    database.execute("DROP TABLE uprn_address_to_constituency")
+    database.commit()
+
+    load_postcodes.create_subdivided_constituencies(database)
+    load_postcodes.create_uprn_interior_postcodes(database)
+    load_postcodes.create_uprn_address_constituency_map_in_partitions(database, partitions=4, workers=2)
+    assert query(database, "SELECT uprn, constituency_code FROM uprn_address_to_constituency ORDER BY uprn") == expected
+
+    codes = {uprn: code for uprn, code in expected[1]}
+    # Addresses on a constituency boundary aren't in either constituency, including the vertex shared by both halfway
+    # along the boundary between them
+    assert all(code is None for uprn, code in codes.items() if uprn < 200000)
+    # Addresses on the edge between two pieces are in the constituency
+    assert any(code is not None for uprn, code in codes.items() if 200000 <= uprn < 300000)
+    assert {code for uprn, code in codes.items() if uprn >= 300000} == {'WEST', 'EAST', None}
+
+def test_pruning_matches_the_unpruned_join(database, tmp_path, monkeypatch):
+    uprn_file = write_csv(tmp_path / 'uprn.csv', UPRN_COLUMNS, clustered_uprn_rows(seed=5))
+    monkeypatch.setattr(load_postcodes, 'find_uprn_csv_files', lambda: [uprn_file])
+    create_constituencies(database)
+    load_postcodes.load_uprn_addresses(database)
+    load_postcodes.create_subdivided_constituencies(database)
+    load_postcodes.create_uprn_interior_postcodes(database)
+    load_postcodes.create_uprn_address_constituency_map_in_partitions(database, partitions=4, workers=2)
+    pruned = query(database, "SELECT uprn, constituency_code FROM uprn_address_to_constituency ORDER BY uprn")
+    interior = query(database, "SELECT constituency_code FROM uprn_interior_postcodes")[1]
+
+    database.execute("DROP TABLE uprn_address_to_constituency, uprn_address_to_constituency_partitions")
+    database.execute("DELETE FROM uprn_interior_postcodes")
+    database.commit()
+    load_postcodes.create_uprn_address_constituency_map_in_partitions(database, partitions=4, workers=2)
+    assert query(database, "SELECT uprn, constituency_code FROM uprn_address_to_constituency ORDER BY uprn") == pruned
+
+    # Postcodes in each constituency & in neither were pruned, while those straddling a boundary weren't
+    assert {code for code, in interior} == {'WEST', 'EAST', None}
+    assert len(interior) < 200
+
+# Each table is dropped & re-created by the one stage which owns it
+@pytest.mark.parametrize('bulk_load', [False, True])
+def test_each_table_is_output_by_a_single_stage(bulk_load):
+    stages = load_postcodes.build_pipeline(multi_layer=True, bulk_load=bulk_load).stages.values()
+    tables = [table for stage in stages for table in stage.output_tables]
+    assert len(tables) == len(set(tables))
+
+def test_boundary_layer_pieces_are_subdivided_from_the_layer_table():
+    connection = FakeConnection()
+    ward = load_postcodes.BoundaryLayer('ward', 'wards_2024', 'ward_code', 'data/wards_2024.gpkg')
+    load_postcodes.create_boundary_layer_pieces(connection, [ward])
+    inserts = [statement for statement in connection.statements if statement[0].startswith('INSERT')]
+    assert inserts == [
+        ('INSERT INTO boundary_layers (layer) VALUES (%s)', ('ward',)),
+        (
+            'INSERT INTO boundary_layer_pieces (layer, boundary_code, geom) '
+            'SELECT %s, ward_code, ST_Subdivide(ST_Transform(geom, 4326), 256) FROM wards_2024',
+            ('ward',)
+        ),
+    ]
+
+POSTCODE_VARIATIONS = ['E1 1AA', 'E11AA', ' E1  1AB ', 'e1 1aa', '', 'INVALID', 'NA', '\\N ', 'SW1A 1AA']
+
+# The rows copy_addresses_from_uprn_file wrote a row at a time, before it was vectorised
+def row_by_row_uprn_rows(file_path: str):
+    rows, invalid_postcodes = [], defaultdict(int)
+    for _index, row in pandas.read_csv(file_path, dtype={'PCDS':str}, keep_default_na=False).iterrows():
+        postcode = Postcode(row['PCDS'])
+        if not postcode.valid():
+            invalid_postcodes[row['PCDS']] += 1
+        rows.append(text_copy_fields((row['UPRN'], postcode.unit_postcode(), row['GRIDGB1N'], row['GRIDGB1E'])))
+    return rows, dict(invalid_postcodes)
+
+def test_uprn_chunks_copy_the_same_rows_as_row_by_row(tmp_path, monkeypatch):
+    rng = random.Random(6)
+    rows = [(100_000 + uprn, rng.choice(POSTCODE_VARIATIONS), 530_000 + uprn, 180_000 + uprn) for uprn in range(50)]
+    uprn_file = write_csv(tmp_path / 'uprn.csv', UPRN_COLUMNS, rows)
+    monkeypatch.setattr(load_postcodes, 'CHUNK_SIZE', 7)
+
+    connection = FakeConnection()
+    invalid_postcodes = load_postcodes.copy_addresses_from_uprn_file(uprn_file, connection, show_progress=False)
+    assert (connection.copied_rows(), dict(invalid_postcodes)) == row_by_row_uprn_rows(uprn_file)
+    # Invalid & empty postcodes are loaded as NULL
+    assert {'E1 1AA', None} <= {postcode for _uprn, postcode, _northing, _easting in connection.copied_rows()}
+
+def test_onspd_chunks_copy_the_same_rows_as_row_by_row(tmp_path, monkeypatch):
+    rng = random.Random(7)
+    rows = [
+        (rng.choice(POSTCODE_VARIATIONS), rng.choice(['', '', '202001']), 51.5 + index / 1000, -0.1 - index / 1000)
+        for index in range(50)
+    ]
+    onspd_file = write_csv(tmp_path / 'onspd.csv', ONSPD_COLUMNS, rows)
+    monkeypatch.setattr(load_postcodes, 'CHUNK_SIZE', 7)
+
+    expected = []
+    for _index, row in pandas.read_csv(onspd_file, dtype={'pcds':str, 'doterm':str}, keep_default_na=False).iterrows():
+        postcode = Postcode(row['pcds'])
+        if row['doterm'] == '' and postcode.valid():
+            expected.append(text_copy_fields((postcode.unit_postcode(), row['lat'], row['long'])))
+
+    connection = FakeConnection()
+    load_postcodes.copy_postcodes_from_onspd_file(onspd_file, connection)
+    assert connection.copied_rows() == expected
+
+def test_mysociety_copies_the_same_rows_as_row_by_row(tmp_path):
+    rng = random.Random(8)
+    rows = [(rng.choice(POSTCODE_VARIATIONS), rng.choice(['E14000639', 'S14000021', ''])) for _ in range(50)]
+    mysociety_file = write_csv(tmp_path / 'mysociety.csv', ['postcode', 'short_code'], rows)
+
+    expected = [
+        text_copy_fields((Postcode(row['postcode']).unit_postcode(), row['short_code'] or None))
+        for _index, row in pandas.read_csv(mysociety_file, dtype={'postcode':str, 'short_code':str}, keep_default_na=False).iterrows()
+    ]
+
+    connection = FakeConnection()
+    load_postcodes.load_mysociety_constituencies(connection, mysociety_file)
+    assert connection.copied_rows() == expected
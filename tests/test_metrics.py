@@ -0,0 +1,48 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app import metrics
+from app.metrics import FileProgress, RunMetrics
+
+def test_stage_totals_are_reported(tmp_path):
+    run_metrics = RunMetrics(explain=False, reports_directory=str(tmp_path))
+    with run_metrics.stage('load'):
+        metrics.add_rows(rows_in=10, rows_out=8)
+        # Rows recorded on other threads count towards the stage which started them
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(metrics.in_current_stage(lambda _: metrics.add_rows(rows_in=5, rows_out=5)), range(20)))
+        metrics.add_stat('pruned_share', 0.5)
+    run_metrics.skip_stage('map')
+    with pytest.raises(RuntimeError):
+        with run_metrics.stage('output'):
+            metrics.add_rows(rows_out=1)
+            raise RuntimeError('Output failed')
+    # Outside of a stage, recording is a no-op
+    metrics.add_rows(rows_in=1_000)
+
+    with open(run_metrics.write_report()) as file:
+        stages = {stage['name']: stage for stage in json.load(file)['stages']}
+    assert [(name, stage['status']) for name, stage in stages.items()] == [
+        ('load', 'completed'), ('map', 'skipped'), ('output', 'failed')
+    ]
+    assert (stages['load']['rows_in'], stages['load']['rows_out']) == (110, 108)
+    assert stages['load']['rows_in_per_second'] == 110 / stages['load']['wall_seconds']
+    assert stages['load']['stats'] == {'pruned_share': 0.5}
+    assert (stages['map']['rows_in'], stages['map']['wall_seconds']) == (0, None)
+    assert stages['output']['rows_out'] == 1
+
+def test_file_progress_totals(tmp_path, capsys):
+    file_path = tmp_path / 'input.csv'
+    file_path.write_bytes(b'x' * 100)
+    with open(file_path, 'rb') as file:
+        progress = FileProgress('input.csv', file, interval=0)
+        file.read(25)
+        progress.update(10)
+        file.read(75)
+        progress.update(30)
+        progress.finish()
+
+    assert progress.rows == 40
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(' - ', 1)[1].split(' (')[0] for line in lines] == ['input.csv: 25%', 'input.csv: 100%', 'input.csv: 100%']
+    assert '(40 rows, ' in lines[-1]
@@ -0,0 +1,116 @@
+from contextlib import contextmanager
+import threading
+import time
+import pytest
+from app import metrics
+from app.pipeline import Pipeline, Stage
+
+class FakePool:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+    @contextmanager
+    def connection(self):
+        yield None
+
+# A pipeline of sleeping stages, with the state kept in the database replaced by an in-memory record of the stages run
+def pipeline(events, failing_stage=None):
+    lock = threading.Lock()
+    def stage(name, seconds, depends_on=()):
+        def run(_connection):
+            with lock:
+                events.append(('start', name))
+            time.sleep(seconds)
+            if name == failing_stage:
+                raise RuntimeError(name)
+            with lock:
+                events.append(('end', name))
+        return Stage(name, run, depends_on=depends_on)
+
+    pipeline = Pipeline([
+        stage('uprn', 0.3),
+        stage('uprn_map', 0.1, depends_on=['uprn']),
+        stage('onspd', 0.2),
+        stage('mysociety', 0.1),
+        stage('combined', 0.05, depends_on=['uprn_map', 'onspd', 'mysociety']),
+        stage('files', 0.05, depends_on=['combined']),
+    ])
+    pipeline._create_state_tables = lambda connection: None
+    pipeline.fingerprints = lambda connection: {name: name for name in pipeline.stages}
+    pipeline._recorded_state = lambda connection, stage: (None, False)
+    pipeline._remove_outputs = lambda connection, stage: None
+    pipeline._record_state = lambda connection, stage, fingerprint, completed: None
+    return pipeline
+
+def test_independent_stages_run_concurrently():
+    events = []
+    started_at = time.perf_counter()
+    pipeline(events).run(None, run_metrics=metrics.RunMetrics(), workers=3, pool=FakePool(4))
+    # The longest branch is uprn -> uprn_map -> combined -> files
+    assert time.perf_counter() - started_at < 0.65
+
+    position = {event: i for i, event in enumerate(events)}
+    assert {name for _, name in events[:3]} == {'uprn', 'onspd', 'mysociety'}
+    for name, dependency in [('uprn_map', 'uprn'), ('combined', 'uprn_map'), ('combined', 'onspd'), ('files', 'combined')]:
+        assert position[('end', dependency)] < position[('start', name)]
+
+def test_only_treats_other_stages_as_complete():
+    events = []
+    pipeline(events).run(None, only=['combined', 'files'], workers=3, pool=FakePool(4))
+    assert events == [('start', 'combined'), ('end', 'combined'), ('start', 'files'), ('end', 'files')]
+
+def test_failed_stage_stops_the_run():
+    events = []
+    with pytest.raises(RuntimeError, match='onspd'):
+        pipeline(events, failing_stage='onspd').run(None, workers=3, pool=FakePool(4))
+    # The running stages finish, but nothing else starts
+    assert ('end', 'uprn') in events
+    assert not any(name in ('combined', 'files') for _, name in events)
+
+def test_pool_must_be_larger_than_workers():
+    with pytest.raises(ValueError):
+        pipeline([]).run(None, workers=3, pool=FakePool(3))
+
+def test_peak_rss_is_only_reset_when_no_other_stage_is_running(monkeypatch):
+    resets = []
+    monkeypatch.setattr(metrics, '_reset_peak_rss', lambda: resets.append(True))
+    run_metrics = metrics.RunMetrics()
+    with run_metrics.stage('first'):
+        with run_metrics.stage('second'):
+            pass
+    with run_metrics.stage('third'):
+        pass
+    assert len(resets) == 2
+
+# A connection whose tables have the given relpersistence & row counts
+class FakeConnection:
+    def __init__(self, tables):
+        self.tables = tables
+
+    @contextmanager
+    def cursor(self):
+        yield FakeCursor(self.tables)
+
+class FakeCursor:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def execute(self, sql, params=None):
+        if params is not None:
+            table = self.tables.get(params[0])
+            self.row = None if table is None else (table[0],)
+        else:
+            self.row = (self.tables[sql.split('FROM ')[1].rstrip(')')][1] > 0,)
+
+    def fetchone(self):
+        return self.row
+
+@pytest.mark.parametrize('tables, exist', [
+    ({'uprn_addresses': ('p', 0)}, True),
+    ({'uprn_addresses': ('u', 10)}, True),
+    ({'uprn_addresses': ('u', 0)}, False),
+    ({}, False),
+])
+def test_emptied_unlogged_outputs_are_missing(tables, exist):
+    stage = Stage('uprn_addresses', lambda connection: None, output_tables=['uprn_addresses'])
+    assert Pipeline([stage])._outputs_exist(FakeConnection(tables), stage) == exist
@@ -0,0 +1,62 @@
+import numpy
+import pytest
+from app.domain.postcode_lookup import PostcodeLookup
+from app.domain.postcode_lookup_sqlite_writer import PostcodeLookupSqliteWriter
+from app.domain.postcode_lookup_writer import ScoredBatch
+
+PCONS = [
+    {'short_code': 'S14000001', 'name': 'Aberdeen North', 'slug': 'aberdeen-north'},
+    {'short_code': 'S14000002', 'name': 'Aberdeen South', 'slug': 'aberdeen-south'},
+]
+INCODE_LETTERS = 'ABDEFGHJLN'
+
+# More postcodes than PostcodeLookup.SQLITE_BATCH_SIZE, each with one or two constituencies
+def expected_results(count: int) -> dict:
+    results = {}
+    for i in range(count):
+        postcode = f"AB{1 + i // 100} {i % 10}A{INCODE_LETTERS[(i // 10) % 10]}"
+        if i % 3 == 0:
+            results[postcode] = [('S14000002', 0.75), ('S14000001', 0.25)]
+        else:
+            results[postcode] = [('S14000001', 1.0)]
+    return results
+
+@pytest.fixture
+def lookup_file(tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'postcode-lookup.db')
+    monkeypatch.setattr(PostcodeLookupSqliteWriter, '_get_pcon_data', lambda _self: PCONS)
+    results = expected_results(1_200)
+    entries = [entry for constituencies in results.values() for entry in constituencies]
+    writer = PostcodeLookupSqliteWriter(file_path)
+    writer.initialize_writer()
+    writer.write_batch(ScoredBatch(
+        rows=[],
+        postcodes=numpy.array(list(results), dtype=object),
+        offsets=numpy.cumsum([0] + [len(constituencies) for constituencies in results.values()]),
+        pcons=numpy.array([pcon for pcon, _ in entries], dtype=object),
+        confidences=numpy.array([confidence for _, confidence in entries]),
+    ))
+    writer.finalise_writer()
+    return file_path
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_lookup_many_across_padded_batches(lookup_file, in_memory):
+    expected = expected_results(1_200)
+    # Not a multiple of SQLITE_BATCH_SIZE, so the last batch is padded, with unknown & invalid postcodes mixed in
+    postcodes = list(expected)[:1_100] + ['ZZ1 1ZZ', 'INVALID', 'ab1 0aa']
+    lookup = PostcodeLookup(lookup_file, cache_size=100, in_memory=in_memory)
+
+    results = lookup.lookup_many(postcodes)
+    assert list(results) == postcodes
+    assert {postcode: results[postcode] for postcode in postcodes[:1_100]} == {
+        postcode: expected[postcode] for postcode in postcodes[:1_100]
+    }
+    assert results['ZZ1 1ZZ'] == []
+    assert results['INVALID'] == []
+    assert results['ab1 0aa'] == expected['AB1 0AA']
+
+    # Cached and uncached postcodes give the same results
+    assert lookup.lookup_many(postcodes) == results
+    assert lookup.most_likely('AB1 0AA') == 'S14000002'
+    assert lookup.most_likely('ZZ1 1ZZ') is None
+    lookup.close()
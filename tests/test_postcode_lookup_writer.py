@@ -0,0 +1,75 @@
+import random
+import numpy
+import pytest
+from app.domain.postcode_lookup_csv_writer import PostcodeLookupCsvWriter
+from app.domain.postcode_lookup_writer import PostcodeLookupWriter
+
+PCONS = ['E14000001', 'E14000002', 'S14000001', 'W07000001', 'UNKNOWN']
+# A handful of confidences, so constituencies often tie
+CONFIDENCES = [0.0, 0.25, 0.5, 0.5, 1.0, 1 / 3]
+
+# A combined_postcode_to_constituency_multicol row: postcode, then 5 UPRN, 1 ONSPD & 1 mySociety (pcon, confidence)
+# columns. Sources are randomly missing, and the same constituency can appear in several UPRN columns.
+def random_row(rng: random.Random, postcode_no: int) -> tuple:
+    row = [f"AB1 {postcode_no}"]
+    for _ in range(7):
+        if rng.random() < 0.4:
+            row += [None, None]
+        else:
+            row += [rng.choice(PCONS), rng.choice(CONFIDENCES)]
+    return tuple(row)
+
+def assert_batch_matches_rows(rows):
+    writer = PostcodeLookupWriter()
+    batch = writer._score_batch(rows)
+
+    assert batch.postcodes.tolist() == [row[0] for row in rows]
+    assert batch.offsets[0] == 0 and batch.offsets[-1] == len(batch.pcons)
+    for i, row in enumerate(rows):
+        start, end = batch.offsets[i], batch.offsets[i+1]
+        expected = writer._calculate_confidences(writer._parse_row(row))
+        # Exactly the same values, ranked by confidence then constituency code
+        assert dict(zip(batch.pcons[start:end].tolist(), batch.confidences[start:end].tolist())) == expected
+        assert batch.pcons[start:end].tolist() == sorted(expected, key=lambda pcon: (-expected[pcon], pcon))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_score_batch_matches_calculate_confidences(seed):
+    rng = random.Random(seed)
+    assert_batch_matches_rows([random_row(rng, i) for i in range(rng.randint(1, 200))])
+
+def test_score_batch_with_no_constituencies():
+    empty_row = ('AB1 0AA',) + (None,) * 14
+    assert_batch_matches_rows([empty_row])
+    assert_batch_matches_rows([empty_row, ('AB1 0AB', 'E14000001', 1.0) + (None,) * 12, empty_row])
+
+def test_score_batch_ties_and_repeated_constituencies():
+    row = (
+        'AB1 0AA',
+        'E14000002', 0.5, 'E14000001', 0.5, 'E14000002', 0.25, None, None, None, None,
+        'E14000001', 1.0,
+        'E14000002', 1.0,
+    )
+    batch = PostcodeLookupWriter()._score_batch([row])
+    # Only the first UPRN column for a constituency counts, and the tie is ranked by constituency code
+    assert batch.pcons.tolist() == ['E14000001', 'E14000002']
+    assert batch.confidences.tolist() == [0.5, 0.5]
+    assert numpy.array_equal(batch.offsets, [0, 2])
+
+@pytest.mark.parametrize('seed', range(5))
+def test_csv_write_row_matches_write_batch(seed, tmp_path):
+    rng = random.Random(seed)
+    rows = [random_row(rng, i) for i in range(100)]
+    files = {}
+    for method in ['write_batch', 'write_row']:
+        files[method] = tmp_path / f"{method}.csv"
+        writer = PostcodeLookupCsvWriter(str(files[method]), write_confidences=True)
+        writer.initialize_writer()
+        if method == 'write_batch':
+            writer.write_batch(writer._score_batch(rows))
+        else:
+            for row in rows:
+                parsed_row = writer._parse_row(row)
+                writer.write_row(parsed_row, writer._calculate_confidences(parsed_row))
+        writer.finalise_writer()
+    # Tied constituencies are ranked by constituency code either way
+    assert files['write_row'].read_text() == files['write_batch'].read_text()
@@ -0,0 +1,29 @@
+import numpy
+import pandas
+import pytest
+from app.domain.postcodes import Postcode
+
+POSTCODES = ['AB1 0AA', 'sw1a1aa', 'INVALID', None, ' E17 0GF ', 'AB1 0AA']
+
+@pytest.mark.parametrize('to_input', [
+    list,
+    lambda postcodes: numpy.array(postcodes, dtype=object),
+    lambda postcodes: pandas.Series(postcodes, index=range(10, 10 + len(postcodes))),
+])
+def test_parse_many_matches_postcode_methods(to_input):
+    parts = Postcode.parse_many(to_input(POSTCODES))
+
+    assert len(parts) == len(POSTCODES)
+    for row, postcode in zip(parts.itertuples(index=False), POSTCODES):
+        parsed = Postcode(postcode)
+        assert row.postcode_area == parsed.postcode_area()
+        assert row.postcode_district == parsed.postcode_district()
+        assert row.postcode_sector == parsed.postcode_sector()
+        assert row.unit_postcode == parsed.unit_postcode()
+        assert row.outcode == parsed.outcode()
+        assert row.incode == parsed.incode()
+
+def test_unit_postcode_series_returns_none_for_invalid_postcodes():
+    unit_postcodes = Postcode.unit_postcode_series(pandas.Series(['AB1 0AA', 'INVALID', None]), separator='')
+
+    assert unit_postcodes.tolist() == ['AB10AA', None, None]
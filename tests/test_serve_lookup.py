@@ -0,0 +1,75 @@
+import asyncio
+import json
+import re
+import pytest
+from app.domain.postcode_lookup import PostcodeLookup
+from app.scripts import serve_lookup
+from app.scripts.serve_lookup import LookupServer
+
+@pytest.fixture
+def lookup(tmp_path):
+    file_path = tmp_path / 'postcode-lookup.csv'
+    file_path.write_text('postcode,pcon_1,confidence_1\nAB1 0AA,S1,1.0\n')
+    return PostcodeLookup(str(file_path))
+
+# Sends raw bytes to a server on a random port, returning everything it responds with before closing the connection
+def exchange(lookup, request: bytes) -> bytes:
+    async def run():
+        server = await asyncio.start_server(LookupServer(lookup).handle_connection, '127.0.0.1', 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            writer.write(request)
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), timeout=5)
+            writer.close()
+            return response
+    return asyncio.run(run())
+
+def statuses(response: bytes) -> list:
+    return [int(status) for status in re.findall(rb'HTTP/1\.1 (\d{3}) ', response)]
+
+def test_keep_alive_requests(lookup):
+    response = exchange(
+        lookup,
+        b'GET /postcodes/AB10AA HTTP/1.1\r\n\r\n'
+        b'POST /postcodes HTTP/1.1\r\nContent-Length: 11\r\nConnection: close\r\n\r\n["AB1 0AA"]'
+    )
+    assert statuses(response) == [200, 200]
+    assert json.loads(response.rsplit(b'\r\n\r\n', 1)[1]) == {
+        'results': {'AB1 0AA': [{'short_code': 'S1', 'confidence': 1.0}]}
+    }
+
+def test_oversized_body_is_rejected(lookup, monkeypatch):
+    monkeypatch.setattr(serve_lookup, 'MAX_BODY_SIZE', 10)
+    # The body would otherwise be truncated, and its remainder parsed as a second request
+    response = exchange(
+        lookup,
+        b'POST /postcodes HTTP/1.1\r\nContent-Length: 40\r\n\r\n'
+        b'["AB1 0AA"]GET /postcodes/AB10AA HTTP/1.1\r\n\r\n'
+    )
+    assert statuses(response) == [413]
+    assert b'Connection: close' in response
+
+@pytest.mark.parametrize('request_bytes', [
+    b'NONSENSE\r\n\r\n',
+    b'POST /postcodes HTTP/1.1\r\nContent-Length: ten\r\n\r\n',
+    b'POST /postcodes HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+    b'GET /postcodes/' + b'A' * 100_000 + b' HTTP/1.1\r\n\r\n',
+])
+def test_malformed_requests_are_rejected(lookup, request_bytes):
+    response = exchange(lookup, request_bytes)
+    assert statuses(response) == [400]
+
+def test_lookup_errors_are_internal_server_errors(lookup, monkeypatch, capsys):
+    def fail(_postcode):
+        raise RuntimeError('Lookup failed')
+    monkeypatch.setattr(lookup, 'lookup', fail)
+    response = exchange(
+        lookup,
+        b'GET /postcodes/AB10AA HTTP/1.1\r\n\r\n'
+        b'GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n'
+    )
+    # The error is logged, and the connection is still usable
+    assert statuses(response) == [500, 200]
+    assert json.loads(response.rsplit(b'\r\n\r\n', 1)[1])['endpoints']['error']['requests'] == 1
+    assert 'RuntimeError: Lookup failed' in capsys.readouterr().err
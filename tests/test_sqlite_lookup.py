@@ -0,0 +1,75 @@
+import sqlite3
+import numpy
+import pytest
+from app.domain.postcode_lookup_sqlite_writer import PostcodeLookupSqliteWriter
+from app.domain.postcode_lookup_writer import ScoredBatch
+
+PCONS = [
+    {'short_code': 'S14000001', 'name': 'Aberdeen North', 'slug': 'aberdeen-north'},
+    {'short_code': 'S14000002', 'name': 'Aberdeen South', 'slug': 'aberdeen-south'},
+    {'short_code': 'E14001172', 'name': 'Cities of London and Westminster', 'slug': 'cities-of-london-and-westminster'},
+]
+
+# Postcodes with their ranked constituencies, and a postcode which doesn't normalise
+POSTCODES = {
+    'AB10 1QJ': [('S14000002', 0.75), ('S14000001', 0.25)],
+    'SW1A 1AA': [('E14001172', 0.75), ('UNKNOWN', 0.25)],
+    'AB1 0AA': [],
+    'INVALID': [('S14000001', 1.0)],
+}
+
+# The example query from the README
+README_QUERY = """
+SELECT
+  pcon.slug,
+  pcon.short_code,
+  pcon.name,
+  postcode_lookup.confidence
+FROM postcode_lookup
+JOIN pcon ON postcode_lookup.pcon_id = pcon.id
+WHERE postcode_lookup.postcode = ?
+ORDER BY postcode_lookup.confidence DESC;
+"""
+
+@pytest.fixture(params=['write_batch', 'write_row'])
+def lookup(request, tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'postcode-lookup.db')
+    monkeypatch.setattr(PostcodeLookupSqliteWriter, '_get_pcon_data', lambda _self: PCONS)
+    writer = PostcodeLookupSqliteWriter(file_path)
+    writer.initialize_writer()
+    if request.param == 'write_batch':
+        entries = [entry for constituencies in POSTCODES.values() for entry in constituencies]
+        writer.write_batch(ScoredBatch(
+            rows=[],
+            postcodes=numpy.array(list(POSTCODES), dtype=object),
+            offsets=numpy.cumsum([0] + [len(constituencies) for constituencies in POSTCODES.values()]),
+            pcons=numpy.array([pcon for pcon, _ in entries], dtype=object),
+            confidences=numpy.array([confidence for _, confidence in entries]),
+        ))
+    else:
+        for postcode, constituencies in POSTCODES.items():
+            writer.write_row({'postcode': postcode}, dict(constituencies))
+    writer.finalise_writer()
+
+    connection = sqlite3.connect(file_path)
+    yield connection
+    connection.close()
+
+def test_readme_query(lookup):
+    assert lookup.execute(README_QUERY, ('AB101QJ',)).fetchall() == [
+        ('aberdeen-south', 'S14000002', 'Aberdeen South', 0.75),
+        ('aberdeen-north', 'S14000001', 'Aberdeen North', 0.25),
+    ]
+    # Constituencies we don't know aren't in pcon, so aren't returned
+    assert lookup.execute(README_QUERY, ('SW1A1AA',)).fetchall() == [
+        ('cities-of-london-and-westminster', 'E14001172', 'Cities of London and Westminster', 0.75),
+    ]
+    assert lookup.execute(README_QUERY, ('AB10AA',)).fetchall() == []
+
+def test_rows_are_ranked_and_invalid_postcodes_skipped(lookup):
+    assert lookup.execute("SELECT postcode, rank, pcon_id, confidence FROM postcode_lookup").fetchall() == [
+        ('AB101QJ', 1, 2, 0.75),
+        ('AB101QJ', 2, 1, 0.25),
+        ('SW1A1AA', 1, 3, 0.75),
+        ('SW1A1AA', 2, None, 0.25),
+    ]